@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+# analytics.py -- size, age and extension reports for "catalog analyze"
+#
+# Reports are computed with NumPy over the memory-mapped columns of a
+# columnar export (see columnar.py), so they cost a few passes over a handful
+# of arrays instead of GROUP BY queries joining "entries" with "fileAttrs".
+# Entries are grouped by any combination of:
+#
+#   volume    the volume they are on
+#   ext       their extension
+#   kind      their kind of entry
+#   year      the year they were last modified
+#
+# and the reports are:
+#
+#   summary       count, total and mean size of the files in each group
+#   sizes         a histogram of file sizes for each group
+#   percentiles   the median, 90th and 99th percentile and largest file size
+#                 in each group
+#   top           the largest files of all
+
+import numpy
+
+from columnar import NO_TIME
+
+# Upper bounds of the buckets of the "sizes" histogram, in bytes
+SIZE_BOUNDS = (1, 1 << 10, 1 << 15, 1 << 20, 1 << 25, 1 << 30, 1 << 35)
+SIZE_LABELS = ("0", "<1K", "<32K", "<1M", "<32M", "<1G", "<32G", ">=32G")
+
+PERCENTILES = (50, 90, 99)
+
+class Analytics(object):
+    """Reports over the entries of READER, a columnar.ColumnReader using
+    NumPy.  Sizes are only reported for entries whose kind is one of
+    FILEKINDS; KINDNAMES labels the kinds of entry."""
+
+    def __init__(self, reader, fileKinds, kindNames):
+        self.reader    = reader
+        self.kindNames = kindNames
+        self.columns   = reader.columns
+        self.files     = numpy.in1d(self.columns["kind"], fileKinds)
+
+    def groups(self, by, mask):
+        """Group the entries selected by MASK, by the comma-separated list
+        of groupings BY.  Returns an array of group numbers, one for each
+        selected entry, and the label of every possible group number."""
+        keys   = numpy.zeros(numpy.count_nonzero(mask), dtype = numpy.int64)
+        labels = [""]
+
+        for grouping in by.split(","):
+            (values, names) = self.grouping(grouping.strip(), mask)
+            keys   = keys * len(names) + values
+            labels = [label and "%s / %s" % (label, name) or name
+                      for label in labels for name in names]
+
+        return (keys, labels)
+
+    def grouping(self, grouping, mask):
+        if grouping == "volume":
+            return (self.columns["volume"][mask], self.reader.volumes)
+
+        elif grouping == "ext":
+            # Entries without an extension have a code of -1
+            return (self.columns["extension"][mask] + 1,
+                    ["(none)"] + self.reader.extensions)
+
+        elif grouping == "kind":
+            kinds = sorted(self.kindNames.keys())
+            return (numpy.searchsorted(kinds, self.columns["kind"][mask]),
+                    [self.kindNames[kind] for kind in kinds])
+
+        elif grouping == "year":
+            modified = self.columns["modified"][mask]
+            known    = modified != NO_TIME
+            years    = numpy.zeros(len(modified), dtype = numpy.int64)
+            years[known] = modified[known].astype("datetime64[s]") \
+                                          .astype("datetime64[Y]") \
+                                          .astype(numpy.int64) + 1970
+            if not known.any():
+                return (years, ["(unknown)"])
+
+            first = years[known].min()
+            last  = years[known].max()
+            years[known] -= first - 1
+            return (years, ["(unknown)"] + [str(year) for year in
+                                            range(first, last + 1)])
+
+        raise ValueError("cannot group by '%s'" % grouping)
+
+    def summary(self, by, limit):
+        (keys, labels) = self.groups(by, self.files)
+        sizes  = self.columns["size"][self.files]
+        counts = numpy.bincount(keys, minlength = len(labels))
+        totals = numpy.bincount(keys, weights = sizes, minlength = len(labels))
+
+        rows = []
+        for group in numpy.argsort(-totals, kind = "mergesort")[:limit]:
+            if counts[group]:
+                rows.append((labels[group], counts[group], long(totals[group]),
+                             long(totals[group] / counts[group])))
+        return (("group", "files", "size", "mean"), rows)
+
+    def sizes(self, by, limit):
+        (keys, labels) = self.groups(by, self.files)
+        buckets = numpy.searchsorted(SIZE_BOUNDS,
+                                     self.columns["size"][self.files],
+                                     side = "right")
+
+        width  = len(SIZE_LABELS)
+        counts = numpy.bincount(keys * width + buckets,
+                                minlength = len(labels) * width)
+        counts = counts.reshape((len(labels), width))
+        totals = counts.sum(axis = 1)
+
+        rows = []
+        for group in numpy.argsort(-totals, kind = "mergesort")[:limit]:
+            if totals[group]:
+                rows.append((labels[group],) + tuple(counts[group]))
+        return (("group",) + SIZE_LABELS, rows)
+
+    def percentiles(self, by, limit):
+        (keys, labels) = self.groups(by, self.files)
+        sizes = self.columns["size"][self.files]
+
+        # Sorting by group, and by size within each group, leaves every
+        # group as one sorted run
+        order  = numpy.lexsort((sizes, keys))
+        keys   = keys[order]
+        sizes  = sizes[order]
+        starts = numpy.flatnonzero(numpy.diff(keys)) + 1
+        starts = numpy.concatenate(([0], starts))
+        ends   = numpy.concatenate((starts[1:], [len(keys)]))
+
+        rows = []
+        for (start, end) in zip(starts, ends):
+            if start == end:
+                continue
+            run = sizes[start:end]
+            rows.append((labels[keys[start]], end - start) +
+                        tuple([long(value) for value in
+                               numpy.percentile(run, PERCENTILES)]) +
+                        (long(run[-1]),))
+
+        rows.sort(key = lambda row: -row[1])
+        return (("group", "files") +
+                tuple(["p%d" % point for point in PERCENTILES]) + ("max",),
+                rows[:limit])
+
+    def top(self, by, limit):
+        sizes = self.columns["size"].copy()
+        sizes[~self.files] = -1
+
+        limit = min(limit, len(sizes))
+        if limit <= 0:
+            return (("size", "volume", "path"), [])
+
+        largest = numpy.argpartition(-sizes, limit - 1)[:limit]
+        largest = largest[numpy.argsort(-sizes[largest], kind = "mergesort")]
+
+        rows = []
+        for index in largest:
+            if sizes[index] < 0:
+                break
+            row = self.reader.row(index)
+            rows.append((row["size"], row["volume"], row["path"]))
+        return (("size", "volume", "path"), rows)
+
+    def run(self, report, by, limit):
+        (header, rows) = getattr(self, report)(by, limit)
+        printTable(header, rows)
+
+def printTable(header, rows):
+    """Print ROWS in columns under HEADER, with numbers to the right."""
+    table   = [header] + rows
+    widths  = [max([len(unicode(row[i])) for row in table])
+               for i in range(len(header))]
+    numeric = [bool(rows) and not isinstance(rows[0][i], basestring)
+               for i in range(len(header))]
+
+    for row in table:
+        cells = []
+        for i in range(len(row)):
+            if numeric[i]:
+                cells.append(unicode(row[i]).rjust(widths[i]))
+            else:
+                cells.append(unicode(row[i]).ljust(widths[i]))
+        print "  ".join(cells).rstrip().encode("utf-8")
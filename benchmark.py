@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+#
+# benchmark.py -- performance checks for catalog.py
+#
+# Usage:
+#
+#   benchmark.py memory
+#   benchmark.py generate DIR [--files N] [--depth N] [--names DIST] ...
+#   benchmark.py run [--save FILE] [--baseline FILE] [--pgsql DATABASE] ...
+#
+# "memory" checks that the in-memory record for each kind of entry stays
+# within catalog.ENTRY_MEMORY_BUDGET bytes, and exits non-zero if not.
+#
+# "generate" creates a synthetic volume under DIR.  The same --seed always
+# produces the same tree: the same names, sizes and contents, and the same
+# .zip and .tar.gz archives embedded in it.
+#
+# "run" generates a volume in a temporary directory and measures, against an
+# SQLite catalog (and a PostgreSQL one, if --pgsql is given):
+#
+#   index     entries per second for a first "catalog index"
+#   reindex   seconds to index the same volume again
+#   dbSize    size of the SQLite catalog file, in bytes
+#   queries   median seconds for each "name" and "path" query pattern
+#
+# The results are written as JSON with --save.  With --baseline, they are
+# compared against an earlier result, and the run fails if any timing is
+# more than --tolerance percent worse, so regressions in the hot paths are
+# caught.
+
+import os
+import sys
+import time
+import random
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import optparse
+
+from StringIO import StringIO
+from subprocess import Popen, PIPE
+from os.path import join, dirname, abspath, getsize
+
+import catalog
+
+catalogScript = join(dirname(abspath(__file__)), "catalog.py")
+
+########################################################################
+
+def entryOverhead(entry):
+    size  = sys.getsizeof(entry)
+    attrs = entry.attrs
+    if attrs is not None:
+        size += sys.getsizeof(attrs)
+        if isinstance(attrs, catalog.ArchiveAttrs):
+            size += sys.getsizeof(attrs.dirAttrs)
+    return size
+
+def measureMemory():
+    """Return a map from kind of entry to its in-memory overhead."""
+    root = tempfile.mkdtemp()
+    try:
+        os.mkdir(join(root, "directory"))
+        for name in ("file.txt", "archive.zip"):
+            fd = open(join(root, name), "w")
+            fd.write("x" * 100)
+            fd.close()
+        os.symlink("file.txt", join(root, "link"))
+
+        volume = catalog.Volume(root, "memory", None, None)
+        sizes  = {}
+        for name in sorted(os.listdir(root)):
+            entry = catalog.createEntry(volume, None, join(root, name),
+                                        name, name)
+            entry.readInfo()
+            sizes[name] = entryOverhead(entry)
+        return sizes
+    finally:
+        shutil.rmtree(root)
+
+def checkMemory():
+    catalog.opts.databaseFile = ":memory:"
+    catalog.openDatabase()
+
+    sizes  = measureMemory()
+    failed = False
+    for name in sorted(sizes):
+        print "%-12s %4d bytes" % (name, sizes[name])
+        if sizes[name] > catalog.ENTRY_MEMORY_BUDGET:
+            failed = True
+
+    print "budget       %4d bytes" % catalog.ENTRY_MEMORY_BUDGET
+    if failed:
+        print "FAILED: entry memory exceeds the budget"
+        return 1
+    return 0
+
+########################################################################
+
+extensions = ("txt", "jpg", "pdf", "c", "h", "py", "mp3", "html", "o", "")
+words      = ("report", "image", "data", "backup", "notes", "index", "main",
+              "test", "photo", "draft", "final", "log", "config", "util")
+
+def makeName(rng, distribution):
+    """Make a file name according to one of the name distributions:
+
+      uniform   random lowercase names, nearly all of them distinct
+      zipf      a few common words dominate, with numeric suffixes
+      long      names of 60 to 200 characters"""
+    ext = rng.choice(extensions)
+    if distribution == "zipf":
+        index = min(int(rng.paretovariate(1.2)) - 1, len(words) - 1)
+        stem  = "%s-%d" % (words[index], rng.randint(1, 50))
+    elif distribution == "long":
+        stem = "".join([rng.choice("abcdefghijklmnopqrstuvwxyz_-")
+                        for i in range(rng.randint(60, 200))])
+    else:
+        stem = "".join([rng.choice("abcdefghijklmnopqrstuvwxyz")
+                        for i in range(rng.randint(3, 16))])
+    if ext:
+        return stem + "." + ext
+    return stem
+
+def makeData(rng, maxSize):
+    size = min(int(rng.lognormvariate(7, 2)), maxSize)
+    return (("%08x" % rng.getrandbits(32)) * (size / 8 + 1))[:size]
+
+def generateVolume(root, files = 10000, depth = 6, fanout = 8, archives = 10,
+                   members = 50, names = "uniform", maxSize = 65536,
+                   seed = 1):
+    """Create a synthetic volume under ROOT and return how many files,
+    directories and archives it holds."""
+    rng = random.Random(seed)
+
+    # Lay out the directory tree first, breadth first, so that "depth" and
+    # "fanout" bound its shape, and then scatter the files across it.
+    directories = [root]
+    frontier    = [(root, 0)]
+    while frontier and len(directories) < max(files / 20, 1):
+        (path, level) = frontier.pop(0)
+        if level >= depth:
+            continue
+        for i in range(rng.randint(1, fanout)):
+            child = join(path, "dir%d-%s" % (i, makeName(rng, names)))
+            directories.append(child)
+            frontier.append((child, level + 1))
+
+    for path in directories:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    for i in range(files):
+        path = join(rng.choice(directories), "%d-%s" % (i, makeName(rng, names)))
+        fd = open(path, "wb")
+        fd.write(makeData(rng, maxSize))
+        fd.close()
+
+    for i in range(archives):
+        directory = rng.choice(directories)
+        if i % 2 == 0:
+            archive = zipfile.ZipFile(join(directory, "archive%d.zip" % i), "w",
+                                      zipfile.ZIP_DEFLATED)
+            for j in range(members):
+                archive.writestr("member%d/%s" % (j % 5, makeName(rng, names)),
+                                 makeData(rng, maxSize))
+            archive.close()
+        else:
+            archive = tarfile.open(join(directory, "archive%d.tar.gz" % i), "w:gz")
+            for j in range(members):
+                data = makeData(rng, maxSize)
+                info = tarfile.TarInfo("member%d/%s" % (j % 5, makeName(rng, names)))
+                info.size  = len(data)
+                info.mtime = 1200000000 + j
+                archive.addfile(info, StringIO(data))
+            archive.close()
+
+    return { "files": files, "directories": len(directories),
+             "archives": archives, "members": archives * members }
+
+########################################################################
+
+def catalogArgs(backend):
+    if backend["kind"] == "pgsql":
+        args = ["-d", backend["database"]]
+        if backend.get("user"):
+            args += ["-u", backend["user"]]
+        if backend.get("password"):
+            args += ["-p", backend["password"]]
+        return args
+    return ["-f", backend["file"]]
+
+def runIndex(backend, root, name):
+    """Index ROOT as volume NAME in a separate process, the way a user
+    would, and return the statistics it wrote with --stats-json."""
+    import json
+
+    (fd, statsFile) = tempfile.mkstemp(suffix = ".json")
+    os.close(fd)
+    try:
+        start = time.time()
+        proc = Popen([sys.executable, catalogScript] + catalogArgs(backend) +
+                     ["--progress", "0", "--stats-json", statsFile,
+                      "index", root, name], stdout = PIPE)
+        proc.communicate()
+        elapsed = time.time() - start
+        if proc.returncode != 0:
+            raise Exception("catalog index failed with status %d" %
+                            proc.returncode)
+
+        fd = open(statsFile)
+        result = json.load(fd)
+        fd.close()
+        result["wallTime"] = elapsed
+        return result
+    finally:
+        os.remove(statsFile)
+
+def timeQueries(backend, patterns, repeat):
+    """Run each query pattern REPEAT times in this process, so that only
+    the query itself is measured, and return the median of each.  The
+    search cache is turned off, or every run after the first would only
+    measure a cache hit."""
+    catalog.opts.cacheSize    = 0
+    catalog.opts.databaseName = None
+    catalog.opts.databaseFile = None
+    if backend["kind"] == "pgsql":
+        catalog.opts.databaseName = backend["database"]
+        catalog.opts.databaseUser = backend.get("user")
+        catalog.opts.databasePass = backend.get("password")
+    else:
+        catalog.opts.databaseFile = backend["file"]
+    catalog.openDatabase()
+    catalog.initDatabase()
+
+    def ignore(entry):
+        pass
+
+    results = {}
+    try:
+        for (kind, pattern) in patterns:
+            find = (kind == "name" and catalog.findEntriesByName or
+                    catalog.findEntriesByPath)
+            times = []
+            for i in range(repeat):
+                start = time.time()
+                count = len(find(pattern, ignore))
+                times.append(time.time() - start)
+            times.sort()
+            results["%s %s" % (kind, pattern)] = {
+                "seconds": times[len(times) / 2], "matches": count }
+    finally:
+        catalog.conn.close()
+    return results
+
+queryPatterns = (("name", "report-1.txt"),
+                 ("name", "*.pdf"),
+                 ("name", "*photo*"),
+                 ("path", "*/member3/*"),
+                 ("path", "dir0-*"))
+
+def benchmarkBackend(backend, root, repeat):
+    first  = runIndex(backend, root, "benchmark")
+    second = runIndex(backend, root, "benchmark")
+
+    result = { "index":   { "entriesPerSecond": first["entriesPerSecond"],
+                            "seconds":          first["wallTime"],
+                            "entries":          first["entries"],
+                            "phases":           first["phases"] },
+               "reindex": { "seconds": second["wallTime"] },
+               "queries": timeQueries(backend, queryPatterns, repeat) }
+    if backend["kind"] == "sqlite":
+        result["dbSize"] = getsize(backend["file"])
+    return result
+
+def havePostgreSQL():
+    try:
+        from pyPgSQL import PgSQL
+        return True
+    except ImportError:
+        return False
+
+########################################################################
+
+def compare(baseline, current, tolerance):
+    """Return a list of descriptions of the timings in CURRENT that are more
+    than TOLERANCE percent worse than those in BASELINE."""
+    regressions = []
+    limit = 1.0 + tolerance / 100.0
+
+    for backend in current["backends"]:
+        old = baseline.get("backends", {}).get(backend)
+        new = current["backends"][backend]
+        if not old:
+            continue
+
+        def check(label, before, after, higherIsBetter = False, floor = 0):
+            # Differences smaller than FLOOR are timer noise, not regressions
+            if not before or not after or abs(after - before) < floor:
+                return
+            if higherIsBetter:
+                worse = before / after
+            else:
+                worse = after / before
+            if worse > limit:
+                regressions.append("%s %s: %.4g -> %.4g (%.0f%% worse)" %
+                                   (backend, label, before, after,
+                                    (worse - 1.0) * 100))
+
+        check("index entries/sec", old["index"]["entriesPerSecond"],
+              new["index"]["entriesPerSecond"], higherIsBetter = True)
+        check("reindex seconds", old["reindex"]["seconds"],
+              new["reindex"]["seconds"], floor = 0.1)
+        if "dbSize" in old:
+            check("database size", float(old["dbSize"]), float(new["dbSize"]))
+        for query in new["queries"]:
+            if query in old["queries"]:
+                check("query '%s'" % query, old["queries"][query]["seconds"],
+                      new["queries"][query]["seconds"], floor = 0.005)
+
+    for name in current["memory"]:
+        before = baseline.get("memory", {}).get(name)
+        after  = current["memory"][name]
+        if before and after > before:
+            regressions.append("memory %s: %d -> %d bytes" % (name, before, after))
+
+    return regressions
+
+def run(opts):
+    import json
+
+    work = tempfile.mkdtemp()
+    try:
+        root = join(work, "volume")
+        print "Generating %d files under %s" % (opts.files, root)
+        shape = generateVolume(root, opts.files, opts.depth, opts.fanout,
+                               opts.archives, opts.members, opts.names,
+                               opts.maxSize, opts.seed)
+
+        backends = { "sqlite": { "kind": "sqlite",
+                                 "file": join(work, "catalog.db") } }
+        if opts.pgsql:
+            if havePostgreSQL():
+                backends["pgsql"] = { "kind":     "pgsql",
+                                      "database": opts.pgsql,
+                                      "user":     opts.pgsqlUser,
+                                      "password": opts.pgsqlPass }
+            else:
+                print "pyPgSQL is not installed; skipping PostgreSQL"
+
+        catalog.opts.databaseFile = ":memory:"
+        catalog.openDatabase()
+        current = { "volume":   shape,
+                    "settings": { "seed": opts.seed, "names": opts.names,
+                                  "depth": opts.depth, "fanout": opts.fanout },
+                    "memory":   measureMemory(),
+                    "backends": {} }
+
+        for name in sorted(backends):
+            print "Benchmarking", name
+            current["backends"][name] = \
+                benchmarkBackend(backends[name], root, opts.repeat)
+            result = current["backends"][name]
+            print "  index:   %.0f entries/sec" % result["index"]["entriesPerSecond"]
+            print "  reindex: %.2f seconds" % result["reindex"]["seconds"]
+            if "dbSize" in result:
+                print "  dbSize:  %d bytes" % result["dbSize"]
+            for query in sorted(result["queries"]):
+                print "  %-24s %.4f seconds" % \
+                    (query, result["queries"][query]["seconds"])
+    finally:
+        shutil.rmtree(work)
+
+    if opts.save:
+        fd = open(opts.save, "w")
+        json.dump(current, fd, indent = 2, sort_keys = True)
+        fd.write("\n")
+        fd.close()
+
+    if opts.baseline:
+        fd = open(opts.baseline)
+        baseline = json.load(fd)
+        fd.close()
+
+        if baseline.get("volume") != current["volume"] or \
+           baseline.get("settings") != current["settings"]:
+            print "warning: the baseline was made with a different volume"
+
+        regressions = compare(baseline, current, opts.tolerance)
+        if regressions:
+            print "REGRESSIONS against %s:" % opts.baseline
+            for regression in regressions:
+                print " ", regression
+            return 1
+        print "No regressions against", opts.baseline
+
+    return 0
+
+########################################################################
+
+parser = optparse.OptionParser(usage = "%prog memory | generate DIR | run")
+
+parser.add_option('', '--files', metavar='N', type='int', dest='files',
+                  default=10000, help='number of plain files to generate')
+parser.add_option('', '--depth', metavar='N', type='int', dest='depth',
+                  default=6, help='maximum directory depth')
+parser.add_option('', '--fanout', metavar='N', type='int', dest='fanout',
+                  default=8, help='maximum subdirectories per directory')
+parser.add_option('', '--archives', metavar='N', type='int', dest='archives',
+                  default=10, help='number of .zip and .tar.gz archives')
+parser.add_option('', '--members', metavar='N', type='int', dest='members',
+                  default=50, help='number of members in each archive')
+parser.add_option('', '--names', metavar='DIST', type='choice',
+                  choices=('uniform', 'zipf', 'long'), dest='names',
+                  default='uniform', help='name distribution: uniform, zipf or long')
+parser.add_option('', '--max-size', metavar='BYTES', type='int', dest='maxSize',
+                  default=65536, help='largest generated file')
+parser.add_option('', '--seed', metavar='N', type='int', dest='seed',
+                  default=1, help='random seed for the generated volume')
+parser.add_option('', '--repeat', metavar='N', type='int', dest='repeat',
+                  default=5, help='times to run each query')
+parser.add_option('', '--save', metavar='FILE', type='string', dest='save',
+                  help='write the results to FILE as JSON')
+parser.add_option('', '--baseline', metavar='FILE', type='string', dest='baseline',
+                  help='compare the results with those saved in FILE')
+parser.add_option('', '--tolerance', metavar='PERCENT', type='float',
+                  dest='tolerance', default=25.0,
+                  help='how much worse than the baseline is a regression')
+parser.add_option('', '--pgsql', metavar='DATABASE', type='string', dest='pgsql',
+                  help='also benchmark this PostgreSQL database')
+parser.add_option('', '--pgsql-user', metavar='USER', type='string',
+                  dest='pgsqlUser', help='PostgreSQL user to connect as')
+parser.add_option('', '--pgsql-pass', metavar='PASS', type='string',
+                  dest='pgsqlPass', help='PostgreSQL user\'s password')
+
+if __name__ == "__main__":
+    (opts, args) = parser.parse_args()
+
+    if not args or args[0] not in ("memory", "generate", "run"):
+        parser.print_usage()
+        sys.exit(1)
+
+    if args[0] == "memory":
+        sys.exit(checkMemory())
+
+    elif args[0] == "generate":
+        if len(args) != 2:
+            print "usage: benchmark.py generate DIR"
+            sys.exit(1)
+        shape = generateVolume(args[1], opts.files, opts.depth, opts.fanout,
+                               opts.archives, opts.members, opts.names,
+                               opts.maxSize, opts.seed)
+        print "Generated %(files)d files in %(directories)d directories, " \
+            "with %(archives)d archives holding %(members)d members" % shape
+
+    elif args[0] == "run":
+        sys.exit(run(opts))
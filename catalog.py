@@ -11,7 +11,6 @@
 #
 # - add support for storing MD5 checksums
 # - add support for comparing a directory to a recorded volume
-# - Write "ext" basic query (for searching based on file extensions)
 # - Exclude trashes, device files (/dev, /proc), and mount locations
 
 # INSTALL
@@ -63,13 +62,118 @@
 # optional.  Although the --name will be reported back to you, their content
 # has no special meaning.
 #
+# Several volumes can be indexed in one run, each walked by its own threads,
+# so that a shelf of external drives takes about as long as its slowest
+# drive.  Give a path and name for each, or list them in a file, one per
+# line, as a path and optionally a name, location and kind, separated by
+# tabs:
+#
+#   catalog -f /tmp/catalog.db index /media/disk1 "Disk 1" /media/disk2 "Disk 2"
+#   catalog -f /tmp/catalog.db --volume-list drives.txt index
+#
+# If indexing a large volume is interrupted, run the same command again with
+# --resume: subtrees that were completely stored are skipped, and the walk
+# picks up where it left off.
+#
+# On Linux, a volume that stays mounted can be kept up to date between index
+# runs by watching it, with the same path and name it was indexed with (see
+# WATCHING A VOLUME below):
+#
+#   catalog -f /tmp/catalog.db watch /Users "Home directories"
+#
+# Volumes that cannot be walked from here, such as those on remote hosts or
+# staged from tape, can be catalogued from a manifest made where they live:
+#
+#   find /data -printf '%P\t%y\t%s\t%m\t%U\t%G\t%T@\n' > data.manifest
+#   catalog -f /tmp/catalog.db ingest-manifest data.manifest "Data" /data
+#
+# Each record holds a path, the "find %y" type letter, size, octal mode, uid,
+# gid, modification time in epoch seconds, and optionally a checksum as an
+# eighth field, all separated by tabs.  The checksum is in hexadecimal, as
+# "ALGORITHM:VALUE" (e.g. "sha256:9f86d0...") or as a bare value, taken to be
+# MD5, SHA-1 or SHA-256 by its length of 32, 40 or 64 digits; records with
+# any other checksum are rejected.  Use "\0" at the end of the -printf
+# format and the -0 option for paths that may contain newlines, and "-" to
+# read the manifest from standard input.  Missing parent directories are
+# created as needed; archives are catalogued as plain files, since their
+# contents are not in the manifest.
+#
+# Indexing runs as a pipeline (see INDEXING PIPELINE below): one thread walks
+# the volume, --jobs threads (2 by default) list archives and compute
+# checksums, and rows are written in transactions of --batch-size rows.
+#
+# While indexing, a progress line is printed every 10 seconds (see
+# --progress).  To find out where an index run spends its time, add
+# "--stats-json FILE" to get per-phase timings, hashing and archive
+# throughput and a commit latency histogram, or "--profile FILE" to collect
+# cProfile statistics for the run.
+#
 # Once indexed, you can search for what you need:
 #
 #   catalog -f /tmp/catalog.db name 'foo*'
 #   catalog -f /tmp/catalog.db path '/foo'
+#   catalog -f /tmp/catalog.db ext 'pdf'
+#   catalog -f /tmp/catalog.db tag 'important'
+#
+# To find what changed recently, or within a period, give local dates and
+# times ("2008-03-01", "2008-03-01 14:30") or ages ("90m", "12h", "7d", "2w"):
+#
+#   catalog -f /tmp/catalog.db newer-than 7d
+#   catalog -f /tmp/catalog.db modified-between 2008-01-01 2008-02-01
+#
+# With -r, the patterns given to "name" and "path" are regular expressions,
+# searched for anywhere in the name or path unless anchored with "^":
+#
+#   catalog -f /tmp/catalog.db -r name '^IMG_[0-9]{4}\.(jpe?g|cr2)$'
+#
+# SQLite matches them with Python's re module, PostgreSQL with its own "~"
+# operator, whose syntax is the same for everyday patterns.  The literal text
+# a pattern requires ("IMG_" above) is looked for first with LIKE, so the
+# expression itself is only tried on the entries that contain it.
 #
 # Set the environment variable CATALOG_FILE if you get tired of passing the -f
 # option.
+#
+# For many searches in a row, as from an editor or from shell completion,
+# leave a server running and send the searches to it with --client; it keeps
+# the database open between searches (see SEARCH SERVER below):
+#
+#   catalog -f /tmp/catalog.db serve &
+#   catalog -f /tmp/catalog.db --client name 'foo*'
+#
+# To search a catalog on a machine without the database, export it (or just
+# some of its volumes) and copy the export there:
+#
+#   catalog -f /tmp/catalog.db export /tmp/catalog.export "Home directories"
+#   columnar.py /tmp/catalog.export --name 'foo*' --ext pdf --min-size 1048576
+#
+# The export is a set of flat, memory-mapped column files; see columnar.py.
+#
+# To see where the space goes on a volume, "du" reports the totals recorded
+# for each directory when it was indexed, without rescanning anything:
+#
+#   catalog du                                  # largest directories anywhere
+#   catalog du "Home directories" --depth 2     # a volume's tree, 2 levels
+#   catalog du "My Book:Backups/2008"           # one directory and below
+#   catalog du "Old disk:Users" "New disk:Users"   # compare, child by child
+#
+# For reports over sizes, ages and extensions, use "analyze", which needs
+# NumPy:
+#
+#   catalog analyze summary --by volume,ext     # count and size per group
+#   catalog analyze sizes --by ext              # size histogram per group
+#   catalog analyze percentiles --by year       # file size percentiles
+#   catalog analyze top --limit 1000            # largest files anywhere
+#
+# The reports run over an export of the whole catalog, kept in FILE.columns
+# beside the catalog and refreshed whenever the catalog has changed.
+#
+# To find copies of files, index with --fingerprint (see "fingerprint" in the
+# schema below), then:
+#
+#   catalog same ~/Downloads/setup.iso          # copies of a file anywhere
+#   catalog same "My Book:Backups/setup.iso"    # copies of a catalogued file
+#   catalog dups --limit 100                    # the largest sets of copies
 
 # ABOUT
 #
@@ -85,6 +189,9 @@
 #    b. .tar, .tar.gz, .tgz, .tar.bz2, .tbz
 #    d. .rar
 #    c. .7z
+#    e. .iso, CD, DVD and Blu-ray images (ISO 9660, with Rock Ridge or
+#       Joliet, and UDF), read on any platform without mounting them; see
+#       isoimage.py
 #
 # 2. On OS/X, it descends into disk images, provided that:
 #    a. They do not ask for agreement to a software license, and
@@ -117,6 +224,8 @@
 #   "kind"        TEXT      A description of the kind of volume it is
 #   "totalCount"  INT       The total number of entries in the volume
 #   "totalSize"   BIGINT    The total uncompressed size of those entries
+#   "generation"  INT       The catalog generation (see below) its indexing
+#                           finished at; NULL while it is being indexed
 #
 # The next, and largest table in the database is "entries", which is almost
 # always what you'll be searching by joining the "entries" table with some of
@@ -141,12 +250,33 @@
 #   "permissions"    INT        Its UNIX file permissions, from octal
 #   "owner"          INT        The owner's user id
 #   "group"          INT        The owner's group id
-#   "created"        TIMESTAMP  When it was created
-#   "dataModified"   TIMESTAMP  When its data was last modified
-#   "attrsModified"  TIMESTAMP  When attributes/metadata were modified
-#   "dataAccessed"   TIMESTAMP  When its data was last accessed
+#   "created"        BIGINT     When it was created
+#   "dataModified"   BIGINT     When its data was last modified
+#   "attrsModified"  BIGINT     When attributes/metadata were modified
+#   "dataAccessed"   BIGINT     When its data was last accessed
 #   "volumePath"     TEXT       Its full path within the volume
 #
+# Since the same few extensions are repeated across millions of entries,
+# "entries" is actually a view.  The rows themselves live in "entryRows",
+# which has exactly the columns above, except that "extension" is replaced by
+# "extensionId", an index into the small "extensions" lookup table:
+#
+#   "id"             INT        The id of the extension
+#   "name"           TEXT       The extension itself, without a leading dot
+#
+# The view is all you need for ad hoc queries, but filtering on "extensionId"
+# (or on "owner") in "entryRows" is a plain integer index lookup:
+#
+#   SELECT e."id", e."volumePath" FROM "entryRows" as e, "extensions" as x
+#    WHERE x."name" = 'pdf' AND e."extensionId" = x."id"
+#
+# The four times are integer nanoseconds since the epoch (UTC), on both
+# backends, or NULL where unknown.  "dataModified" is indexed, so a range of
+# modification times is an index range scan:
+#
+#   SELECT "volumePath" FROM "entryRows"
+#    WHERE "dataModified" >= 1199145600000000000     -- 2008-01-01 UTC
+#
 # There are several kinds of entries, whose "kind" matches one of the
 # following:
 #
@@ -169,8 +299,35 @@
 #   "entryId"      INT       The id of the entry it describes
 #   "linkGroupId"  INT       Id of the "link group" this entry belongs to
 #   "size"         BIGINT    The size of the file
-#   "checksum"     CHAR(32)  An MD5 checksum of the contents (if possible)
+#   "checksum"     VARCHAR(64) A checksum of the contents (if possible), in
+#                            hexadecimal
+#   "checksumType" TEXT      Its algorithm: "md5" if computed here, or as
+#                            given by an archive for its members ("crc32")
+#                            or by a manifest ("sha256", say)
 #   "encoding"     TEXT      The encoding of its contents (if applicable)
+#   "fingerprint"  CHAR(32)  A quick MD5 of the size and the first, middle
+#                            and last 64K of the contents (with --fingerprint)
+#
+# Files with more than one hard link are put in a link group, one row of the
+# "linkGroups" table for each inode, so that "linkGroupId" is shared by all
+# the links to the same data.  Such a file is hashed only once, for its first
+# link, and its checksum copied to the others.
+#
+# Archive members are never decompressed to be hashed, but most archives
+# record a CRC of each member, which is stored as its checksum instead.  A
+# CRC-32 is too short to identify contents across a whole catalog by itself,
+# so it is only ever compared along with "size", and with other CRCs.
+#
+# A fingerprint costs three reads, whatever the size of the file, and files
+# of up to three blocks are fingerprinted whole.  Files with different
+# fingerprints differ; larger files with the same fingerprint only probably
+# match, so once a volume has been indexed with --fingerprint, its files
+# whose fingerprint collides with any other file's are hashed in full, and
+# "checksum" settles it.  "catalog same" and "catalog dups" look for copies
+# this way, by fingerprint first and checksum second.  They also report
+# archive members with the same size and CRC, marked "(crc32)"; "catalog
+# same" given a file on disk computes its CRC to find them, if any archive
+# member has its size.
 #
 # The "dirAttrs" table records information about directories and archive
 # contents:
@@ -181,13 +338,61 @@
 #   "thisSize"     BIGINT    The total size of its immediate children
 #   "totalCount"   INT       The count of all "descended" entries
 #   "totalSize"    BIGINT    The total size of all "descendend" entries
+#   "complete"     INT       1 once everything beneath it has been stored
+#   "totalLinkedSize" BIGINT The size of further hard links to files
+#                            beneath it, which "totalSize" leaves out
+#
+# "thisSize" and "totalSize" count the physical bytes taken: a file reached
+# through several hard links is counted once, under the first link found,
+# although every link is counted as an entry.  The logical size, counting
+# every link in full, is "totalSize" + "totalLinkedSize".
+#
+# While a volume is being indexed, the directories whose "complete" is still
+# 0 are the frontier of the walk.  If indexing is interrupted, "catalog index
+# --resume" uses them as checkpoints: completed subtrees are kept as they
+# are, and only the frontier is walked again.
+#
+# The "generation" table holds a single counter, "generation", which is
+# incremented by every transaction that finishes indexing or clearing a
+# volume.  Anything derived from the catalog, such as the columns cached for
+# "catalog analyze", records the generation it was made from, and is rebuilt
+# once it no longer matches.
+#
+# The results of searches ("catalog name", "path", "ext" and "tag") are kept
+# in the "queryCache" table, one row per search and volume, so that asking
+# again is a lookup instead of a scan of "entryRows":
+#
+#   "query"       TEXT      The search, normalized, e.g. "name LIKE %.vmdk"
+#   "volumeId"    INT       The volume searched
+#   "generation"  INT       The volume's "generation" when it was searched
+#   "results"     TEXT      The ids of the matching entries, comma-separated
+#   "size"        INT       The number of those ids
+#   "lastUsed"    INT       A counter, incremented by every write to the
+#                           cache
+#
+# A row is only used while its "generation" matches its volume's, so indexing
+# a volume again invalidates only the results cached for that volume.  The
+# least recently used rows are evicted once the rows hold more than
+# --cache-size results in all.  A search answered wholly from the cache
+# needs no write to answer: its use is remembered, and recorded once the
+# process exits (or, in a long-running "catalog serve", once CACHE_USE_BATCH
+# uses have piled up, or a search writes to the cache anyway).  Recording
+# uses is best effort; if the catalog is locked or cannot be written, they
+# are let go, and the search still answers.
 #
 # The "linkAttrs" table is just for symbolic links, and basically it records
 # which entry the link points to:
 #
 #   "id"           INT       Id of the link attribute
 #   "entryId"      INT       Entry id for the symbolic link itself
-#   "targetId"     INT       Id of the entry it points to
+#   "targetId"     INT       Id of the entry it points to, if it is on the
+#                            same volume and exists
+#   "targetPath"   TEXT      The text of the link, as read from it
+#
+# The targets are found once a whole volume has been written, in one pass
+# which matches each link's target path against the volume's entries.  A
+# link left without a "targetId" is either dangling, or points outside the
+# volume; the pass reports how many of each it found.
 #
 # The "metadata" table is special, and allows an unlimited amount of typed
 # metadata to be stored for an entry.  Both individual items, and even lists
@@ -221,6 +426,17 @@
 # making it possible to query the entry tree based on the entry or name,
 # without regard to its structure.
 #
+# While indexing, the extended attributes of each entry are read along with
+# its other attributes (with the optional pyxattr or xattr module; see the
+# --no-xattrs option) and stored here, named after the attribute: as text if
+# they are valid UTF-8, otherwise as generic data.  Tags, kept in
+# "user.xdg.tags" as a comma-separated list, are stored as a list whose
+# members are the tags, so that finding tagged entries is a lookup on the
+# index over "name" and "textValue":
+#
+#   SELECT "entryId" FROM "metadata"
+#    WHERE "name" = 'user.xdg.tags' AND "textValue" = 'important'
+#
 # A WORD ON INDICES: Since most name-based searches are going to be partial
 # (LIKE) or regular expressions (RLIKE), and since the indices can get HUGE, I
 # haven't bothered to index the textual fields, such as filenames.  Yes, there
@@ -230,7 +446,7 @@
 # you prefer to have indices, feel free to create them after your database has
 # been initialized:
 #
-#   ALTER TABLE "entries" ADD INDEX(name(250))
+#   ALTER TABLE "entryRows" ADD INDEX(name(250))
 #
 #ifdef PGSQL
 #
@@ -250,7 +466,17 @@ import tarfile
 import os
 import re
 import sys
+import time
+import errno
+import Queue
 import optparse
+import threading
+import sre_parse
+import sre_constants
+import socket
+import SocketServer
+import inotify
+import isoimage
 
 from subprocess import Popen, PIPE
 from os.path import *
@@ -262,6 +488,12 @@ def doquery(cursor, sql, args):
     else:
         return cursor.execute(sql, args)
 
+def doquerymany(cursor, sql, rows):
+    if opts.databaseName:
+        return cursor.executemany(re.sub('\?', '%s', sql), rows)
+    else:
+        return cursor.executemany(sql, rows)
+
 def createPostgreSQLTables():
     c = conn.cursor()
 
@@ -414,6 +646,91 @@ def createSQLite3Tables():
 
     conn.commit()
 
+entryColumns = ('"volumeId", "directoryId", "name", "baseName", "kind", ' +
+                '"permissions", "owner", "group", "created", "dataModified", ' +
+                '"attrsModified", "dataAccessed", "volumePath"')
+
+def createEntriesView(c):
+    c.execute("""
+    CREATE VIEW "entries" AS
+      SELECT e."id", e."volumeId", e."directoryId", e."name", e."baseName",
+             x."name" AS "extension", e."kind", e."permissions", e."owner",
+             e."group", e."created", e."dataModified", e."attrsModified",
+             e."dataAccessed", e."volumePath"
+        FROM "entryRows" AS e
+        LEFT JOIN "extensions" AS x ON x."id" = e."extensionId" """)
+
+def internPostgreSQLExtensions():
+    c = conn.cursor()
+
+    c.execute("""
+    CREATE TABLE "extensions"
+        ("id" SERIAL PRIMARY KEY,
+         "name" TEXT UNIQUE NOT NULL)""")
+
+    c.execute("""
+    INSERT INTO "extensions" ("name")
+      SELECT DISTINCT "extension" FROM "entries"
+       WHERE "extension" IS NOT NULL""")
+
+    c.execute("ALTER TABLE \"entries\" RENAME TO \"entryRows\"")
+    c.execute("""
+    ALTER TABLE "entryRows" ADD COLUMN "extensionId" INTEGER
+      REFERENCES "extensions"("id") ON DELETE RESTRICT""")
+    c.execute("""
+    UPDATE "entryRows" SET "extensionId" = x."id"
+      FROM "extensions" AS x WHERE x."name" = "entryRows"."extension" """)
+    c.execute("ALTER TABLE \"entryRows\" DROP COLUMN \"extension\"")
+
+    createEntriesView(c)
+    conn.commit()
+
+def internSQLite3Extensions():
+    c = conn.cursor()
+
+    c.execute("""
+    CREATE TABLE "extensions"
+        ("id" INTEGER PRIMARY KEY,
+         "name" TEXT UNIQUE)""")
+
+    c.execute("""
+    INSERT INTO "extensions" ("name")
+      SELECT DISTINCT "extension" FROM "entries"
+       WHERE "extension" IS NOT NULL""")
+
+    # SQLite3 cannot drop a column, so the rows are copied into a new table.
+    c.execute("""
+    CREATE TABLE "entryRows"
+        ("id" INTEGER PRIMARY KEY,
+         "volumeId" INTEGER,
+         "directoryId" INTEGER,
+         "name" TEXT,
+         "baseName" TEXT,
+         "extensionId" INTEGER,
+         "kind" INTEGER,
+         "permissions" INTEGER,
+         "owner" INTEGER,
+         "group" INTEGER,
+         "created" INTEGER,
+         "dataModified" INTEGER,
+         "attrsModified" INTEGER,
+         "dataAccessed" INTEGER,
+         "volumePath" TEXT)""")
+
+    c.execute("""
+    INSERT INTO "entryRows" ("id", "extensionId", %s)
+      SELECT e."id", x."id", %s
+        FROM "entries" AS e
+        LEFT JOIN "extensions" AS x ON x."name" = e."extension" """ %
+              (entryColumns, re.sub('"(\w+)"', 'e."\\1"', entryColumns)))
+
+    c.execute("DROP TABLE \"entries\"")
+    c.execute("CREATE INDEX \"entries_volumeId_idx\" ON \"entryRows\"(\"volumeId\")")
+    c.execute("CREATE INDEX \"entries_directoryId_idx\" ON \"entryRows\"(\"directoryId\")")
+
+    createEntriesView(c)
+    conn.commit()
+
 def initDatabase():
     version = 0
     try:
@@ -445,81 +762,620 @@ def initDatabase():
         c.execute("CREATE INDEX \"metadata_entryId_idx\" ON \"metadata\"(\"entryId\")")
         c.execute("CREATE INDEX \"metadata_metadataId_idx\" ON \"metadata\"(\"metadataId\")")
 
-    if version < 10:
-        version = 10
+    if version < 11:
+        if opts.databaseName:
+            internPostgreSQLExtensions()
+        else:
+            internSQLite3Extensions()
+
+        c = conn.cursor()
+        c.execute("CREATE INDEX \"entries_extensionId_idx\" ON \"entryRows\"(\"extensionId\")")
+        c.execute("CREATE INDEX \"entries_owner_idx\" ON \"entryRows\"(\"owner\")")
+
+    if version < 12:
+        c = conn.cursor()
+        c.execute("ALTER TABLE \"dirAttrs\" ADD COLUMN \"complete\" INTEGER")
+        c.execute("UPDATE \"dirAttrs\" SET \"complete\" = 1")
+
+    if version < 13:
+        c = conn.cursor()
+        c.execute("CREATE TABLE \"generation\"(\"generation\" INTEGER)")
+        c.execute("INSERT INTO \"generation\" (\"generation\") VALUES (0)")
+
+    if version < 14:
+        c = conn.cursor()
+        c.execute("CREATE INDEX \"dirAttrs_totalSize_idx\" ON \"dirAttrs\"(\"totalSize\")")
+
+    if version < 15:
+        c = conn.cursor()
+        c.execute("ALTER TABLE \"dirAttrs\" ADD COLUMN \"totalLinkedSize\" BIGINT")
+        c.execute("UPDATE \"dirAttrs\" SET \"totalLinkedSize\" = 0")
+
+    if version < 16:
+        c = conn.cursor()
+        c.execute("ALTER TABLE \"linkAttrs\" ADD COLUMN \"targetPath\" TEXT")
+        if opts.databaseName:
+            c.execute("ALTER TABLE \"linkAttrs\" ALTER COLUMN \"targetId\" DROP NOT NULL")
+
+    if version < 17:
+        c = conn.cursor()
+        c.execute("CREATE INDEX \"metadata_name_textValue_idx\" ON \"metadata\"(\"name\", \"textValue\")")
+
+    if version < 18:
+        c = conn.cursor()
+        c.execute("ALTER TABLE \"volumes\" ADD COLUMN \"generation\" INTEGER")
+        c.execute("""UPDATE "volumes" SET "generation" =
+                       (SELECT "generation" FROM "generation")""")
+        c.execute("""
+        CREATE TABLE "queryCache"
+            ("query" TEXT,
+             "volumeId" INTEGER,
+             "generation" INTEGER,
+             "results" TEXT,
+             "size" INTEGER,
+             "lastUsed" INTEGER)""")
+        c.execute("CREATE INDEX \"queryCache_query_idx\" ON \"queryCache\"(\"query\")")
+
+    if version < 19:
+        c = conn.cursor()
+        c.execute("ALTER TABLE \"fileAttrs\" ADD COLUMN \"fingerprint\" CHAR(32)")
+        c.execute("CREATE INDEX \"fileAttrs_fingerprint_idx\" ON \"fileAttrs\"(\"fingerprint\")")
+
+    if version < 20:
+        c = conn.cursor()
+        columns = ("created", "dataModified", "attrsModified", "dataAccessed")
+        if opts.databaseName:
+            # Stored times were local, as the server's time zone sees them
+            c.execute("DROP VIEW \"entries\"")
+            for column in columns:
+                c.execute("""
+                ALTER TABLE "entryRows" ALTER COLUMN "%s" TYPE BIGINT
+                  USING (EXTRACT(EPOCH FROM "%s"::TIMESTAMPTZ)
+                         * 1000000)::BIGINT * 1000""" % (column, column))
+            createEntriesView(c)
+        else:
+            # Stored times were local, as "YYYY-MM-DD HH:MM:SS[.ffffff]"
+            for column in columns:
+                c.execute("""
+                UPDATE "entryRows" SET "%s" =
+                    CAST(strftime('%%s', substr("%s", 1, 19), 'utc')
+                         AS INTEGER) * 1000000000 +
+                    CASE WHEN length("%s") > 20
+                         THEN CAST(substr(substr("%s", 21) || '000000', 1, 6)
+                                   AS INTEGER) * 1000
+                         ELSE 0 END
+                 WHERE typeof("%s") = 'text'""" % ((column,) * 5))
+        c.execute("CREATE INDEX \"entries_dataModified_idx\" ON \"entryRows\"(\"dataModified\")")
+
+    if version < 21:
+        c = conn.cursor()
+        if opts.databaseName:
+            c.execute("ALTER TABLE \"fileAttrs\" ALTER COLUMN \"checksum\" TYPE VARCHAR(64)")
+        c.execute("ALTER TABLE \"fileAttrs\" ADD COLUMN \"checksumType\" TEXT")
+        c.execute("""UPDATE "fileAttrs" SET "checksumType" = 'md5'
+                      WHERE "checksum" IS NOT NULL""")
+        c.execute("CREATE INDEX \"fileAttrs_checksum_idx\" ON \"fileAttrs\"(\"checksum\")")
+
+    if version < 22:
+        # For "catalog same" to see whether any archive member has the size
+        # of a file before reading all of it for its CRC
+        c = conn.cursor()
+        c.execute("CREATE INDEX \"fileAttrs_size_idx\" ON \"fileAttrs\"(\"size\")")
+
+    if version < 22:
+        version = 22
         c = conn.cursor()
         c.execute("UPDATE \"version\" SET \"version\" = %d" % version)
         conn.commit()
 
+extensionIds = {}
+
+def internExtension(extension):
+    if extension is None:
+        return None
+
+    id = extensionIds.get(extension)
+    if id is not None:
+        return id
+
+    c = conn.cursor()
+    doquery(c, """SELECT "id" FROM "extensions" WHERE "name" = ?""", (extension,))
+    data = c.fetchone()
+    if data:
+        id = data[0]
+    else:
+        doquery(c, """INSERT INTO "extensions" ("name") VALUES (?)""", (extension,))
+        id = insertedId(c, "extensions")
+
+    extensionIds[extension] = id
+    return id
+
+def insertedId(c, table):
+    if not opts.databaseName:
+        id = c.lastrowid
+        commit()
+    else:
+        commit()
+        c = conn.cursor()
+        c.execute("SELECT currval(pg_get_serial_sequence('\"%s\"', 'id'))" % table)
+        id = c.fetchone()[0]
+    return id
+
+def commit():
+    start = time.time()
+    conn.commit()
+    stats.addCommit(time.time() - start)
+
 ########################################################################
 
-class FileAttrs:
-    entry     = None
-    linkGroup = None
-    size      = None
-    checksum  = None
-    encoding  = None
-    def __init__(self): pass    # this makes pylint happy again
-
-class DirAttrs:
-    entry      = None
-    thisCount  = 0
-    thisSize   = 0
-    totalCount = 0
-    totalSize  = 0
-    def __init__(self): pass
+# Upper bounds, in seconds, of the commit latency histogram buckets
+COMMIT_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+class IndexStats(object):
+    """Timers and counters for one run of "catalog index".
+
+    Phases are timed by passing the time a phase started to add(), which
+    keeps the cost of measuring to a single time.time() call.  Archive
+    listing is timed per handler class, under "archive:<class name>".
+
+    When several volumes are indexed at once, each also has an IndexStats
+    of its own (see forVolume).  A thread working for a volume attaches to
+    its stats, and what it does is then counted there as well as here."""
+
+    def __init__(self, expected = None):
+        self.lock         = threading.Lock()
+        self.started      = time.time()
+        self.finished     = None
+        self.lastProgress = self.started
+        self.expected     = expected    # entries we expect to see, if known
+        self.entries      = 0
+        self.bytesHashed  = 0
+        self.phases       = {}          # name -> [seconds, count]
+        self.commits      = [0] * (len(COMMIT_BUCKETS) + 1)
+        self.commitTime   = 0.0
+        self.volumes      = {}          # volume name -> IndexStats
+        self.details      = {}          # further items for report()
+        self.local        = threading.local()
+
+    def forVolume(self, name, expected = None):
+        """Start the stats of the volume NAME."""
+        volumeStats = IndexStats(expected)
+        self.volumes[name] = volumeStats
+        return volumeStats
+
+    def attach(self, volumeStats):
+        """Count what the calling thread does from now on in VOLUMESTATS
+        too (None to stop)."""
+        self.local.volume = volumeStats
+
+    def targets(self):
+        volumeStats = getattr(self.local, "volume", None)
+        if volumeStats:
+            return (self, volumeStats)
+        return (self,)
+
+    def finish(self):
+        self.finished = time.time()
+
+    def add(self, phase, start, count = 1):
+        elapsed = time.time() - start
+        for target in self.targets():
+            target.lock.acquire()
+            try:
+                times = target.phases.get(phase)
+                if times:
+                    times[0] += elapsed
+                    times[1] += count
+                else:
+                    target.phases[phase] = [elapsed, count]
+            finally:
+                target.lock.release()
+        return elapsed
+
+    def addHashed(self, start, size):
+        self.add("hash", start)
+        for target in self.targets():
+            target.lock.acquire()
+            target.bytesHashed += size
+            target.lock.release()
+
+    def addCommit(self, elapsed):
+        for i in range(len(COMMIT_BUCKETS)):
+            if elapsed <= COMMIT_BUCKETS[i]:
+                break
+        else:
+            i = len(COMMIT_BUCKETS)
+        self.lock.acquire()
+        self.commitTime += elapsed
+        self.commits[i] += 1
+        self.lock.release()
+
+    def addEntry(self):
+        for target in self.targets():
+            target.lock.acquire()
+            target.entries += 1
+            target.lock.release()
+        if opts.progressInterval > 0 and self.entries % 1000 == 0:
+            now = time.time()
+            if now - self.lastProgress >= opts.progressInterval:
+                self.lastProgress = now
+                print self.progress(now)
+                sys.stdout.flush()
+
+    def progress(self, now):
+        elapsed = max(now - self.started, 0.001)
+        rate    = self.entries / elapsed
+        message = "Indexed %d entries (%d/s), %.1f MB hashed (%.1f MB/s)" % \
+            (self.entries, rate, self.bytesHashed / 1048576.0,
+             self.bytesHashed / 1048576.0 / elapsed)
+        if self.expected and rate > 0:
+            remaining = max(self.expected - self.entries, 0) / rate
+            message += ", ETA %d:%02d:%02d" % (remaining / 3600,
+                                               remaining / 60 % 60,
+                                               remaining % 60)
+        if self.volumes:
+            message += " (%s)" % ", ".join(
+                ["%s: %d" % (name, self.volumes[name].entries)
+                 for name in sorted(self.volumes.keys())])
+        return message
+
+    def report(self):
+        elapsed = max((self.finished or time.time()) - self.started, 0.001)
+
+        phases   = {}
+        archives = {}
+        for (name, (seconds, count)) in self.phases.items():
+            record = { "seconds": round(seconds, 6), "count": count }
+            if name.startswith("archive:"):
+                archives[name[8:]] = record
+            else:
+                phases[name] = record
+
+        # One [upper bound in ms, count] pair per bucket; the last bucket,
+        # with a bound of None, holds everything slower.
+        histogram = []
+        for i in range(len(self.commits)):
+            if i < len(COMMIT_BUCKETS):
+                histogram.append([COMMIT_BUCKETS[i] * 1000, self.commits[i]])
+            else:
+                histogram.append([None, self.commits[i]])
+
+        report = { "elapsed":              round(elapsed, 6),
+                   "entries":              self.entries,
+                   "entriesPerSecond":     round(self.entries / elapsed, 2),
+                   "bytesHashed":          self.bytesHashed,
+                   "bytesHashedPerSecond": round(self.bytesHashed / elapsed, 2),
+                   "phases":               phases,
+                   "archives":             archives,
+                   "commits":              { "count":     sum(self.commits),
+                                             "seconds":   round(self.commitTime, 6),
+                                             "histogram": histogram } }
+        if self.volumes:
+            report["volumes"] = dict([(name, volumeStats.report()) for
+                                      (name, volumeStats) in
+                                      self.volumes.items()])
+        report.update(self.details)
+        return report
+
+    def writeJson(self, fileName, **extra):
+        import json
+        report = self.report()
+        report.update(extra)
+        fd = open(fileName, "w")
+        json.dump(report, fd, indent = 2, sort_keys = True)
+        fd.write("\n")
+        fd.close()
+
+stats = IndexStats()
+
+########################################################################
+
+# The record types below are created once per catalogued entry, so they use
+# __slots__ rather than a per-instance dictionary.  Attribute records no longer
+# point back at their entry, which keeps them out of reference cycles.
+
+class FileAttrs(object):
+    __slots__ = ('linkGroup', 'size', 'checksum', 'encoding')
+
+    def __init__(self):
+        self.linkGroup = None
+        self.size      = None
+        self.checksum  = None
+        self.encoding  = None
+
+class DirAttrs(object):
+    __slots__ = ('thisCount', 'thisSize', 'totalCount', 'totalSize',
+                 'totalLinkedSize')
+
+    def __init__(self):
+        self.thisCount       = 0
+        self.thisSize        = 0
+        self.totalCount      = 0
+        self.totalSize       = 0
+        self.totalLinkedSize = 0
 
 class ArchiveAttrs(FileAttrs):
-    dirAttrs = None
+    __slots__ = ('dirAttrs',)
+
     def __init__(self):
         FileAttrs.__init__(self)
         self.dirAttrs = DirAttrs()
 
-class LinkAttrs:
-    entry  = None
-    target = None
-    def __init__(self): pass
+class LinkAttrs(object):
+    __slots__ = ('target',)
+
+    def __init__(self):
+        self.target = None
 
 (DIRECTORY, PLAIN_FILE, SYMBOLIC_LINK,
  PACKAGE, PACKAGE_DIRECTORY, PACKAGE_FILE,
  ARCHIVE, ARCHIVE_DIRECTORY, ARCHIVE_FILE,
  SPECIAL_FILE) = (1, 2, 3, 4, 5, 6, 7, 8, 9, 10)
 
+(TEXT_METADATA, INTEGER_METADATA, DATE_METADATA, GENERIC_METADATA,
+ LIST_METADATA) = (1, 2, 3, 4, 5)
+
+# Extended attributes holding a comma-separated list of tags
+TAG_ATTRIBUTES = ("user.xdg.tags",)
+
+xattr = None
+try:
+    import xattr
+except ImportError:
+    pass
+
+def xattrWanted(name):
+    """On Linux only the "user." namespace is catalogued; the others
+    ("security.", "trusted.", "system.") hold labels, capabilities and ACLs
+    that every file may carry, rather than anything a user set."""
+    return not sys.platform.startswith("linux") or name.startswith("user.")
+
+def readXattrs(path):
+    """Return the (name, value) pairs of the extended attributes of PATH,
+    which is not followed if it is a symbolic link."""
+    if not xattr or not opts.readXattrs:
+        return []
+
+    try:
+        if hasattr(xattr, "list"):          # pyxattr
+            return [(name, xattr.get(path, name, nofollow = True))
+                    for name in xattr.list(path, nofollow = True)
+                    if xattrWanted(name)]
+        else:                               # xattr
+            return [(name, xattr.getxattr(path, name, symlink = True))
+                    for name in xattr.listxattr(path, symlink = True)
+                    if xattrWanted(name)]
+    except (IOError, OSError):
+        return []
+
+def blobValue(data):
+    if opts.databaseName:
+        from pyPgSQL import PgSQL
+        return PgSQL.PgBytea(data)
+    else:
+        return buffer(data)
+
+def storeXattrs(entry, xattrs):
+    """Queue metadata rows for the extended attributes XATTRS of ENTRY."""
+    writer = entry.volume.writer
+
+    for (name, value) in xattrs:
+        try:
+            text = value.rstrip("\0").decode("utf-8")
+        except UnicodeError:
+            text = None
+
+        id = writer.metadataIds.allocate()
+        if name in TAG_ATTRIBUTES and text is not None:
+            writer.put("metadata",
+                       (id, entry.id, None, name, LIST_METADATA, None, None),
+                       entry)
+            for tag in text.split(","):
+                tag = tag.strip()
+                if tag:
+                    writer.put("metadata",
+                               (writer.metadataIds.allocate(), entry.id, id,
+                                name, TEXT_METADATA, tag, None), entry)
+        elif text is not None:
+            writer.put("metadata",
+                       (id, entry.id, None, name, TEXT_METADATA, text, None),
+                       entry)
+        else:
+            writer.put("metadata",
+                       (id, entry.id, None, name, GENERIC_METADATA, None,
+                        blobValue(value)), entry)
+
+kindNames = { DIRECTORY:         "directory",
+              PLAIN_FILE:        "file",
+              SYMBOLIC_LINK:     "link",
+              PACKAGE:           "package",
+              PACKAGE_DIRECTORY: "package directory",
+              PACKAGE_FILE:      "package file",
+              ARCHIVE:           "archive",
+              ARCHIVE_DIRECTORY: "archive directory",
+              ARCHIVE_FILE:      "archive file",
+              SPECIAL_FILE:      "special" }
+
 def isArchiveName(fileName):
-    return re.search("(\\.(zip|jar|7z|tgz|tbz|rar|dmg)|\\.tar(\\.gz|\\.bz2)?)$",
+    return re.search("(\\.(zip|jar|7z|tgz|tbz|rar|dmg|iso)|\\.tar(\\.gz|\\.bz2)?)$",
                      fileName)
 
+def bumpGeneration(c):
+    """Record that the catalog has changed, as part of the transaction that
+    changes it, so that whatever was derived from it is rebuilt."""
+    c.execute("UPDATE \"generation\" SET \"generation\" = \"generation\" + 1")
+
+def currentGeneration():
+    c = conn.cursor()
+    c.execute("SELECT \"generation\" FROM \"generation\"")
+    return c.fetchone()[0]
+
+# Timestamps are stored as integer nanoseconds since the epoch, the same on
+# both backends, and only turned into dates to be shown.
+
+def fromTicks(ticks):
+    """Turn seconds since the epoch into a stored timestamp.  Time stamps
+    from lstat() are only precise to the microsecond as floats."""
+    return long(round(ticks * 1000000)) * 1000
+
+def fromLocalTime(year, month, day, hour = 0, minute = 0, second = 0):
+    """Turn a local date and time, as archive listings give it, into a
+    stored timestamp."""
+    return fromTicks(time.mktime((year, month, day, hour, minute, second,
+                                  0, 0, -1)))
+
+def toTicks(value):
+    """Turn a stored timestamp into whole seconds since the epoch."""
+    if value is None:
+        return None
+    return value // 1000000000
+
+def formatTime(value):
+    """Turn a stored timestamp into a local date and time, for display."""
+    if value is None:
+        return "-" * 19
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(toTicks(value)))
+
+TIME_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+def parseTime(text):
+    """Turn TEXT, a local date and time ("YYYY-MM-DD", optionally followed
+    by "HH:MM" or "HH:MM:SS") or an age ("90m", "12h", "7d", "2w"), into a
+    stored timestamp.  Raises ValueError if it is neither."""
+    text = text.strip()
+    if text[:-1].isdigit() and text[-1:] in TIME_UNITS:
+        return fromTicks(time.time() - int(text[:-1]) * TIME_UNITS[text[-1]])
+
+    for format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return fromTicks(time.mktime(time.strptime(text, format)))
+        except ValueError:
+            pass
+    raise ValueError("cannot parse time '%s'" % text)
+
 lastMessage = ""
 
-class Entry:
-    id            = -1
-    parent        = None
-    parentId      = -1
-    volume        = None
-    path          = None                # current absolute pathname
-    volumePath    = None                # path strictly within the volume
-    name          = None
-    baseName      = None
-    extension     = None
-    kind          = PLAIN_FILE
-    permissions   = None
-    owner         = None
-    group         = None
-    created       = None
-    dataModified  = None
-    attrsModified = None
-    dataAccessed  = None
-    infoRead      = False
-    attrs         = None
+# MEMORY BUDGET: an Entry, together with its attribute record, must stay
+# within ENTRY_MEMORY_BUDGET bytes of object overhead (not counting the
+# strings it holds) on a 64-bit Python.  Large searches and deep archive
+# listings create hundreds of thousands of them; "benchmark.py memory" checks
+# this figure.
+
+ENTRY_MEMORY_BUDGET = 384
+
+# The size of each of the three blocks read for a fingerprint.  A file's
+# fingerprint is passed to Entry.store instead of being kept in FileAttrs,
+# which has no room left under ENTRY_MEMORY_BUDGET.
+
+FINGERPRINT_BLOCK = 65536
+
+def fileChecksum(path):
+    """Return the MD5 checksum of the contents of the file at PATH."""
+    import hashlib
+    start = time.time()
+    fd = open(path, "rb")
+    csum = hashlib.md5()
+    size = 0
+    while True:
+        data = fd.read(1048576)
+        if not data:
+            break
+        csum.update(data)
+        size += len(data)
+    fd.close()
+    stats.addHashed(start, size)
+    return csum.hexdigest()
+
+def fileCrc32(path):
+    """Return the CRC-32 of the contents of the file at PATH, as archives
+    record it for their members."""
+    import zlib
+    start = time.time()
+    fd = open(path, "rb")
+    crc = 0
+    size = 0
+    while True:
+        data = fd.read(1048576)
+        if not data:
+            break
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+    fd.close()
+    stats.addHashed(start, size)
+    return "%08x" % (crc & 0xffffffff)
+
+def fileFingerprint(path, size):
+    """Return the fingerprint of the file at PATH, which is SIZE bytes long:
+    the MD5 checksum of its size, and of its first, middle and last
+    FINGERPRINT_BLOCK bytes, or of all of it if that is no more."""
+    import hashlib
+    start = time.time()
+    fd = open(path, "rb")
+    csum = hashlib.md5(str(size))
+    if fingerprintIsWhole(size):
+        csum.update(fd.read())
+    else:
+        for offset in (0, (size - FINGERPRINT_BLOCK) // 2,
+                       size - FINGERPRINT_BLOCK):
+            fd.seek(offset)
+            csum.update(fd.read(FINGERPRINT_BLOCK))
+    fd.close()
+    stats.add("fingerprint", start)
+    return csum.hexdigest()
+
+def archiveChecksum(algorithm, value):
+    """Tag VALUE, a checksum an archive or manifest gives for a file, with
+    its ALGORITHM, as FileAttrs keeps it; checksums computed here are MD5
+    sums, and are kept untagged."""
+    return "%s:%s" % (algorithm, value.lower())
+
+def splitChecksum(checksum):
+    """Return the value and the algorithm of CHECKSUM, as kept in
+    FileAttrs, for the "checksum" and "checksumType" columns."""
+    if checksum is None:
+        return (None, None)
+    if ":" in checksum:
+        (algorithm, value) = checksum.split(":", 1)
+        return (value, algorithm)
+    return (checksum, "md5")
+
+def fingerprintIsWhole(size):
+    """True if the fingerprint of a file of SIZE bytes covers all of it."""
+    return size <= 3 * FINGERPRINT_BLOCK
+
+class Entry(object):
+    __slots__ = ('id', 'parent', 'parentId', 'volume', 'volumeId',
+                 'path',                # current absolute pathname
+                 'volumePath',          # path strictly within the volume
+                 'name', 'baseName', 'extension', 'kind', 'permissions',
+                 'owner', 'group', 'created', 'dataModified', 'attrsModified',
+                 'dataAccessed', 'infoRead', 'attrs')
 
     def __init__(self, volume = None, parent = None, path = None,
                  volumePath = None, name = None):
-        self.volume     = volume
-        self.volumePath = volumePath
-        self.path       = path
-        self.parent     = parent
-        self.name       = name
-
+        self.id            = -1
+        self.volume        = volume
+        self.volumeId      = None
+        self.volumePath    = volumePath
+        self.path          = path
+        self.name          = name
+        self.baseName      = None
+        self.extension     = None
+        self.kind          = PLAIN_FILE
+        self.permissions   = None
+        self.owner         = None
+        self.group         = None
+        self.created       = None
+        self.dataModified  = None
+        self.attrsModified = None
+        self.dataAccessed  = None
+        self.infoRead      = False
+        self.attrs         = None
+
+        # Only the parent's id is kept; holding the parent object itself
+        # would keep the whole chain of ancestors alive.  getParent() loads
+        # it on demand.
+        self.parent = None
         if parent:
             self.parentId = parent.id
         else:
@@ -572,21 +1428,25 @@ class Entry:
         elif not self.isSpecialFile():
             c = conn.cursor()
             doquery(c, """
-              SELECT "linkGroupId", "size", "checksum", "encoding"
+              SELECT "linkGroupId", "size", "checksum", "encoding",
+                     "checksumType"
                 FROM "fileAttrs" WHERE "entryId" = ?""", (self.id,))
             result = c.fetchone()
             if result:
                 self.attrs = FileAttrs()
-                self.attrs.entry     = self
-                self.attrs.linkGroup = None
+                self.attrs.linkGroup = result[0]
                 self.attrs.size      = result[1]
                 self.attrs.checksum  = result[2]
                 self.attrs.encoding  = result[3]
+                if result[2] and result[4] not in (None, "md5"):
+                    self.attrs.checksum = archiveChecksum(result[4], result[2])
         else:
             return
 
     def readInfo(self):
+        start = time.time()
         info = os.lstat(self.path)
+        stats.add("stat", start)
 
         if S_ISDIR(info[ST_MODE]):
             self.kind = DIRECTORY
@@ -597,6 +1457,7 @@ class Entry:
         elif S_ISLNK(info[ST_MODE]):
             self.kind = SYMBOLIC_LINK
             self.attrs = LinkAttrs()
+            self.attrs.target = os.readlink(self.path)
         elif S_ISREG(info[ST_MODE]):
             if isArchiveName(self.name):
                 self.kind = ARCHIVE
@@ -606,7 +1467,6 @@ class Entry:
                 self.attrs = FileAttrs()
 
             self.attrs.size     = long(info[ST_SIZE])
-            self.attrs.checksum = self.readChecksum(self.path)
         else:
             self.kind = SPECIAL_FILE
 
@@ -614,25 +1474,22 @@ class Entry:
         self.owner         = info[ST_UID]
         self.group         = info[ST_GID]
 
-        if opts.databaseName:
-            self.dataAccessed  = mx.DateTime.DateTimeFromTicks(info[ST_ATIME])
-            self.dataModified  = mx.DateTime.DateTimeFromTicks(info[ST_MTIME])
-            self.attrsModified = mx.DateTime.DateTimeFromTicks(info[ST_CTIME])
-        else:
-            self.dataAccessed  = datetime.datetime.fromtimestamp(info[ST_ATIME])
-            self.dataModified  = datetime.datetime.fromtimestamp(info[ST_MTIME])
-            self.attrsModified = datetime.datetime.fromtimestamp(info[ST_CTIME])
+        self.dataAccessed  = fromTicks(info.st_atime)
+        self.dataModified  = fromTicks(info.st_mtime)
+        self.attrsModified = fromTicks(info.st_ctime)
 
         self.infoRead = True
+        return info
 
     def readChecksum(self, path):
         if opts.readChecksums:
-            import md5
-            fd = open(path)
-            csum = md5.new()
-            csum.update(fd.read())
-            fd.close()
-            return csum.hexdigest()
+            return fileChecksum(path)
+        else:
+            return None
+
+    def readFingerprint(self, path, size):
+        if opts.readFingerprints:
+            return fileFingerprint(path, size)
         else:
             return None
 
@@ -662,6 +1519,11 @@ class Entry:
         else:
             return 1
 
+    def getFileSize(self):
+        if self.isPlainFile() or self.isArchive():
+            return self.attrs.size
+        return 0
+
     def getSize(self):
         assert self.infoRead
         # Some archive members do not have attributes
@@ -677,64 +1539,19 @@ class Entry:
             return 0
 
     def scanEntries(self):
-        if not self.isDirectory() and not self.isPackage() and \
-           not self.isArchive():
-            return
+        """Catalog everything beneath this directory, in this thread."""
+        if self.isDirectory() or self.isPackage():
+            Walker(self.volume, self).run()
 
+    def storeDirAttrs(self):
         attrs = self.attrs
         if self.isArchive():
             attrs = attrs.dirAttrs
 
-        attrs.thisCount  = 0
-        attrs.thisSize   = 0
-        attrs.totalCount = 0
-        attrs.totalSize  = 0
-
-        entryPath = ""
-
-        try:
-            global lastMessage
-
-            for entryName in os.listdir(self.path):
-                entryPath = join(self.path, entryName)
-
-                if re.match("/(dev|Network|automount)/", entryPath) or \
-                   re.search("/\\.Trashes$", entryPath):
-                    continue
-
-                entry = createEntry(self.volume, self, entryPath,
-                                    join(self.volumePath, entryName),
-                                    entryName)
-                entry.readInfo()
-                entry.store()
-
-                if entry.isPlainFile():
-                    attrs.thisCount += 1
-                    attrs.thisSize  += entry.getSize()
-
-                elif not entry.isSymbolicLink():
-                    if entry.isArchive() and entry.getSize() > (5 * 1024 * 1024):
-                        print "Scanning", entry.volumePath
-                        lastMessage = ""
-                    else:
-                        parts = entry.volumePath.split("/")
-                        if parts > 3:
-                            parts = parts[0:3]
-                        theMessage = apply(join, parts)
-                        if theMessage != lastMessage:
-                            print "Scanning", theMessage
-                            lastMessage = theMessage
-
-                    entry.scanEntries()
-
-                    attrs.totalCount += entry.getCount()
-                    attrs.totalSize  += entry.getSize()
-
-        except Exception, msg:
-            print "Failed to index %s:" % (entryPath or self.path), msg
-
-        attrs.totalCount += attrs.thisCount
-        attrs.totalSize  += attrs.thisSize
+        self.volume.writer.put("dirTotals",
+                               (attrs.thisCount, attrs.thisSize,
+                                attrs.totalCount, attrs.totalSize,
+                                attrs.totalLinkedSize, self.id), self)
 
     def load(self, id):
         self.id = id
@@ -770,90 +1587,95 @@ class Entry:
             self.dataAccessed  = dataAccessed
             self.volumePath    = volumePath
 
-    def store(self):
-        if self.id == -1:
-            c = conn.cursor()
-            doquery(c, """
-              INSERT INTO "entries"
-                ("volumeId", "directoryId", "name", "baseName", "extension",
-                 "kind", "permissions", "owner", "group", "created",
-                 "dataModified", "attrsModified", "dataAccessed",
-                 "volumePath")
-              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
-                      ?, ?, ?, ?)""",
-                (self.volume.id, self.parentId, self.name, self.baseName,
-                 self.extension, self.kind, self.permissions, self.owner,
-                 self.group, self.created, self.dataModified, self.attrsModified,
-                 self.dataAccessed, self.volumePath))
-
-	    if not opts.databaseName:
-                self.id = c.lastrowid
-            	conn.commit()
-	    else:
-            	conn.commit()
-                c = conn.cursor()
-                c.execute("SELECT currval(pg_get_serial_sequence('entries', 'id'))")
-                self.id = c.fetchone()[0]
-        else:
-            c = conn.cursor()
-            doquery(c, """
-              UPDATE "entries" SET
-                "volumeId"      = ?,
-                "directoryId"   = ?,
-                "name"          = ?,
-                "baseName"      = ?,
-                "extension"     = ?,
-                "kind"          = ?,
-                "permissions"   = ?,
-                "owner"         = ?,
-                "group"         = ?,
-                "created"       = ?,
-                "dataModified"  = ?,
-                "attrsModified" = ?,
-                "dataAccessed"  = ?,
-                "volumePath"    = ?)
-              WHERE "id" = ?""",
-                (self.volume.id, self.parentId, self.name, self.baseName,
-                 self.extension, self.kind, self.permissions, self.owner,
-                 self.group, self.created, self.dataModified, self.attrsModified,
-                 self.dataAccessed, self.volumePath, self.id))
-
-            doquery(c, "DELETE FROM \"fileAttrs\" WHERE \"entryId\" = ?", (self.id,))
-            doquery(c, "DELETE FROM \"linkAttrs\" WHERE \"entryId\" = ?", (self.id,))
-            doquery(c, "DELETE FROM \"dirAttrs\" WHERE \"entryId\" = ?", (self.id,))
-            conn.commit()
+    def store(self, fingerprint = None):
+        if self.id != -1:
+            self.update(fingerprint)
+            return
+
+        # New entries are handed to the volume's EntryWriter, which writes
+        # them in batches; only their id is needed right away.
+        writer  = self.volume.writer
+        self.id = writer.entryIds.allocate()
+
+        writer.put("entry",
+                   (self.id, self.volume.id, self.parentId, self.name,
+                    self.baseName, self.extension, self.kind,
+                    self.permissions, self.owner, self.group, self.created,
+                    self.dataModified, self.attrsModified, self.dataAccessed,
+                    self.volumePath), self)
 
         if self.isPlainFile() or self.isArchive():
-            c = conn.cursor()
-            doquery(c, """
-              INSERT INTO "fileAttrs"
-                ("entryId", "linkGroupId", "size", "checksum", "encoding")
-              VALUES (?, ?, ?, ?, ?)""",
-                (self.id, None, self.attrs.size, self.attrs.checksum,
-                 self.attrs.encoding))
-            conn.commit()
+            (checksum, checksumType) = splitChecksum(self.attrs.checksum)
+            writer.put("fileAttrs",
+                       (self.id, self.attrs.linkGroup, self.attrs.size,
+                        checksum, checksumType, self.attrs.encoding,
+                        fingerprint), self)
         elif self.isSymbolicLink():
-            # jww (2007-02-24): What if the target hasn't been stored yet?
-            if False:
-                c = conn.cursor()
-                doquery(c, """
-                  INSERT INTO "linkAttrs" ("entryId", "targetId")
-                  VALUES (?, ?)""", (self.id, self.attrs.target.id))
-                conn.commit()
+            # The target may not have been stored yet, so only the link text
+            # is kept for now; Volume.resolveLinks finds the targets later.
+            writer.put("linkAttrs", (self.id, None, self.attrs.target), self)
 
         if self.isDirectory() or self.isPackage() or self.isArchive():
             attrs = self.attrs
             if self.isArchive():
                 attrs = attrs.dirAttrs
 
-            c = conn.cursor()
-            doquery(c, """
-              INSERT INTO "dirAttrs"
-                ("entryId", "thisCount", "thisSize", "totalCount", "totalSize")
-              VALUES (?, ?, ?, ?, ?)""",
-                (self.id, attrs.thisCount, attrs.thisSize, attrs.totalCount,
-                 attrs.totalSize))
-            conn.commit()
+            writer.put("dirAttrs",
+                       (self.id, attrs.thisCount, attrs.thisSize,
+                        attrs.totalCount, attrs.totalSize,
+                        attrs.totalLinkedSize), self)
+
+        stats.addEntry()
+
+    def update(self, fingerprint = None):
+        c = conn.cursor()
+        doquery(c, """
+          UPDATE "entryRows" SET
+            "volumeId"      = ?,
+            "directoryId"   = ?,
+            "name"          = ?,
+            "baseName"      = ?,
+            "extensionId"   = ?,
+            "kind"          = ?,
+            "permissions"   = ?,
+            "owner"         = ?,
+            "group"         = ?,
+            "created"       = ?,
+            "dataModified"  = ?,
+            "attrsModified" = ?,
+            "dataAccessed"  = ?,
+            "volumePath"    = ?
+          WHERE "id" = ?""",
+            (self.volume.id, self.parentId, self.name, self.baseName,
+             internExtension(self.extension), self.kind, self.permissions,
+             self.owner, self.group, self.created, self.dataModified,
+             self.attrsModified, self.dataAccessed, self.volumePath,
+             self.id))
+
+        doquery(c, "DELETE FROM \"fileAttrs\" WHERE \"entryId\" = ?", (self.id,))
+        doquery(c, "DELETE FROM \"linkAttrs\" WHERE \"entryId\" = ?", (self.id,))
+        doquery(c, "DELETE FROM \"dirAttrs\" WHERE \"entryId\" = ?", (self.id,))
+
+        if self.isPlainFile() or self.isArchive():
+            (checksum, checksumType) = splitChecksum(self.attrs.checksum)
+            doquery(c, writerStatements["fileAttrs"],
+                    (self.id, self.attrs.linkGroup, self.attrs.size,
+                     checksum, checksumType, self.attrs.encoding,
+                     fingerprint))
+        elif self.isSymbolicLink():
+            doquery(c, writerStatements["linkAttrs"],
+                    (self.id, None, self.attrs.target))
+
+        if self.isDirectory() or self.isPackage() or self.isArchive():
+            attrs = self.attrs
+            if self.isArchive():
+                attrs = attrs.dirAttrs
+
+            doquery(c, writerStatements["dirAttrs"],
+                    (self.id, attrs.thisCount, attrs.thisSize,
+                     attrs.totalCount, attrs.totalSize,
+                     attrs.totalLinkedSize))
+        commit()
 
     def drop(self):
         # jww (2007-08-05): What about the link group?
@@ -861,14 +1683,15 @@ class Entry:
         doquery(c, "DELETE FROM \"fileAttrs\" WHERE \"entryId\" = ?", (self.id,))
         doquery(c, "DELETE FROM \"linkAttrs\" WHERE \"entryId\" = ?", (self.id,))
         doquery(c, "DELETE FROM \"dirAttrs\" WHERE \"entryId\" = ?", (self.id,))
-        doquery(c, "DELETE FROM \"entries\" WHERE \"id\" = ?", (self.id,))
-        conn.commit()
+        doquery(c, "DELETE FROM \"metadata\" WHERE \"entryId\" = ?", (self.id,))
+        doquery(c, "DELETE FROM \"entryRows\" WHERE \"id\" = ?", (self.id,))
+        commit()
         self.id = -1
 
 def createEntry(volume, parent, path, volumePath, name):
     args = (volume, parent, path, volumePath, name)
 
-    ext  = splitext(name[1:])[1]
+    ext  = splitext(name)[1]
     if ext == ".zip" or ext == ".jar":
         return apply(ZipFileEntry, args)
     elif ext == ".7z":
@@ -877,6 +1700,8 @@ def createEntry(volume, parent, path, volumePath, name):
         return apply(RarFileEntry, args)
     elif ext == ".dmg":
         return apply(DiskImageEntry, args)
+    elif ext == ".iso":
+        return apply(IsoImageEntry, args)
     elif re.search("(\\.tar(\\.gz|\\.bz2)?|\\.tgz|\\.tbz)$", name):
         return apply(TarFileEntry, args)
     else:
@@ -885,7 +1710,7 @@ def createEntry(volume, parent, path, volumePath, name):
 
 def findEntryByVolumePath(volume, volPath):
     c = conn.cursor()
-    doquery(c, """SELECT "id" FROM "entries"
+    doquery(c, """SELECT "id" FROM "entryRows"
                  WHERE "volumeId" = ? AND "volumePath" = ?""",
                  (volume.id, volPath))
     data = c.fetchone()
@@ -902,50 +1727,384 @@ def findEntryByVolumePath(volume, volPath):
 
     return None
 
-def processEntriesResult(c, reporter):
+def processEntriesResult(rows, reporter):
     entries = []
+    volumes = {}
 
-    data = c.fetchone()
-    while data:
-        (volId, volName, volLocation, volKind, id) = data
-
-        vol = Volume(None, volName, volLocation, volKind)
-        vol.id = volId
+    for (volId, volName, volLocation, volKind, id) in rows:
+        vol = volumes.get(volId)
+        if not vol:
+            vol = Volume(None, volName, volLocation, volKind)
+            vol.id = volId
+            volumes[volId] = vol
 
         entry = Entry()
         entry.id = id
         entry.volume = vol
         entries.append(entry)
 
-        data = c.fetchone()
-
     for entry in entries:
         entry.load(entry.id)
         reporter(entry)
 
     return entries
 
-def findEntriesByName(name, reporter):
-    name = re.sub('\*', '%', name)
-    containsPercent = re.search('%', name)
+def findEntries(query, condition, params, reporter, tables = ""):
+    """Report the entries of "entryRows" as e (joined with TABLES) matching
+    the SQL CONDITION.  QUERY names the search in the "queryCache" table:
+    each volume's matches are looked up there first, and searched for only
+    if the volume has been indexed again since they were cached."""
     c = conn.cursor()
-    doquery(c, """
-      SELECT v."id", v."name", v."location", v."kind", e."id"
-      FROM "volumes" as v, "entries" as e
-      WHERE e."name" %s ? AND e."volumeId" = v."id" """ %
-              (containsPercent and "LIKE" or "="), (name,))
-    return processEntriesResult(c, reporter)
+    c.execute("""
+      SELECT "id", "name", "location", "kind", "generation"
+      FROM "volumes" ORDER BY "id" """)
+    volumes = c.fetchall()
 
-def findEntriesByPath(path, reporter):
-    path = re.sub('\*', '%', path)
-    c = conn.cursor()
-    doquery(c, """
-      SELECT v."id", v."name", v."location", v."kind", e."id"
-      FROM "volumes" as v, "entries" as e
-      WHERE e."volumePath" LIKE ? AND e."volumeId" = v."id" """, (path,))
-    return processEntriesResult(c, reporter)
+    cached = {}
+    if opts.cacheSize > 0:
+        doquery(c, """
+          SELECT "volumeId", "generation", "results" FROM "queryCache"
+           WHERE "query" = ?""", (query,))
+        for (volumeId, generation, results) in c.fetchall():
+            cached[volumeId] = (generation, results)
+
+    found = {}
+    stale = []
+    for (volumeId, name, location, kind, generation) in volumes:
+        hit = cached.get(volumeId)
+        if hit and generation is not None and hit[0] == generation:
+            found[volumeId] = [long(id) for id in hit[1].split(",") if id]
+        else:
+            found[volumeId] = []
+            stale.append(volumeId)
+
+    if stale:
+        doquery(c, """
+          SELECT e."volumeId", e."id" FROM "entryRows" as e %s
+          WHERE %s AND e."volumeId" IN (%s)""" %
+                (tables, condition, ", ".join([str(id) for id in stale])),
+                params)
+        for (volumeId, id) in c.fetchall():
+            found[volumeId].append(id)
+
+    if opts.cacheSize > 0:
+        generations = dict([(volume[0], volume[4]) for volume in volumes])
+        cacheResults(query, found, stale, generations)
+
+    rows = []
+    for (volumeId, name, location, kind, generation) in volumes:
+        for id in found[volumeId]:
+            rows.append((volumeId, name, location, kind, id))
+    return processEntriesResult(rows, reporter)
+
+# Searches answered from the cache whose use has not been written yet
+cacheUses = set()
+CACHE_USE_BATCH = 100
+
+def cacheResults(query, found, stale, generations):
+    """Store the results of QUERY just searched for in the volumes STALE,
+    mark QUERY (and the searches answered from the cache before it) as just
+    used, and evict the least recently used results beyond --cache-size
+    entries.  Nothing is written if QUERY was answered from the cache, until
+    CACHE_USE_BATCH searches have been; and if the catalog cannot be
+    written, the results simply go uncached."""
+    # Volumes still being indexed have no generation yet
+    stale = [volumeId for volumeId in stale
+             if generations[volumeId] is not None]
+
+    cacheUses.add(query)
+    if not stale and len(cacheUses) < CACHE_USE_BATCH:
+        return
+
+    try:
+        writeCache(query, found, stale, generations)
+    except Exception, msg:
+        conn.rollback()
+        if opts.verbose:
+            print "Could not cache the results of %s:" % query, msg
+    cacheUses.clear()
+
+def touchCacheUses(c, tick):
+    for used in cacheUses:
+        doquery(c, """UPDATE "queryCache" SET "lastUsed" = ? WHERE "query" = ?""",
+                (tick, used))
+
+def recordCacheUses():
+    """Record the uses of cached results not written yet, as the process
+    exits, letting them go if the catalog is locked or cannot be written."""
+    if not cacheUses:
+        return
+
+    try:
+        c = conn.cursor()
+        if not opts.databaseName:
+            # Rather than wait out another process's write lock
+            c.execute("PRAGMA busy_timeout = 100")
+        c.execute("""SELECT MAX("lastUsed") FROM "queryCache" """)
+        touchCacheUses(c, (c.fetchone()[0] or 0) + 1)
+        conn.commit()
+    except Exception, msg:
+        conn.rollback()
+        if opts.verbose:
+            print "Could not record the use of cached results:", msg
+    cacheUses.clear()
+
+def writeCache(query, found, stale, generations):
+    c = conn.cursor()
+    c.execute("""SELECT MAX("lastUsed") FROM "queryCache" """)
+    tick = (c.fetchone()[0] or 0) + 1
+
+    touchCacheUses(c, tick)
+
+    for volumeId in stale:
+        doquery(c, """
+          DELETE FROM "queryCache" WHERE "query" = ? AND "volumeId" = ?""",
+                (query, volumeId))
+        doquery(c, """
+          INSERT INTO "queryCache"
+            ("query", "volumeId", "generation", "results", "size", "lastUsed")
+          VALUES (?, ?, ?, ?, ?, ?)""",
+                (query, volumeId, generations[volumeId],
+                 ",".join([str(id) for id in found[volumeId]]),
+                 len(found[volumeId]), tick))
+
+    c.execute("""
+      SELECT "lastUsed", SUM("size") + COUNT(*) FROM "queryCache"
+       GROUP BY "lastUsed" ORDER BY "lastUsed" DESC""")
+    kept = 0
+    for (lastUsed, size) in c.fetchall():
+        kept += size
+        if kept > opts.cacheSize:
+            doquery(c, """DELETE FROM "queryCache" WHERE "lastUsed" <= ?""",
+                    (lastUsed,))
+            break
+    conn.commit()
+
+def findEntriesByName(name, reporter):
+    name = re.sub('\*', '%', name)
+    containsPercent = re.search('%', name)
+    operator = containsPercent and "LIKE" or "="
+    return findEntries(u"name %s %s" % (operator, name),
+                       'e."name" %s ?' % operator, (name,), reporter)
+
+def findEntriesByPath(path, reporter):
+    path = re.sub('\*', '%', path)
+    return findEntries(u"path LIKE %s" % path,
+                       'e."volumePath" LIKE ?', (path,), reporter)
+
+def regexLiterals(pattern):
+    """Return the literal text that every match of the regular expression
+    PATTERN begins with, if it is anchored at the start ("" otherwise), a
+    list of the literal strings that every match must contain, and the
+    pattern's flags."""
+    parsed = sre_parse.parse(pattern)
+    runs   = []
+    state  = {"text": [], "atStart": False}
+
+    def endRun():
+        if state["text"]:
+            runs.append((state["atStart"], u"".join(state["text"])))
+            state["text"] = []
+        state["atStart"] = False
+
+    def walk(items):
+        for (op, av) in items:
+            if op == sre_constants.LITERAL:
+                state["text"].append(unichr(av))
+            elif op == sre_constants.SUBPATTERN:
+                walk(av[-1])
+            elif op == sre_constants.AT and not runs and not state["text"] \
+                 and av in (sre_constants.AT_BEGINNING,
+                            sre_constants.AT_BEGINNING_STRING):
+                state["atStart"] = True
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) \
+                 and av[0] >= 1:
+                # The body of a repeat matches at least once, but what comes
+                # before and after it need not adjoin that match
+                endRun()
+                walk(av[2])
+                endRun()
+            else:
+                # Anything else (alternatives, classes, optional parts) may
+                # match text of its own, so it only ends the current run
+                endRun()
+
+    walk(parsed)
+    endRun()
+
+    prefix = u""
+    if runs and runs[0][0]:
+        prefix = runs[0][1]
+
+    literals = []
+    for (atStart, text) in runs:
+        if text not in literals:
+            literals.append(text)
+    return (prefix, literals, parsed.pattern.flags)
+
+def regexPredicate(column, pattern):
+    """Return the SQL condition, and its arguments, matching COLUMN against
+    the regular expression PATTERN.  The literals the pattern requires are
+    tested first with LIKE (and its literal prefix with a range, which can
+    use an index on COLUMN), so that only rows containing them are matched
+    against the expression itself."""
+    (prefix, literals, flags) = regexLiterals(pattern)
+    clauses = []
+    params  = []
+
+    ignoreCase = flags & sre_constants.SRE_FLAG_IGNORECASE
+    if ignoreCase and not opts.databaseName:
+        # SQLite's LIKE only ignores the case of ASCII letters
+        literals = [text for text in literals if ord(max(text)) < 128]
+        prefix   = u""
+    elif ignoreCase:
+        prefix   = u""
+
+    if prefix and ord(prefix[-1]) < sys.maxunicode:
+        clauses.append('%s >= ? AND %s < ?' % (column, column))
+        params.extend([prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)])
+        literals = [text for text in literals if text != prefix]
+
+    like = ignoreCase and opts.databaseName and "ILIKE" or "LIKE"
+    for text in literals:
+        clauses.append("%s %s ? ESCAPE '!'" % (column, like))
+        params.append(u"%%%s%%" % re.sub(u'([!%_])', u'!\\1', text))
+
+    if opts.databaseName:
+        clauses.append('%s ~ ?' % column)
+    else:
+        clauses.append('%s REGEXP ?' % column)
+    params.append(pattern)
+
+    return (" AND ".join(clauses), params)
+
+def findEntriesByRegex(column, pattern, reporter):
+    (condition, params) = regexPredicate('e."%s"' % column, pattern)
+    return findEntries(u"%s ~ %s" % (column, pattern), condition, params,
+                       reporter)
+
+regexCache = {}
+
+def regexpMatch(pattern, value):
+    """The REGEXP function for SQLite: whether VALUE matches the regular
+    expression PATTERN, compiled once for all the rows of a query."""
+    if value is None:
+        return False
+    regex = regexCache.get(pattern)
+    if regex is None:
+        regex = regexCache[pattern] = re.compile(pattern, re.UNICODE)
+    return regex.search(value) is not None
+
+def findEntriesByExtension(extension, reporter):
+    if extension.startswith('.'):
+        extension = extension[1:]
+    return findEntries(u"ext = %s" % extension,
+                       'x."name" = ? AND e."extensionId" = x."id"',
+                       (extension,), reporter, ', "extensions" as x')
+
+def exportEntries(dirName, volumeNames, **extra):
+    """Write the entries of the named volumes, or of every volume, to a
+    columnar export in DIRNAME (see columnar.py).  Keyword arguments are
+    recorded in the export's meta.json."""
+    import columnar
+
+    where  = ""
+    params = ()
+    if volumeNames:
+        where  = """WHERE v."name" IN (%s)""" % ", ".join(["?"] * len(volumeNames))
+        params = tuple(volumeNames)
+
+    c = conn.cursor()
+    doquery(c, """
+      SELECT e."id", v."name", e."name", x."name", e."kind",
+             COALESCE(f."size", d."totalSize"), e."dataModified",
+             e."volumePath"
+        FROM "entryRows" AS e
+        JOIN "volumes" AS v ON v."id" = e."volumeId"
+        LEFT JOIN "extensions" AS x ON x."id" = e."extensionId"
+        LEFT JOIN "fileAttrs" AS f ON f."entryId" = e."id"
+        LEFT JOIN "dirAttrs" AS d ON d."entryId" = e."id"
+      %s ORDER BY e."id" """ % where, params)
+
+    writer = columnar.ColumnWriter(dirName, **extra)
+    rows   = c.fetchmany(1000)
+    while rows:
+        for (id, volume, name, extension, kind, size, modified,
+             volumePath) in rows:
+            writer.add(id, volume, name, extension, kind, size,
+                       toTicks(modified), volumePath)
+        rows = c.fetchmany(1000)
+    writer.close()
+
+    print "Exported %d entries to %s" % (writer.count, dirName)
+
+def analyticsColumns():
+    """Return a ColumnReader over the whole catalog for "catalog analyze".
+    The columns are cached on disk next to the catalog, and exported again
+    only when the catalog's generation has moved on since."""
+    import columnar
+    import shutil
+
+    if opts.databaseName:
+        dirName = expanduser("~/.catalog-%s.columns" % opts.databaseName)
+    else:
+        dirName = opts.databaseFile + ".columns"
+
+    generation = currentGeneration()
+    if exists(join(dirName, "meta.json")):
+        try:
+            reader = columnar.ColumnReader(dirName)
+            if reader.meta.get("generation") == generation:
+                return reader
+            reader.close()
+        except ValueError:
+            pass
+
+    # Export beside the cache and then swap it in, so that an interrupted
+    # export never leaves a cache that looks current.
+    tempName = dirName + ".new"
+    if exists(tempName):
+        shutil.rmtree(tempName)
+    exportEntries(tempName, [], generation = generation)
+    if exists(dirName):
+        shutil.rmtree(dirName)
+    os.rename(tempName, dirName)
+
+    return columnar.ColumnReader(dirName)
+
+def findEntriesByTags(tags, reporter):
+    """Report the entries tagged with every one of TAGS."""
+    condition = " AND ".join(["""
+        e."id" IN (SELECT "entryId" FROM "metadata"
+                    WHERE "name" IN (%s) AND "textValue" = ?
+                      AND "type" = %d)""" %
+                     (", ".join(["'%s'" % name for name in TAG_ATTRIBUTES]),
+                      TEXT_METADATA) for tag in tags])
+    return findEntries(u"tag %s" % u",".join(sorted(set(tags))), condition,
+                       tuple(tags), reporter)
+
+def findEntriesByModified(after, before, reporter):
+    """Report the entries modified at or after the stored timestamp AFTER,
+    and before BEFORE unless it is None, oldest first.  The range and the
+    order both come from the index on "dataModified"; results are not put
+    in the query cache, since ages like "7d" name a new range every time."""
+    condition = 'e."dataModified" >= ?'
+    params    = (after,)
+    if before is not None:
+        condition += ' AND e."dataModified" < ?'
+        params    += (before,)
+
+    c = conn.cursor()
+    doquery(c, """
+      SELECT v."id", v."name", v."location", v."kind", e."id"
+        FROM "entryRows" AS e, "volumes" AS v
+       WHERE %s AND v."id" = e."volumeId"
+       ORDER BY e."dataModified" """ % condition, params)
+    return processEntriesResult(c.fetchall(), reporter)
+
+class ZipFileEntry(Entry):              # a .zip archive file
+    __slots__ = ()
 
-class ZipFileEntry(Entry):              # a .zip archive file
     def __init__(self, volume, parent, path, volumePath, name):
         Entry.__init__(self, volume, parent, path, volumePath, name)
 
@@ -953,11 +2112,9 @@ class ZipFileEntry(Entry):              # a .zip archive file
         entry.kind  = PLAIN_FILE
         entry.attrs = FileAttrs()
 
-        entry.attrs.size   = info.file_size
-        if opts.databaseName:
-            entry.dataModified = apply(mx.DateTime.DateTime, info.date_time)
-        else:
-            entry.dataModified = apply(datetime.datetime, info.date_time)
+        entry.attrs.size     = info.file_size
+        entry.attrs.checksum = archiveChecksum("crc32", "%08x" % info.CRC)
+        entry.dataModified   = fromLocalTime(*info.date_time)
 
         entry.infoRead = True
         self.infoRead = True
@@ -997,19 +2154,48 @@ class ZipFileEntry(Entry):              # a .zip archive file
         attrs.totalSize  += attrs.thisSize
 
 class SevenZipFileEntry(Entry):              # a .7z archive file
-    def readStoredInfo(self, entry, line):
+    __slots__ = ()
+
+    def readStoredInfo(self, entry, fields):
         entry.kind  = PLAIN_FILE
         entry.attrs = FileAttrs()
 
-        entry.attrs.size   = long(line[26:38])
-        if opts.databaseName:
-            entry.dataModified = mx.DateTime.strptime(line[0:19], "%Y-%m-%d %H:%M:%S")
-        else:
-            entry.dataModified = datetime.datetime.strptime(line[0:19], "%Y-%m-%d %H:%M:%S")
+        entry.attrs.size = long(fields.get("Size") or 0)
+        if fields.get("CRC"):
+            entry.attrs.checksum = archiveChecksum("crc32", fields["CRC"])
+
+        # "YYYY-MM-DD HH:MM:SS", sliced rather than parsed with strptime
+        line = fields.get("Modified", "")
+        if len(line) >= 19:
+            entry.dataModified = fromLocalTime(int(line[0:4]), int(line[5:7]),
+                                               int(line[8:10]), int(line[11:13]),
+                                               int(line[14:16]), int(line[17:19]))
 
         entry.infoRead = True
         self.infoRead = True
 
+    def members(self, pipe):
+        """Yield the fields of each member in the technical listing ("7za l
+        -slt") read from PIPE: blocks of "Key = Value" lines, separated by
+        blank lines, after a line of dashes."""
+        insideListing = False
+        fields = {}
+        for line in pipe:
+            line = line.rstrip("\r\n")
+            if not insideListing:
+                insideListing = line.startswith("----------")
+            elif not line:
+                if "Path" in fields:
+                    yield fields
+                fields = {}
+            elif " = " in line:
+                (key, value) = line.split(" = ", 1)
+                fields[key] = value
+            elif line.endswith(" ="):
+                fields[line[:-2]] = ""
+        if "Path" in fields:
+            yield fields
+
     def scanEntries(self):
         assert self.isArchive()
 
@@ -1024,18 +2210,18 @@ class SevenZipFileEntry(Entry):              # a .7z archive file
         pipe = None
 
         try:
-            pipe = Popen("7za l \"%s\"" % self.path, shell = True,
+            pipe = Popen("7za l -slt \"%s\"" % self.path, shell = True,
                          stdout = PIPE).stdout
 
-            for line in pipe.readlines():
-                if not re.match("20", line):
+            for fields in self.members(pipe):
+                if fields.get("Attributes", "").startswith("D"):
                     continue
 
-                filename = line[53:-1]
+                filename = fields["Path"]
 
                 entry = Entry(self.volume, self, join(self.path, filename),
                               join(self.volumePath, filename), filename)
-                self.readStoredInfo(entry, line)
+                self.readStoredInfo(entry, fields)
                 entry.store()
 
                 attrs.thisCount += 1
@@ -1050,6 +2236,8 @@ class SevenZipFileEntry(Entry):              # a .7z archive file
         attrs.totalSize  += attrs.thisSize
 
 class RarFileEntry(Entry):              # a .rar archive file
+    __slots__ = ()
+
     def scanEntries(self):
         assert self.isArchive()
 
@@ -1097,12 +2285,19 @@ class RarFileEntry(Entry):              # a .rar archive file
                     entry.attrs = FileAttrs()
 
                     entry.attrs.size   = long(items[1])
-                    if opts.databaseName:
-                        entry.dataModified = mx.DateTime.strptime(items[4] + " " + items[5],
-                                                                  "%d-%m-%y %H:%M")
-                    else:
-                        entry.dataModified = datetime.datetime.strptime(items[4] + " " + items[5],
-                                                                        "%d-%m-%y %H:%M")
+                    if re.match("[0-9A-Fa-f]{8}$", items[7]):
+                        entry.attrs.checksum = archiveChecksum("crc32",
+                                                               items[7])
+                    # "DD-MM-YY" and "HH:MM", with strptime's rule for
+                    # the century
+                    (day, month, year) = [int(x) for x in items[4].split("-")]
+                    (hour, minute) = [int(x) for x in items[5].split(":")]
+                    if year < 69:
+                        year += 2000
+                    elif year < 100:
+                        year += 1900
+                    entry.dataModified = fromLocalTime(year, month, day,
+                                                       hour, minute)
 
                     entry.infoRead = True
                     self.infoRead = True
@@ -1122,6 +2317,8 @@ class RarFileEntry(Entry):              # a .rar archive file
         attrs.totalSize  += attrs.thisSize
 
 class TarFileEntry(Entry):              # an (un)compressed .tar archive file
+    __slots__ = ()
+
     def readStoredInfo(self, entry, info):
         # jww (2007-03-26): Parse out symbolic links here
         entry.kind  = PLAIN_FILE
@@ -1131,10 +2328,7 @@ class TarFileEntry(Entry):              # an (un)compressed .tar archive file
         entry.permissions  = info.mode
         entry.owner        = info.uid
         entry.group        = info.gid
-        if opts.databaseName:
-            entry.dataModified  = mx.DateTime.DateTimeFromTicks(info.mtime)
-        else:
-            entry.dataModified = datetime.datetime.fromtimestamp(info.mtime)
+        entry.dataModified = fromTicks(info.mtime)
 
         entry.infoRead = True
         self.infoRead = True
@@ -1173,7 +2367,71 @@ class TarFileEntry(Entry):              # an (un)compressed .tar archive file
         attrs.totalCount += attrs.thisCount
         attrs.totalSize  += attrs.thisSize
 
+class IsoImageEntry(Entry):              # an ISO 9660 or UDF .iso image
+    __slots__ = ()
+
+    def readStoredInfo(self, entry, info):
+        if info.kind == isoimage.SYMLINK:
+            entry.kind  = SYMBOLIC_LINK
+            entry.attrs = LinkAttrs()
+            entry.attrs.target = info.target
+        else:
+            entry.kind  = PLAIN_FILE
+            entry.attrs = FileAttrs()
+            entry.attrs.size = info.size
+
+        entry.permissions = info.mode
+        entry.owner       = info.uid
+        entry.group       = info.gid
+        if info.mtime is not None:
+            entry.dataModified = fromTicks(info.mtime)
+
+        entry.infoRead = True
+        self.infoRead = True
+
+    def scanEntries(self):
+        assert self.isArchive()
+
+        attrs = self.attrs
+        attrs = attrs.dirAttrs
+
+        attrs.thisCount  = 0
+        attrs.thisSize   = 0
+        attrs.totalCount = 0
+        attrs.totalSize  = 0
+
+        image = None
+
+        # The image's directories are read straight from the file, without
+        # mounting it; like the members of other archives, only its files
+        # and links are catalogued, each under the image itself.
+        try:
+            image = isoimage.IsoImage(self.path)
+
+            for info in image.walk():
+                if info.kind == isoimage.DIRECTORY:
+                    continue
+
+                entry = Entry(self.volume, self, join(self.path, info.path),
+                              join(self.volumePath, info.path),
+                              basename(info.path))
+                self.readStoredInfo(entry, info)
+                entry.store()
+
+                attrs.thisCount += 1
+                attrs.thisSize  += entry.getFileSize()
+        except Exception, msg:
+            print "Failed to index %s:" % self.path, msg
+
+        if image:
+            image.close()
+
+        attrs.totalCount += attrs.thisCount
+        attrs.totalSize  += attrs.thisSize
+
 class DiskImageEntry(Entry):              # a .dmg file
+    __slots__ = ()
+
     def scanEntries(self):
         assert self.isArchive()
 
@@ -1234,9 +2492,777 @@ class DiskImageEntry(Entry):              # a .dmg file
             p = Popen("hdiutil detach \"%s\"" % path, shell = True, stdout = PIPE)
             os.waitpid(p.pid, 0)
 
+########################################################################
+
+# INDEXING PIPELINE
+#
+# "catalog index" runs as three stages connected by bounded queues, so that
+# each stage can run at its own pace and a slow stage holds back the others
+# (backpressure) instead of letting work pile up in memory:
+#
+#   1. A Walker lists directories and lstat()s their children, assigning
+#      each new entry its id, in a thread of its own.
+#
+#   2. A WorkerPool of --jobs threads lists the contents of archives and
+#      computes checksums, which are the slow, blocking parts of indexing.
+#
+#   3. An EntryWriter, running in the main thread (which owns the database
+#      connection), writes rows in batches of --batch-size, using one
+#      executemany() per statement and one transaction per batch.  With
+#      PostgreSQL, --writers N spreads the writing over N connections, each
+#      taking whole top-level subtrees of the volume.
+#
+# When several volumes are indexed at once, each has a Walker and WorkerPool
+# of its own, so that one slow disk holds back only its own walk, and they
+# all feed the one EntryWriter.  With --stats-json, each volume's timings
+# and counters are reported under "volumes" as well as in the totals.
+#
+# A directory's totals depend on all of its children, including archives
+# still being listed by the workers, so every ScanFrame counts its pending
+# children.  When that count drops to zero the directory is finished: its
+# totals are rolled into its parent and its "dirAttrs" row updated.
+
+class ScanFrame(object):
+    """A directory being catalogued by a Walker, with its rollup so far."""
+    __slots__ = ('entry', 'attrs', 'parent', 'names', 'pending')
+
+    def __init__(self, entry, parent):
+        self.entry   = entry
+        self.attrs   = entry.attrs
+        self.parent  = parent           # the ScanFrame of the parent directory
+        self.names   = None             # children left to visit, last first
+        self.pending = 1                # unfinished children, plus the listing
+
+        self.attrs.thisCount  = 0
+        self.attrs.thisSize   = 0
+        self.attrs.totalCount = 0
+        self.attrs.totalSize  = 0
+
+class Walker(object):
+    """The walk stage of the indexing pipeline.
+
+    The traversal keeps its own stack of ScanFrames instead of recursing, so
+    the depth of a tree is limited by neither Python's recursion limit nor
+    the call stack.  Archives and checksums are handed to POOL; without a
+    pool they are done in the walker's own thread.  A mounted disk image is
+    walked by a nested Walker without a pool.
+
+    When resuming an interrupted scan, RESUME maps the id of each directory
+    on the frontier to what is already stored beneath it (as returned by
+    Volume.loadFrontier), and those children are not stored again."""
+
+    def __init__(self, volume, top, pool = None, resume = None):
+        self.volume      = volume
+        self.top         = top
+        self.pool        = pool
+        self.resume      = resume
+        self.done        = Queue.Queue()     # jobs finished by the pool
+        self.outstanding = 0
+        self.xattrs      = {}                # entries waiting to be stored
+
+    def run(self):
+        stack = [ScanFrame(self.top, None)]
+        while stack or self.outstanding:
+            self.collect(not stack)
+            if not stack:
+                continue
+
+            frame = stack[-1]
+            if frame.names is None:
+                start = time.time()
+                try:
+                    frame.names = os.listdir(frame.entry.path)
+                    frame.names.reverse()
+                except Exception, msg:
+                    print "Failed to index %s:" % frame.entry.path, msg
+                    frame.names = []
+                stats.add("list", start)
+
+            if not frame.names:
+                stack.pop()
+                self.release(frame)
+                continue
+
+            child = self.visit(frame, frame.names.pop())
+            if child:
+                stack.append(child)
+
+    def visit(self, frame, entryName):
+        global lastMessage
+
+        entryPath = join(frame.entry.path, entryName)
+
+        if re.match("/(dev|Network|automount)/", entryPath) or \
+           re.search("/\\.Trashes$", entryPath):
+            return None
+
+        if self.resume:
+            stored = self.resume.get(frame.entry.id, {}).pop(entryName, None)
+            if stored:
+                return self.resumeChild(frame, entryPath, entryName, stored)
+
+        try:
+            entry = createEntry(self.volume, frame.entry, entryPath,
+                                join(frame.entry.volumePath, entryName),
+                                entryName)
+            info = entry.readInfo()
+
+            xattrs = readXattrs(entryPath)
+            if xattrs:
+                self.xattrs[entry] = xattrs
+
+            if entry.isDirectory() or entry.isPackage() or entry.isArchive():
+                if entry.isArchive() and entry.getFileSize() > (5 * 1024 * 1024):
+                    print "Scanning", entry.volumePath
+                    lastMessage = ""
+                else:
+                    parts = entry.volumePath.split("/")
+                    if parts > 3:
+                        parts = parts[0:3]
+                    theMessage = apply(join, parts)
+                    if theMessage != lastMessage:
+                        print "Scanning", theMessage
+                        lastMessage = theMessage
+
+            if entry.isDirectory() or entry.isPackage():
+                entry.store()
+                self.storeXattrs(entry)
+                frame.pending += 1
+                return ScanFrame(entry, frame)
+
+            # Only the first link to a file is hashed, or counted in sizes
+            counted = True
+            if entry.isPlainFile() and info[ST_NLINK] > 1:
+                counted = self.volume.linkFile(entry, (info[ST_DEV],
+                                                       info[ST_INO]))
+
+            if entry.isArchive():
+                self.submit(frame, entry, scanArchive)
+            elif entry.isPlainFile() and counted and \
+                    (opts.readChecksums or opts.readFingerprints):
+                self.submit(frame, entry, hashFile)
+            else:
+                entry.store()
+                self.account(frame, entry, counted)
+
+        except Exception, msg:
+            print "Failed to index %s:" % entryPath, msg
+
+        return None
+
+    def resumeChild(self, frame, entryPath, entryName, stored):
+        """Account for a child stored by an earlier, interrupted scan, and
+        walk it again only if it is a directory on the frontier."""
+        (id, kind, size, complete, totalCount, totalSize, linkGroup,
+         totalLinkedSize) = stored
+
+        if kind in (DIRECTORY, PACKAGE) and not complete:
+            try:
+                entry = createEntry(self.volume, frame.entry, entryPath,
+                                    join(frame.entry.volumePath, entryName),
+                                    entryName)
+                entry.readInfo()
+            except Exception, msg:
+                print "Failed to index %s:" % entryPath, msg
+                return None
+
+            if entry.isDirectory() or entry.isPackage():
+                entry.id = id
+                frame.pending += 1
+                return ScanFrame(entry, frame)
+            return None
+
+        if kind in (DIRECTORY, PACKAGE, ARCHIVE):
+            frame.attrs.totalCount      += totalCount or 0
+            frame.attrs.totalSize       += totalSize or 0
+            frame.attrs.totalLinkedSize += totalLinkedSize or 0
+        elif kind == PLAIN_FILE:
+            frame.attrs.thisCount += 1
+            if linkGroup is None or self.volume.countLinkGroup(linkGroup):
+                frame.attrs.thisSize += size or 0
+            else:
+                frame.attrs.totalLinkedSize += size or 0
+        return None
+
+    def submit(self, frame, entry, work):
+        frame.pending += 1
+        if self.pool:
+            self.outstanding += 1
+            self.pool.submit((self, frame, entry, work))
+        else:
+            if runJob(entry, work):
+                self.account(frame, entry)
+            else:
+                self.xattrs.pop(entry, None)
+            self.release(frame)
+
+    def collect(self, block):
+        """Account for the jobs the pool has finished.  If BLOCK, wait for at
+        least one."""
+        while self.outstanding:
+            try:
+                if block:
+                    (frame, entry, ok) = self.done.get(True, 0.5)
+                else:
+                    (frame, entry, ok) = self.done.get_nowait()
+            except Queue.Empty:
+                if block:
+                    continue
+                return
+
+            self.outstanding -= 1
+            if ok:
+                self.account(frame, entry)
+            else:
+                self.xattrs.pop(entry, None)
+            self.release(frame)
+            block = False
+
+    def storeXattrs(self, entry):
+        """Store the extended attributes of ENTRY, once it has an id."""
+        xattrs = self.xattrs.pop(entry, None)
+        if xattrs:
+            storeXattrs(entry, xattrs)
+
+    def account(self, frame, entry, counted = True):
+        """Add a finished child, other than a directory, to FRAME's totals.
+        Unless COUNTED, the child is a further link to a file whose size has
+        been counted already."""
+        self.storeXattrs(entry)
+
+        if entry.isPlainFile():
+            frame.attrs.thisCount += 1
+            if counted:
+                frame.attrs.thisSize += entry.getSize()
+            else:
+                frame.attrs.totalLinkedSize += entry.getSize()
+        elif entry.isArchive():
+            frame.attrs.totalCount += entry.getCount()
+            frame.attrs.totalSize  += entry.getSize()
+
+    def release(self, frame):
+        """Drop one of FRAME's pending children, and finish every directory
+        that has no pending children left, from FRAME upwards."""
+        frame.pending -= 1
+        while frame.pending == 0:
+            attrs = frame.attrs
+            attrs.totalCount += attrs.thisCount
+            attrs.totalSize  += attrs.thisSize
+            frame.entry.storeDirAttrs()
+
+            if self.resume:
+                self.resume.pop(frame.entry.id, None)
+
+            parent = frame.parent
+            if parent is None:
+                break
+            parent.attrs.totalCount      += attrs.totalCount
+            parent.attrs.totalSize       += attrs.totalSize
+            parent.attrs.totalLinkedSize += attrs.totalLinkedSize
+            parent.pending -= 1
+            frame = parent
+
+def hashFile(entry):
+    entry.attrs.checksum = entry.readChecksum(entry.path)
+    entry.store(entry.readFingerprint(entry.path, entry.attrs.size))
+
+def scanArchive(entry):
+    entry.attrs.checksum = entry.readChecksum(entry.path)
+    entry.store(entry.readFingerprint(entry.path, entry.attrs.size))
+
+    start = time.time()
+    entry.scanEntries()
+    stats.add("archive:" + entry.__class__.__name__, start)
+
+    entry.storeDirAttrs()
+
+def runJob(entry, work):
+    try:
+        work(entry)
+        return True
+    except Exception, msg:
+        print "Failed to index %s:" % entry.path, msg
+        return False
+
+class WorkerPool(object):
+    """The archive and checksum stage of the indexing pipeline: COUNT threads
+    taking jobs from a bounded queue, and reporting each one back to the
+    Walker that submitted it."""
+
+    def __init__(self, count):
+        self.jobs    = Queue.Queue(count * 4)
+        self.threads = []
+        for i in range(count):
+            thread = threading.Thread(target = profiled,
+                                      args = (self.work,))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, job):
+        self.jobs.put(job)
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            (walker, frame, entry, work) = job
+            stats.attach(walker.volume.stats)
+            walker.done.put((frame, entry, runJob(entry, work)))
+
+    def close(self):
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+class IdAllocator(object):
+    """Hands out ids for new rows of TABLE, from any thread, so that rows
+    can refer to each other before any of them has been written.
+
+    With SQLite3 the ids simply continue from the largest one in use, which
+    assumes that no other process is writing to the catalog at the same
+    time.  With PostgreSQL they are drawn from the table's sequence, a block
+    at a time, on a connection of their own."""
+
+    def __init__(self, table, block = 1000):
+        self.table = table
+        self.block = block
+        self.lock  = threading.Lock()
+        self.ids   = []
+        self.conn  = None
+
+        if not opts.databaseName:
+            c = conn.cursor()
+            c.execute("SELECT MAX(\"id\") FROM \"%s\"" % table)
+            self.next = (c.fetchone()[0] or 0) + 1
+
+    def allocate(self):
+        self.lock.acquire()
+        try:
+            if not opts.databaseName:
+                id = self.next
+                self.next += 1
+                return id
+
+            if not self.ids:
+                if not self.conn:
+                    self.conn = connect()
+                c = self.conn.cursor()
+                c.execute("""
+                  SELECT nextval(pg_get_serial_sequence('"%s"', 'id'))
+                    FROM generate_series(1, %d)""" % (self.table, self.block))
+                self.ids = [row[0] for row in c.fetchall()]
+                self.ids.reverse()
+                self.conn.commit()
+
+            return self.ids.pop()
+        finally:
+            self.lock.release()
+
+writerStatements = {
+    "entry": """
+      INSERT INTO "entryRows"
+        ("id", "volumeId", "directoryId", "name", "baseName", "extensionId",
+         "kind", "permissions", "owner", "group", "created", "dataModified",
+         "attrsModified", "dataAccessed", "volumePath")
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+    "fileAttrs": """
+      INSERT INTO "fileAttrs"
+        ("entryId", "linkGroupId", "size", "checksum", "checksumType",
+         "encoding", "fingerprint")
+      VALUES (?, ?, ?, ?, ?, ?, ?)""",
+    "dirAttrs": """
+      INSERT INTO "dirAttrs"
+        ("entryId", "thisCount", "thisSize", "totalCount", "totalSize",
+         "totalLinkedSize", "complete")
+      VALUES (?, ?, ?, ?, ?, ?, 0)""",
+    # Marking a directory complete is its checkpoint: the update is queued
+    # only after every row beneath it, so it is never committed before them.
+    "dirTotals": """
+      UPDATE "dirAttrs" SET "thisCount" = ?, "thisSize" = ?,
+                            "totalCount" = ?, "totalSize" = ?,
+                            "totalLinkedSize" = ?, "complete" = 1
+       WHERE "entryId" = ?""",
+    "linkGroup": """
+      INSERT INTO "linkGroups" ("id") VALUES (?)""",
+    "linkAttrs": """
+      INSERT INTO "linkAttrs" ("entryId", "targetId", "targetPath")
+      VALUES (?, ?, ?)""",
+    "metadata": """
+      INSERT INTO "metadata"
+        ("id", "entryId", "metadataId", "name", "type", "textValue",
+         "blobValue")
+      VALUES (?, ?, ?, ?, ?, ?, ?)""",
+}
+
+# Within a batch, rows are inserted before the updates that may refer to them
+writerOrder = ("linkGroup", "entry", "fileAttrs", "linkAttrs", "metadata",
+               "dirAttrs", "dirTotals")
+
+# The position of the id of the entry each row belongs to
+writerEntryIds = { "entry": 0, "fileAttrs": 0, "linkAttrs": 0, "metadata": 1,
+                   "dirAttrs": 0, "dirTotals": 5 }
+
+def writeRows(connection, rows, failed = None):
+    """Write ROWS, lists of parameters keyed by the name of their
+    writerStatement, in one transaction on CONNECTION.  If the batch cannot
+    be written, it is written again a row at a time, and the entries whose
+    rows fail are reported and skipped, along with everything beneath them;
+    their ids are added to the set FAILED."""
+    if failed is None:
+        failed = set()
+
+    c = connection.cursor()
+    try:
+        for statement in writerOrder:
+            if rows.get(statement):
+                doquerymany(c, writerStatements[statement], rows[statement])
+
+        start = time.time()
+        connection.commit()
+        stats.addCommit(time.time() - start)
+    except Exception:
+        connection.rollback()
+        writeEachRow(connection, rows, failed)
+
+def writeEachRow(connection, rows, failed):
+    """Write ROWS one at a time, each in a transaction of its own (after a
+    failure PostgreSQL aborts the rest of the transaction)."""
+    c = connection.cursor()
+    for statement in writerOrder:
+        for params in rows.get(statement, ()):
+            column = writerEntryIds.get(statement)
+            if column is not None and params[column] in failed:
+                continue
+            if statement == "entry" and params[2] in failed:
+                failed.add(params[0])           # beneath a failed entry
+                continue
+
+            try:
+                doquery(c, writerStatements[statement], params)
+                connection.commit()
+            except Exception, msg:
+                connection.rollback()
+                if statement == "entry":
+                    print "Failed to index %s:" % params[14], msg
+                else:
+                    print "Failed to store %s row:" % statement, msg
+                if column is not None:
+                    failed.add(params[column])
+
+def internExtensions(rows):
+    """Replace the extension of each "entry" row by its id."""
+    return [row[:5] + (internExtension(row[5]),) + row[6:] for row in rows]
+
+class EntryWriter(object):
+    """The writing stage of the indexing pipeline.
+
+    Rows are given to put() as the name of one of the writerStatements and
+    its parameters, along with the entry they belong to.  If THREADED, put()
+    may be called from any thread and only queues the row; drain() must then
+    be run in the main thread to write them.  Otherwise rows are written as
+    batches fill up, and flush() writes whatever is left.
+
+    With PostgreSQL and --writers N above 1, the main thread only dispatches
+    the queued rows to N WriterThreads with connections of their own.  The
+    rows of each top-level subtree of a volume all go to the same thread, so
+    that a directory is still marked complete only after everything beneath
+    it has been committed.  The rows of the volume's top directory are kept
+    for the main connection, and written after every thread has finished."""
+
+    def __init__(self, threaded = False):
+        self.entryIds     = IdAllocator("entryRows")
+        self.linkGroupIds = IdAllocator("linkGroups")
+        self.metadataIds  = IdAllocator("metadata")
+        self.queue    = None
+        self.threads  = []
+        if threaded:
+            self.queue = Queue.Queue(10000)
+            if opts.databaseName and opts.writers > 1:
+                self.threads = [WriterThread() for i in range(opts.writers)]
+                for thread in self.threads:
+                    thread.start()
+        self.routes   = {}
+        self.rows     = {}
+        self.count    = 0
+        self.failed   = set()               # ids of entries not written
+
+    def put(self, statement, params, entry = None):
+        if self.queue:
+            route = None
+            if self.threads and entry is not None:
+                top = entry.volumePath.lstrip("/").split("/", 1)[0]
+                if top:
+                    route = (entry.volume.id, top)
+            self.queue.put((statement, params, route))
+        else:
+            self.add(statement, params)
+
+    def add(self, statement, params):
+        rows = self.rows.get(statement)
+        if rows is None:
+            rows = self.rows[statement] = []
+        rows.append(params)
+
+        self.count += 1
+        if self.count >= opts.batchSize and not self.threads:
+            self.flush()
+
+    def dispatch(self, statement, params, route):
+        """Pass a row taken from the queue to the WriterThread of its
+        subtree, if there are any, or add it to the main connection's."""
+        if not self.threads:
+            self.add(statement, params)
+
+        elif statement == "linkGroup":
+            # The links to a file may be in different subtrees, written by
+            # different threads, so its group is committed before any of
+            # them can refer to it.
+            writeRows(conn, {statement: [params]}, self.failed)
+
+        elif route is None:
+            self.add(statement, params)
+
+        else:
+            thread = self.routes.get(route)
+            if thread is None:
+                thread = min(self.threads, key = lambda thread:
+                             (thread.queue.qsize(), thread.routes))
+                thread.routes += 1
+                self.routes[route] = thread
+            if statement == "entry":
+                params = internExtensions([params])[0]
+            thread.put((statement, params))
+
+    def flush(self):
+        if not self.count:
+            return
+
+        start = time.time()
+        if self.rows.get("entry"):
+            self.rows["entry"] = internExtensions(self.rows["entry"])
+        writeRows(conn, self.rows, self.failed)
+        stats.add("write", start, self.count)
+
+        self.rows  = {}
+        self.count = 0
+
+    def commitPending(self):
+        """Commit the rows written so far, except the ones held back for
+        the main connection when there are WriterThreads."""
+        if not self.threads:
+            self.flush()
+        for thread in self.threads:
+            thread.put("flush")
+
+    def finish(self):
+        """Wait for the WriterThreads, then write the rows held back."""
+        for thread in self.threads:
+            thread.put(None)
+        for thread in self.threads:
+            thread.join()
+        for thread in self.threads:
+            thread.check()
+        self.threads = []
+
+        self.flush()
+
+    def drain(self, threads):
+        """Write queued rows until all of THREADS have finished.
+
+        Ctrl-C is only acted on between rows, so that a row is never lost
+        between being taken from the queue and being written, nor a batch
+        left half written.  KeyboardInterrupt is then raised, and the rows
+        still queued are left for salvage()."""
+        import signal
+        interrupted = []
+        previous = signal.signal(signal.SIGINT, lambda signum, frame:
+                                 interrupted.append(signum))
+        try:
+            while not interrupted:
+                try:
+                    (statement, params, route) = self.queue.get(True, 0.5)
+                except Queue.Empty:
+                    # The producers are idle, so commit what there is so far
+                    self.commitPending()
+                    if self.queue.empty() and \
+                       not [thread for thread in threads if thread.isAlive()]:
+                        break
+                    continue
+
+                self.dispatch(statement, params, route)
+        finally:
+            signal.signal(signal.SIGINT, previous)
+
+        if interrupted:
+            raise KeyboardInterrupt
+        self.finish()
+
+    def salvage(self):
+        """Write the rows queued so far, without waiting for any more.
+        Every row is queued after the rows it depends on, and a directory's
+        "dirTotals" after everything beneath it, so whatever has been
+        queued by now can be written as it stands."""
+        while True:
+            try:
+                (statement, params, route) = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            self.dispatch(statement, params, route)
+
+        self.finish()
+
+# With --profile, every thread of the indexing pipeline runs under a
+# profiler of its own, since cProfile only sees the thread it was started
+# in; writeProfile() merges them with the main thread's.
+threadProfiles = []
+
+def profiled(function):
+    """Call FUNCTION, under a profiler of its own if --profile was given."""
+    if not opts.profileFile:
+        return function()
+
+    import cProfile
+    profile = cProfile.Profile()
+    threadProfiles.append(profile)
+    return profile.runcall(function)
+
+def writeProfile(profile, fileName):
+    """Write the statistics of PROFILE and of every pipeline thread's
+    profile to FILENAME."""
+    import pstats
+    merged = pstats.Stats(profile)
+    for threadProfile in threadProfiles:
+        merged.add(threadProfile)
+    merged.dump_stats(fileName)
+
+class Stage(threading.Thread):
+    """Runs FUNCTION in a thread of its own, keeping any exception it raises
+    so that the main thread can raise it again."""
+
+    def __init__(self, function):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.function = function
+        self.failure  = None
+
+    def run(self):
+        try:
+            profiled(self.function)
+        except:
+            self.failure = sys.exc_info()
+
+    def check(self):
+        if self.failure:
+            raise self.failure[0], self.failure[1], self.failure[2]
+
+class WriterThread(Stage):
+    """Writes the rows dispatched to it by an EntryWriter, in batches of
+    --batch-size, on a PostgreSQL connection of its own."""
+
+    def __init__(self):
+        Stage.__init__(self, self.write)
+        self.queue  = Queue.Queue(10000)
+        self.conn   = connect()
+        self.routes = 0                 # subtrees routed to this thread
+        self.rows   = {}
+        self.count  = 0
+        self.failed = set()             # ids of entries not written
+
+    def put(self, item):
+        """Queue ITEM: a (statement, params) row, "flush" to commit the rows
+        so far, or None once there are no more."""
+        while True:
+            try:
+                self.queue.put(item, True, 0.5)
+                return
+            except Queue.Full:
+                # A thread that has failed no longer empties its queue
+                self.check()
+
+    def write(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                elif item == "flush":
+                    self.flush()
+                    continue
+
+                (statement, params) = item
+                rows = self.rows.get(statement)
+                if rows is None:
+                    rows = self.rows[statement] = []
+                rows.append(params)
+
+                self.count += 1
+                if self.count >= opts.batchSize:
+                    self.flush()
+
+            self.flush()
+        finally:
+            self.conn.close()
+
+    def flush(self):
+        if not self.count:
+            return
+
+        start = time.time()
+        writeRows(self.conn, self.rows, self.failed)
+        stats.add("write", start, self.count)
+
+        self.rows  = {}
+        self.count = 0
+
+def dropEntries(ids):
+    """Delete the entries with the given IDS, and everything beneath them."""
+    c = conn.cursor()
+
+    subtree = list(ids)
+    level   = list(ids)
+    while level:
+        children = []
+        for i in range(0, len(level), 500):
+            chunk = level[i:i+500]
+            doquery(c, """SELECT "id" FROM "entryRows" WHERE "directoryId" IN (%s)""" %
+                    ", ".join(["?"] * len(chunk)), chunk)
+            children.extend([row[0] for row in c.fetchall()])
+        subtree.extend(children)
+        level = children
+
+    for i in range(0, len(subtree), 500):
+        chunk  = subtree[i:i+500]
+        params = ", ".join(["?"] * len(chunk))
+        # Links elsewhere that led into the subtree are left dangling
+        doquery(c, """UPDATE "linkAttrs" SET "targetId" = NULL
+                     WHERE "targetId" IN (%s)""" % params, chunk)
+        for table in ("fileAttrs", "linkAttrs", "dirAttrs", "metadata"):
+            doquery(c, """DELETE FROM "%s" WHERE "entryId" IN (%s)""" %
+                    (table, params), chunk)
+        doquery(c, """DELETE FROM "entryRows" WHERE "id" IN (%s)""" % params,
+                chunk)
+    dropLinkGroups(c)
+    commit()
+
+def dropLinkGroups(c):
+    """Delete the link groups that no file belongs to any more."""
+    c.execute("""
+      DELETE FROM "linkGroups" WHERE "id" NOT IN
+        (SELECT "linkGroupId" FROM "fileAttrs"
+          WHERE "linkGroupId" IS NOT NULL)""")
+
 class Volume:
     id         = -1
     topEntry   = None
+    writer     = None
+    pool       = None
+    stats      = None
+    inodes     = None
+    counted    = None
     name       = "unnamed"
     location   = "unknown location"
     kind       = "unknown kind"
@@ -1261,7 +3287,7 @@ class Volume:
         # Since SQLite3 does not support cascading operations, we're required
         # to do the removal manually.
         if not opts.databaseName:
-            doquery(c, """SELECT "id" FROM "entries" WHERE "volumeId" = ?""", (volumeId,))
+            doquery(c, """SELECT "id" FROM "entryRows" WHERE "volumeId" = ?""", (volumeId,))
             data = c.fetchone()
 
             idsToDelete = []
@@ -1274,54 +3300,1469 @@ class Volume:
                 doquery(c, "DELETE FROM \"fileAttrs\" WHERE \"entryId\" = ?", (entryId,))
                 doquery(c, "DELETE FROM \"linkAttrs\" WHERE \"entryId\" = ?", (entryId,))
                 doquery(c, "DELETE FROM \"dirAttrs\" WHERE \"entryId\" = ?", (entryId,))
+                doquery(c, "DELETE FROM \"metadata\" WHERE \"entryId\" = ?", (entryId,))
 
-            doquery(c, "DELETE FROM \"entries\" WHERE \"volumeId\" = ?", (volumeId,))
+            doquery(c, "DELETE FROM \"entryRows\" WHERE \"volumeId\" = ?", (volumeId,))
 
+        doquery(c, "DELETE FROM \"queryCache\" WHERE \"volumeId\" = ?", (volumeId,))
         doquery(c, "DELETE FROM \"volumes\" WHERE \"id\" = ?", (volumeId,))
-        conn.commit()
-
-    def scanEntries(self):
+        dropLinkGroups(c)
+        bumpGeneration(c)
+        commit()
+
+    def expectedEntries(self):
+        """Guess how many entries this scan will store, for the progress
+        ETA: the size of the previous scan if there was one, otherwise the
+        number of inodes in use if the volume is a whole file system."""
         if self.id > 0:
-            self.clearEntries()
-            self.id = -1
-
-        if self.id < 0:
             c = conn.cursor()
+            doquery(c, """SELECT COUNT(*) FROM "entryRows" WHERE "volumeId" = ?""",
+                    (self.id,))
+            return c.fetchone()[0]
+
+        if ismount(self.path) and hasattr(os, "statvfs"):
+            info = os.statvfs(self.path)
+            return info.f_files - info.f_ffree
+
+        return None
+
+    def linkFile(self, entry, inode):
+        """Put ENTRY, a file with more than one hard link, in the link group
+        of its INODE, a (st_dev, st_ino) pair, creating the group when the
+        inode is first seen.  Returns whether its size is still to be
+        counted, which is only the case for the first link."""
+        group = self.inodes.get(inode)
+        if group is None:
+            allocated = self.writer.linkGroupIds.allocate()
+            group = self.inodes.setdefault(inode, allocated)
+            if group == allocated:
+                self.writer.put("linkGroup", (group,))
+
+        entry.attrs.linkGroup = group
+        return self.countLinkGroup(group)
+
+    def countLinkGroup(self, group):
+        """Return True the first time it is called for GROUP in a scan."""
+        if group in self.counted:
+            return False
+        self.counted.add(group)
+        return True
+
+    def shareLinkChecksums(self):
+        """Copy the checksum and fingerprint of the first link to each
+        hard-linked file, which is the only one hashed, to the other
+        links."""
+        c = conn.cursor()
+        for column in ("checksum", "checksumType", "fingerprint"):
+            doquery(c, """
+              UPDATE "fileAttrs" SET "%s" =
+                  (SELECT MAX(l."%s") FROM "fileAttrs" AS l
+                    WHERE l."linkGroupId" = "fileAttrs"."linkGroupId")
+               WHERE "linkGroupId" IS NOT NULL AND "%s" IS NULL
+                 AND "entryId" IN (SELECT "id" FROM "entryRows"
+                                    WHERE "volumeId" = ?)""" %
+                    (column, column, column), (self.id,))
+        commit()
+
+    def hashCollisions(self):
+        """Hash in full the files of this volume whose fingerprint is shared
+        with a file that is not another link to the same data, and which
+        the fingerprint does not cover whole, so that "checksum" tells
+        whether they really match.  Only one link to each hard-linked file
+        is hashed; shareLinkChecksums copies its checksum to the others."""
+        c = conn.cursor()
+        doquery(c, """
+          SELECT f."id", e."volumePath"
+            FROM "fileAttrs" AS f, "entryRows" AS e
+           WHERE e."id" = f."entryId" AND f."id" IN
+                 (SELECT MIN(h."id") FROM "fileAttrs" AS h, "entryRows" AS r
+                   WHERE r."id" = h."entryId" AND r."volumeId" = ?
+                     AND h."checksum" IS NULL AND h."size" > ?
+                     AND h."fingerprint" IN
+                         (SELECT "fingerprint" FROM "fileAttrs"
+                           WHERE "fingerprint" IS NOT NULL
+                           GROUP BY "fingerprint"
+                          HAVING COUNT(DISTINCT COALESCE("linkGroupId",
+                                                         -"entryId")) > 1)
+                     AND NOT EXISTS
+                         (SELECT 1 FROM "fileAttrs" AS l
+                           WHERE l."linkGroupId" = h."linkGroupId"
+                             AND l."checksum" IS NOT NULL)
+                   GROUP BY COALESCE(h."linkGroupId", -h."entryId"))""",
+                (self.id, 3 * FINGERPRINT_BLOCK))
+        collisions = c.fetchall()
+
+        hashed = 0
+        for (id, volumePath) in collisions:
+            try:
+                checksum = fileChecksum(join(self.path, volumePath))
+            except (IOError, OSError), msg:
+                print "Failed to hash %s:" % volumePath, msg
+                continue
+            doquery(c, """UPDATE "fileAttrs" SET "checksum" = ?,
+                                            "checksumType" = 'md5'
+                         WHERE "id" = ?""", (checksum, id))
+            hashed += 1
+        commit()
+
+        if hashed:
+            print "Volume", self.path, "hashed", hashed, \
+                "files whose fingerprints collide"
+
+    def linkTarget(self, volumePath, text):
+        """Return the path within this volume of the target of the link at
+        VOLUMEPATH, whose text is TEXT, or None if it lies outside."""
+        if isabs(text):
+            if not self.path or text == self.path:
+                return None
+            root = self.path.rstrip("/") + "/"
+            if not text.startswith(root):
+                return None
+            text = text[len(root):]
+        else:
+            text = join(dirname(volumePath), text)
+
+        path = normpath(text)
+        if path == ".":
+            return ""
+        if path == ".." or path.startswith("../"):
+            return None
+        return path
+
+    def resolveLinks(self):
+        """Find the entries that this volume's unresolved symbolic links
+        point to.  The volume's paths are read in one pass, checking each
+        against the targets wanted, and the targets found are written with a
+        single executemany; dangling links, and links leading out of the
+        volume, are counted and reported."""
+        c = conn.cursor()
+        doquery(c, """
+          SELECT l."id", e."volumePath", l."targetPath"
+            FROM "linkAttrs" AS l, "entryRows" AS e
+           WHERE e."id" = l."entryId" AND e."volumeId" = ?
+             AND l."targetId" IS NULL AND l."targetPath" IS NOT NULL""",
+                (self.id,))
+
+        wanted  = {}
+        outside = []
+        for (id, volumePath, text) in c.fetchall():
+            target = self.linkTarget(volumePath, text)
+            if target is None:
+                outside.append((volumePath, text))
+            else:
+                wanted.setdefault(target, []).append((id, volumePath, text))
+
+        if not wanted and not outside:
+            return
+
+        start    = time.time()
+        resolved = []
+        doquery(c, """SELECT "volumePath", "id" FROM "entryRows"
+                     WHERE "volumeId" = ?""", (self.id,))
+        rows = c.fetchmany(1000)
+        while rows:
+            for (volumePath, id) in rows:
+                links = wanted.pop(volumePath or "", None)
+                if links:
+                    resolved.extend([(id, link[0]) for link in links])
+            rows = c.fetchmany(1000)
+
+        doquerymany(c, """UPDATE "linkAttrs" SET "targetId" = ? WHERE "id" = ?""",
+                    resolved)
+        commit()
+        stats.add("links", start, len(resolved))
+
+        dangling = []
+        for links in wanted.values():
+            dangling.extend([link[1:] for link in links])
+
+        print "Volume %s: %d links resolved, %d dangling, %d outside the volume" % \
+            (self.name, len(resolved), len(dangling), len(outside))
+        if opts.verbose:
+            for (volumePath, text) in sorted(dangling):
+                print "  dangling: %s -> %s" % (volumePath, text)
+            for (volumePath, text) in sorted(outside):
+                print "  outside:  %s -> %s" % (volumePath, text)
+
+    def findTopEntry(self):
+        c = conn.cursor()
+        doquery(c, """
+          SELECT e."id", d."complete" FROM "entryRows" AS e, "dirAttrs" AS d
+           WHERE e."volumeId" = ? AND e."directoryId" = -1
+             AND d."entryId" = e."id" """, (self.id,))
+        return c.fetchone()
+
+    def loadFrontier(self):
+        """Load what an interrupted scan left behind: a map from the id of
+        each directory still on the frontier to a map from the names of its
+        stored children to their (id, kind, size, complete, totalCount,
+        totalSize, linkGroupId, totalLinkedSize).  Archives that were only
+        partly listed are dropped, to be listed again, and so are entries
+        whose attributes were never written, since the walker was still
+        queueing them when the run was interrupted."""
+        c = conn.cursor()
+        doquery(c, """
+          SELECT e."id", e."kind" FROM "entryRows" AS e, "dirAttrs" AS d
+           WHERE e."volumeId" = ? AND d."entryId" = e."id"
+             AND d."complete" = 0""", (self.id,))
+        frontier = c.fetchall()
+
+        archives = [id for (id, kind) in frontier if kind == ARCHIVE]
+        if archives:
+            dropEntries(archives)
+
+        directories = [id for (id, kind) in frontier if kind != ARCHIVE]
+        resume = {}
+        for id in directories:
+            resume[id] = {}
+
+        partial = []
+        for i in range(0, len(directories), 500):
+            chunk = directories[i:i+500]
             doquery(c, """
-              INSERT INTO "volumes" ("name", "location", "kind", "totalCount", "totalSize")
-              VALUES (?, ?, ?, 0, 0)""", (self.name, self.location, self.kind))
-
-	    if not opts.databaseName:
-                self.id = c.lastrowid
-            	conn.commit()
-	    else:
-            	conn.commit()
-                c = conn.cursor()
-                c.execute("SELECT currval(pg_get_serial_sequence('volumes', 'id'))")
-                self.id = c.fetchone()[0]
+              SELECT e."id", e."directoryId", e."name", e."kind", f."size",
+                     d."complete", d."totalCount", d."totalSize",
+                     f."linkGroupId", d."totalLinkedSize",
+                     f."entryId" IS NOT NULL, d."entryId" IS NOT NULL,
+                     l."entryId" IS NOT NULL
+                FROM "entryRows" AS e
+                LEFT JOIN "fileAttrs" AS f ON f."entryId" = e."id"
+                LEFT JOIN "dirAttrs" AS d ON d."entryId" = e."id"
+                LEFT JOIN "linkAttrs" AS l ON l."entryId" = e."id"
+               WHERE e."directoryId" IN (%s)""" %
+                    ", ".join(["?"] * len(chunk)), chunk)
+            for (id, parentId, name, kind, size, complete, totalCount,
+                 totalSize, linkGroup, totalLinkedSize, hasFileAttrs,
+                 hasDirAttrs, hasLinkAttrs) in c.fetchall():
+                if (kind in (PLAIN_FILE, ARCHIVE) and not hasFileAttrs) or \
+                   (kind in (DIRECTORY, PACKAGE, ARCHIVE) and
+                    not hasDirAttrs) or \
+                   (kind == SYMBOLIC_LINK and not hasLinkAttrs):
+                    partial.append(id)
+                    continue
+                resume[parentId][name] = (id, kind, size, complete,
+                                          totalCount, totalSize, linkGroup,
+                                          totalLinkedSize)
+        if partial:
+            dropEntries(partial)
+
+        print "Resuming volume %s: %d directories left on the frontier" % \
+            (self.name, len(directories))
+        return resume
+
+    def scanEntries(self, resume = False):
+        indexVolumes([self], resume)
+
+    def prepareScan(self, writer, resume = False):
+        """Get ready to index this volume, with its rows going to WRITER.
+        Returns the Stage that will walk it, or None if there is nothing
+        to walk."""
+        # An interrupted scan leaves the volume's top directory incomplete
+        top = None
+        if resume and self.id > 0:
+            top = self.findTopEntry()
+            if top and top[1]:
+                print "Volume %s was completely indexed; indexing it again" % \
+                    self.name
+                top = None
+            elif not top:
+                print "Volume %s has nothing to resume; indexing it again" % \
+                    self.name
+
+        frontier = None
+        if top:
+            frontier = self.loadFrontier()
+        else:
+            self.create()
 
         self.topEntry = Entry(self, None, self.path, "", "")
         self.topEntry.readInfo()
 
+        self.writer  = writer
+        self.inodes  = {}
+        self.counted = set()
+        if opts.jobs > 0:
+            self.pool = WorkerPool(opts.jobs)
+
+        # The top entry is stored first, so that its children can refer to
+        # it; its totals are filled in once the scan is done.
+        if self.topEntry.isDirectory():
+            if top:
+                self.topEntry.id = top[0]
+            else:
+                self.topEntry.store()
+            work = Walker(self, self.topEntry, self.pool, frontier).run
+        elif self.topEntry.isArchive():
+            work = lambda: scanArchive(self.topEntry)
+        else:
+            print "Volume is neither a directory nor an archive"
+            return None
+
+        def run():
+            stats.attach(self.stats)
+            try:
+                work()
+            finally:
+                if self.stats:
+                    self.stats.finish()
+        return Stage(run)
+
+    def endScan(self, completed):
+        """Let go of what the walk needed.  The workers are only waited for
+        if the walk COMPLETED; otherwise they may never finish."""
+        if self.pool and completed:
+            self.pool.close()
+        self.pool    = None
+        self.writer  = None
+        self.inodes  = None
+        self.counted = None
+
+    def finishScan(self):
+        """Once every row of the walk has been written, settle what needs
+        the whole volume: colliding fingerprints, the checksums of hard
+        links, symbolic link targets and the volume's totals."""
+        if opts.readFingerprints and self.topEntry.isDirectory():
+            self.hashCollisions()
+        if opts.readChecksums or opts.readFingerprints:
+            self.shareLinkChecksums()
+        self.resolveLinks()
+
         if self.topEntry.isDirectory():
-            self.topEntry.scanEntries()
-            self.topEntry.store()
             self.totalCount = self.topEntry.attrs.totalCount
             self.totalSize  = self.topEntry.attrs.totalSize
+
+            if self.topEntry.attrs.totalLinkedSize:
+                print "Volume", self.path, "hard links add", \
+                    self.topEntry.attrs.totalLinkedSize, "more bytes"
         elif self.topEntry.isArchive():
-            self.topEntry.scanEntries()
-            self.topEntry.store()
             self.totalCount = self.topEntry.attrs.dirAttrs.totalCount
             self.totalSize  = self.topEntry.attrs.dirAttrs.totalSize
-        else:
-            print "Volume is neither a directory nor an archive"
 
+        self.storeTotals()
+
+    def create(self):
+        """Store this volume afresh, dropping whatever was catalogued for it
+        before."""
+        if self.id > 0:
+            self.clearEntries()
+            self.id = -1
+
+        c = conn.cursor()
+        doquery(c, """
+          INSERT INTO "volumes" ("name", "location", "kind", "totalCount", "totalSize")
+          VALUES (?, ?, ?, 0, 0)""", (self.name, self.location, self.kind))
+
+        self.id = insertedId(c, "volumes")
+
+    def storeTotals(self, report = True):
+        c = conn.cursor()
         doquery(c, """
           UPDATE "volumes" SET "totalCount" = ?, "totalSize" = ? WHERE "id" = ?""",
             (self.totalCount, self.totalSize, self.id))
+        bumpGeneration(c)
+        doquery(c, """
+          UPDATE "volumes" SET "generation" =
+            (SELECT "generation" FROM "generation") WHERE "id" = ?""",
+            (self.id,))
+        commit()
+
+        if report:
+            print "Volume", self.path, "total count is", self.totalCount
+            print "Volume", self.path, "total size  is", self.totalSize
+
+    def ingestManifest(self, records):
+        """Catalog this volume from the records of a manifest (see
+        parseManifestRecord) instead of from the file system, which is never
+        touched.  Directories are stored when first named, by their own
+        record or by a path beneath them, and their totals are rolled up
+        once every record has been read."""
+        global stats
+        stats = IndexStats(self.expectedEntries())
+
+        self.create()
+
+        self.writer = EntryWriter()
+        try:
+            self.topEntry = Entry(self, None, self.path, "", "")
+            self.topEntry.kind  = DIRECTORY
+            self.topEntry.attrs = DirAttrs()
+            self.topEntry.store()
+
+            directories = { "": self.topEntry }
+
+            for record in records:
+                try:
+                    (path, kind, size, mode, uid, gid, mtime, digest) = \
+                        parseManifestRecord(record)
+                except ValueError, msg:
+                    print "Skipping manifest record %r:" % record, msg
+                    continue
+
+                volumePath = self.manifestPath(path)
+                if volumePath in directories:
+                    # A directory already stored on behalf of its contents
+                    entry = directories[volumePath]
+                    if kind != DIRECTORY:
+                        print "Skipping manifest record %r: already a directory" % \
+                            record
+                        continue
+                else:
+                    parent = self.manifestDirectory(directories,
+                                                    dirname(volumePath))
+                    entry  = Entry(self, parent, join(self.path, volumePath),
+                                   volumePath, basename(volumePath))
+                    entry.kind = kind
+
+                    if kind == DIRECTORY:
+                        entry.attrs = DirAttrs()
+                        directories[volumePath] = entry
+                    elif kind == PLAIN_FILE:
+                        entry.attrs = FileAttrs()
+                        entry.attrs.size     = size
+                        entry.attrs.checksum = digest
+                        parent.attrs.thisCount += 1
+                        parent.attrs.thisSize  += size
+                    elif kind == SYMBOLIC_LINK:
+                        entry.attrs = LinkAttrs()
+
+                entry.permissions  = mode
+                entry.owner        = uid
+                entry.group        = gid
+                entry.dataModified = fromTicks(mtime)
+                entry.infoRead     = True
+
+                if entry.id != -1:
+                    # Its row may still be waiting in the writer
+                    self.writer.flush()
+                entry.store()
+
+            # Deepest directories first, so that each one is complete before
+            # it is added to its parent
+            paths = directories.keys()
+            paths.sort(key = lambda path: -path.count("/"))
+            for path in paths:
+                if not path:
+                    continue
+                attrs = directories[path].attrs
+                attrs.totalCount += attrs.thisCount
+                attrs.totalSize  += attrs.thisSize
+
+                parent = directories[dirname(path)].attrs
+                parent.totalCount += attrs.totalCount
+                parent.totalSize  += attrs.totalSize
+                directories[path].storeDirAttrs()
+
+            attrs = self.topEntry.attrs
+            attrs.totalCount += attrs.thisCount
+            attrs.totalSize  += attrs.thisSize
+            self.topEntry.storeDirAttrs()
+
+            self.writer.flush()
+        finally:
+            self.writer = None
+
+        self.totalCount = self.topEntry.attrs.totalCount
+        self.totalSize  = self.topEntry.attrs.totalSize
+        self.storeTotals()
+
+    def manifestPath(self, path):
+        """Turn a path from a manifest into one within this volume."""
+        if self.path and self.path != "/" and \
+           (path == self.path or path.startswith(self.path + "/")):
+            path = path[len(self.path):]
+        path = normpath("/" + path.lstrip("/"))[1:]
+        return path
+
+    def manifestDirectory(self, directories, volumePath):
+        """Find the directory at VOLUMEPATH, storing it and any of its
+        ancestors that the manifest has not named yet."""
+        missing = []
+        while volumePath not in directories:
+            missing.append(volumePath)
+            volumePath = dirname(volumePath)
+
+        parent = directories[volumePath]
+        missing.reverse()
+        for volumePath in missing:
+            entry = Entry(self, parent, join(self.path, volumePath),
+                          volumePath, basename(volumePath))
+            entry.kind  = DIRECTORY
+            entry.attrs = DirAttrs()
+            entry.store()
+
+            directories[volumePath] = parent = entry
+
+        return parent
+
+# The type letters of "find -printf %y", and the kind and file type bits each
+# one is catalogued with.
+manifestKinds = {
+    'f': (PLAIN_FILE,    S_IFREG),
+    'd': (DIRECTORY,     S_IFDIR),
+    'l': (SYMBOLIC_LINK, S_IFLNK),
+    'b': (SPECIAL_FILE,  S_IFBLK),
+    'c': (SPECIAL_FILE,  S_IFCHR),
+    'p': (SPECIAL_FILE,  S_IFIFO),
+    's': (SPECIAL_FILE,  S_IFSOCK),
+}
+
+def indexVolumes(volumes, resume = False):
+    """Index VOLUMES in one run.  Each volume is walked by a Walker of its
+    own, with its own WorkerPool and stats, so that the run takes about as
+    long as its slowest volume rather than as all of them together; the
+    rows of all of them go to one EntryWriter."""
+    global stats
+
+    expected = [volume.expectedEntries() for volume in volumes]
+    if None in expected:
+        stats = IndexStats()
+    else:
+        stats = IndexStats(sum(expected))
+
+    if len(volumes) > 1:
+        for (volume, count) in zip(volumes, expected):
+            volume.stats = stats.forVolume(volume.name, count)
+    else:
+        stats.expected = expected[0]
+
+    writer    = EntryWriter(threaded = True)
+    stages    = []
+    completed = False
+    try:
+        for volume in volumes:
+            stats.attach(volume.stats)
+            stage = volume.prepareScan(writer, resume)
+            if stage:
+                stages.append(stage)
+        stats.attach(None)
+
+        for stage in stages:
+            stage.start()
+        if stages:
+            try:
+                writer.drain(stages)
+            except KeyboardInterrupt:
+                # Keep what has been gathered so far, for --resume
+                writer.salvage()
+                print "Interrupted; use --resume to continue indexing", \
+                    ", ".join([volume.name for volume in volumes])
+                raise
+            for stage in stages:
+                stage.check()
+        completed = True
+    finally:
+        stats.attach(None)
+        for volume in volumes:
+            volume.endScan(completed)
+
+    for volume in volumes:
+        stats.attach(volume.stats)
+        volume.finishScan()
+        if volume.stats:
+            volume.stats.details.update(path = volume.path,
+                                        totalCount = volume.totalCount,
+                                        totalSize = volume.totalSize)
+    stats.attach(None)
+
+def readVolumeList(stream):
+    """Read the volumes to index from STREAM, one per line: a path, and
+    optionally its name, location and kind, separated by tabs.  Blank lines
+    and lines starting with "#" are skipped.  Returns (path, name, location,
+    kind) tuples, with None for what was not given."""
+    volumes = []
+    for line in stream:
+        line = line.rstrip("\r\n")
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+
+        fields = line.split("\t") + [None] * 3
+        (path, name, location, kind) = [field or None for field in fields[:4]]
+        if not name:
+            name = basename(normpath(path))
+        volumes.append((path, name, location, kind))
+    return volumes
+
+def parseManifestRecord(record):
+    """Split a manifest record into (path, kind, size, mode, uid, gid, mtime,
+    digest).  A record has seven or eight tab-separated fields: the path,
+    the type letter, the size in bytes, the mode in octal (the permission
+    bits alone, or the whole st_mode), the uid, the gid, the modification
+    time in seconds since the epoch, and optionally a checksum.  Raises
+    ValueError if the record is malformed."""
+    fields = record.split("\t")
+    if len(fields) not in (7, 8):
+        raise ValueError("expected 7 or 8 fields, found %d" % len(fields))
+
+    (path, kind, size, mode, uid, gid, mtime) = fields[:7]
+
+    if kind not in manifestKinds:
+        raise ValueError("unknown type '%s'" % kind)
+    (kind, typeBits) = manifestKinds[kind]
+
+    mode = int(mode, 8)
+    if not S_IFMT(mode):
+        mode |= typeBits
+
+    digest = None
+    if len(fields) == 8 and fields[7]:
+        digest = manifestChecksum(fields[7])
+
+    return (path, kind, long(size), mode, int(uid), int(gid), float(mtime),
+            digest)
+
+# The algorithms of bare manifest checksums, by their number of hex digits
+manifestDigests = { 32: "md5", 40: "sha1", 64: "sha256" }
+
+def manifestChecksum(text):
+    """Return the checksum given in a manifest as TEXT, "ALGORITHM:VALUE" or
+    a bare value, as FileAttrs keeps it.  Raises ValueError if it is not in
+    hexadecimal, or its algorithm cannot be told from its length."""
+    if ":" in text:
+        (algorithm, value) = text.split(":", 1)
+        algorithm = algorithm.lower()
+    else:
+        (algorithm, value) = (manifestDigests.get(len(text)), text)
+
+    if not re.match("[0-9A-Fa-f]+$", value):
+        raise ValueError("checksum '%s' is not hexadecimal" % text)
+    if not algorithm:
+        raise ValueError("cannot tell the algorithm of checksum '%s'; "
+                         "give it as ALGORITHM:VALUE" % text)
+    if algorithm in manifestDigests.values() and \
+       manifestDigests.get(len(value)) != algorithm:
+        raise ValueError("checksum '%s' is the wrong length for %s" %
+                         (text, algorithm))
+
+    if algorithm == "md5":
+        return value.lower()
+    return archiveChecksum(algorithm, value)
+
+def readManifest(stream, separator = "\n"):
+    """Yield the records of a manifest read from STREAM, which are
+    terminated by SEPARATOR."""
+    remainder = ""
+    while True:
+        data = stream.read(1048576)
+        if not data:
+            break
+        records   = (remainder + data).split(separator)
+        remainder = records.pop()
+        for record in records:
+            if record:
+                yield record
+
+    if remainder:
+        yield remainder
+
+########################################################################
+
+# WATCHING A VOLUME
+#
+# "catalog watch" keeps an indexed volume up to date between index runs, on
+# Linux, by watching each of its directories with inotify.  Events come in
+# bursts (an unpacked tarball, a build), so they are coalesced until the
+# volume has been quiet for WATCH_QUIET seconds, or for at most WATCH_DELAY
+# seconds, into the set of paths that changed.  Each path is then compared
+# with what is stored for it: entries are added (whole subtrees for new
+# directories), updated or dropped, and the differences in count and size
+# are added to the "dirAttrs" rows of every directory above them, and to the
+# volume's totals, in one batch.
+#
+# If the kernel's event queue overflows, events have been lost, and the
+# directories whose modification time has changed since they were last seen
+# have their children compared again.  Changes to files inside directories
+# whose listing did not change are only found by the next index run, as are
+# the hard links among files added while watching.
+#
+# A changed file has its checksum and fingerprint computed again if it had
+# them, whether or not the watch was started with -C and -F; those options
+# only decide what new files get.
+
+WATCH_QUIET = 1.0
+WATCH_DELAY = 10.0
+
+WATCH_MASK = (inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MODIFY |
+              inotify.IN_CLOSE_WRITE | inotify.IN_ATTRIB |
+              inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO |
+              inotify.IN_ONLYDIR | inotify.IN_DONT_FOLLOW |
+              inotify.IN_EXCL_UNLINK)
+
+# Events after which a file's checksum no longer holds
+CONTENT_EVENTS = (inotify.IN_CREATE | inotify.IN_MODIFY |
+                  inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO)
+
+class WatchWalker(Walker):
+    """A Walker that also collects the directories it stores, so that they
+    can be watched in turn."""
+
+    def __init__(self, volume, top, directories):
+        Walker.__init__(self, volume, top)
+        self.directories = directories
+
+    def visit(self, frame, entryName):
+        child = Walker.visit(self, frame, entryName)
+        if child:
+            self.directories.append(child.entry)
+        return child
+
+def fileKind(name, info):
+    """The kind of entry that a file named NAME, with lstat() INFO, is
+    catalogued as."""
+    if S_ISDIR(info[ST_MODE]):
+        return DIRECTORY
+    elif S_ISLNK(info[ST_MODE]):
+        return SYMBOLIC_LINK
+    elif S_ISREG(info[ST_MODE]):
+        if isArchiveName(name):
+            return ARCHIVE
+        return PLAIN_FILE
+    return SPECIAL_FILE
+
+class VolumeWatcher(object):
+    """Applies the changes made beneath VOLUME's path, as inotify reports
+    them, to its catalogued entries."""
+
+    def __init__(self, volume):
+        self.volume      = volume
+        self.inotify     = inotify.Inotify()
+        self.watches     = {}           # watch descriptor -> volume path
+        self.directories = {}           # volume path -> entry id
+        self.parents     = {}           # directory id -> its parent's id
+        self.mtimes      = {}           # volume path -> st_mtime last seen
+        self.full        = False        # whether we ran out of watches
+        self.links       = []           # (id, volume path) of links changed
+
+    def diskPath(self, volumePath):
+        if volumePath:
+            return join(self.volume.path, volumePath)
+        return self.volume.path
+
+    def watch(self, volumePath, id, parentId):
+        self.directories[volumePath] = id
+        self.parents[id] = parentId
+        try:
+            path = self.diskPath(volumePath)
+            self.watches[self.inotify.addWatch(path, WATCH_MASK)] = volumePath
+            self.mtimes[volumePath] = os.lstat(path).st_mtime
+        except OSError, err:
+            if err.errno == errno.ENOSPC and not self.full:
+                print "Out of inotify watches; raise fs.inotify.max_user_watches"
+                self.full = True
+            elif err.errno not in (errno.ENOENT, errno.ENOTDIR, errno.ENOSPC):
+                print "Failed to watch %s:" % path, err
+
+    def unwatch(self, volumePath):
+        """Forget the directory VOLUMEPATH and every directory beneath it."""
+        prefix = volumePath + "/"
+        for path in self.directories.keys():
+            if path == volumePath or path.startswith(prefix):
+                id = self.directories.pop(path)
+                self.parents.pop(id, None)
+                self.mtimes.pop(path, None)
+        for (wd, path) in self.watches.items():
+            if path == volumePath or path.startswith(prefix):
+                del self.watches[wd]
+                self.inotify.removeWatch(wd)
+
+    def load(self):
+        """Watch every directory of the volume, as catalogued."""
+        c = conn.cursor()
+        doquery(c, """
+          SELECT "id", "directoryId", "volumePath" FROM "entryRows"
+           WHERE "volumeId" = ? AND "kind" IN (?, ?)""",
+                (self.volume.id, DIRECTORY, PACKAGE))
+        rows = c.fetchall()
+
+        # Directories listed from archives and disk images are not on disk
+        # as such; they are left out by starting from the top directory.
+        children = {}
+        for (id, parentId, volumePath) in rows:
+            children.setdefault(parentId, []).append((id, volumePath))
+        level = [(-1, None)]
+        while level:
+            below = []
+            for (parentId, parentPath) in level:
+                for (id, volumePath) in children.get(parentId, []):
+                    volumePath = volumePath or ""
+                    if isinstance(volumePath, unicode):
+                        volumePath = volumePath.encode("utf-8")
+                    self.watch(volumePath, id, parentId)
+                    below.append((id, volumePath))
+            level = below
+
+        print "Watching %d directories of volume %s" % \
+            (len(self.watches), self.volume.name)
+
+    def run(self):
+        if "" not in self.directories:
+            print "Volume %s has no top directory to watch" % self.volume.name
+            return
+
+        try:
+            while True:
+                events = self.inotify.read()
+                deadline = time.time() + WATCH_DELAY
+                while time.time() < deadline:
+                    more = self.inotify.read(WATCH_QUIET)
+                    if not more:
+                        break
+                    events.extend(more)
+                self.apply(events)
+        finally:
+            self.inotify.close()
+
+    def collect(self, events):
+        """Coalesce EVENTS into a map from each volume path they concern to
+        the union of their masks.  Returns it and whether events were lost."""
+        changed  = {}
+        overflow = False
+        for (wd, mask, cookie, name) in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                overflow = True
+                continue
+
+            volumePath = self.watches.get(wd)
+            if volumePath is None:
+                continue
+            if mask & inotify.IN_IGNORED:
+                # The directory is gone, or was moved away; the event for it
+                # in its parent says which
+                del self.watches[wd]
+                continue
+            if name:
+                volumePath = join(volumePath, name)
+            elif mask & (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF):
+                continue
+            changed[volumePath] = changed.get(volumePath, 0) | mask
+        return (changed, overflow)
+
+    def rescan(self, changed):
+        """After lost events, add the children of every directory whose
+        modification time has changed to CHANGED."""
+        c = conn.cursor()
+        for (volumePath, id) in self.directories.items():
+            path = self.diskPath(volumePath)
+            try:
+                mtime = os.lstat(path).st_mtime
+                names = set(os.listdir(path))
+            except OSError:
+                changed[volumePath] = changed.get(volumePath, 0)
+                continue
+            if mtime == self.mtimes.get(volumePath):
+                continue
+            self.mtimes[volumePath] = mtime
+
+            doquery(c, """SELECT "name" FROM "entryRows" WHERE "directoryId" = ?""",
+                    (id,))
+            for (name,) in c.fetchall():
+                if isinstance(name, unicode):
+                    name = name.encode("utf-8")
+                names.add(name)
+            for name in names:
+                childPath = join(volumePath, name)
+                changed[childPath] = changed.get(childPath, 0) | \
+                    CONTENT_EVENTS | inotify.IN_ATTRIB
+
+    def lookup(self, parentId, name):
+        """Return what is stored for the child NAME of directory PARENTID:
+        (id, kind, size, totalCount, totalSize, totalLinkedSize), or None."""
+        c = conn.cursor()
+        doquery(c, """
+          SELECT e."id", e."kind", f."size", d."totalCount", d."totalSize",
+                 d."totalLinkedSize"
+            FROM "entryRows" AS e
+            LEFT JOIN "fileAttrs" AS f ON f."entryId" = e."id"
+            LEFT JOIN "dirAttrs" AS d ON d."entryId" = e."id"
+           WHERE e."directoryId" = ? AND e."name" = ?""", (parentId, name))
+        return c.fetchone()
+
+    def resolve(self, volumePath):
+        """Return the id of the entry at VOLUMEPATH, if it is stored."""
+        if volumePath in self.directories:
+            return self.directories[volumePath]
+        parentId = self.directories.get(dirname(volumePath))
+        if parentId is not None:
+            stored = self.lookup(parentId, basename(volumePath))
+            if stored:
+                return stored[0]
+        return None
+
+    def addDelta(self, deltas, parentId, delta, sign):
+        """Add DELTA, the (thisCount, thisSize, totalCount, totalSize,
+        totalLinkedSize) that an entry adds to its parent PARENTID, times
+        SIGN, to DELTAS for its parent and every directory above."""
+        id = parentId
+        while id is not None and id >= 0:
+            totals = deltas.get(id)
+            if totals is None:
+                totals = deltas[id] = [0, 0, 0, 0, 0]
+            for i in range(5):
+                totals[i] += sign * delta[i]
+            delta = (0, 0) + tuple(delta[2:])
+            id = self.parents.get(id)
+
+    def apply(self, events):
+        (changed, overflow) = self.collect(events)
+        if overflow:
+            print "Events were lost; rescanning changed directories"
+            self.rescan(changed)
+        if not changed:
+            return
+
+        global stats
+        stats = IndexStats()
+
+        volume = self.volume
+        volume.writer  = EntryWriter()
+        volume.inodes  = {}
+        volume.counted = set()
+        firstId = volume.writer.entryIds.allocate()
+        self.links = []
+
+        # Paths that are gone are handled first, so that a directory moved
+        # within the volume is unwatched at its old path before it is
+        # watched at its new one; parents are handled before children.
+        paths = []
+        for (volumePath, mask) in changed.items():
+            try:
+                info = os.lstat(self.diskPath(volumePath))
+            except OSError:
+                info = None
+            paths.append((info is not None, volumePath.count("/"),
+                          volumePath, mask, info))
+        paths.sort()
+
+        deltas   = {}
+        dropped  = []
+        replaced = set()                # paths whose subtrees were rewritten
+        parents  = set()
+        try:
+            for (exists, depth, volumePath, mask, info) in paths:
+                parts = volumePath.split("/")
+                if [i for i in range(1, len(parts))
+                    if "/".join(parts[:i]) in replaced]:
+                    continue
+
+                parentPath = dirname(volumePath)
+                parentId   = self.directories.get(parentPath)
+                if parentId is None or not volumePath:
+                    continue
+                parents.add(parentPath)
+
+                name   = basename(volumePath)
+                stored = self.lookup(parentId, name)
+
+                if stored and (info is None or stored[1] == ARCHIVE or
+                               fileKind(name, info) != stored[1]):
+                    dropped.append(stored[0])
+                    self.addDelta(deltas, parentId, self.storedDelta(stored), -1)
+                    if stored[1] in (DIRECTORY, PACKAGE):
+                        self.unwatch(volumePath)
+                    replaced.add(volumePath)
+                    stored = None
 
-        print "Volume", self.path, "total count is", self.totalCount
-        print "Volume", self.path, "total size  is", self.totalSize
+                if info is None:
+                    continue
+                try:
+                    if stored:
+                        delta = self.update(stored, volumePath, info, mask)
+                    else:
+                        delta = self.insert(parentId, volumePath)
+                        replaced.add(volumePath)
+                    self.addDelta(deltas, parentId, delta, 1)
+                except Exception, msg:
+                    print "Failed to index %s:" % self.diskPath(volumePath), msg
+
+            volume.writer.flush()
+        finally:
+            volume.writer  = None
+            volume.inodes  = None
+            volume.counted = None
+
+        if dropped:
+            dropEntries(dropped)
+        self.resolveLinks(firstId)
+
+        c = conn.cursor()
+        doquerymany(c, """
+          UPDATE "dirAttrs" SET "thisCount"       = "thisCount" + ?,
+                                "thisSize"        = "thisSize" + ?,
+                                "totalCount"      = "totalCount" + ?,
+                                "totalSize"       = "totalSize" + ?,
+                                "totalLinkedSize" = "totalLinkedSize" + ?
+           WHERE "entryId" = ?""",
+                    [tuple(totals) + (id,) for (id, totals) in deltas.items()
+                     if [value for value in totals if value]])
+
+        top = deltas.get(self.directories[""], [0, 0, 0, 0, 0])
+        volume.totalCount += top[2]
+        volume.totalSize  += top[3]
+        volume.storeTotals(report = False)
+
+        for parentPath in parents:
+            try:
+                self.mtimes[parentPath] = \
+                    os.lstat(self.diskPath(parentPath)).st_mtime
+            except OSError:
+                pass
+
+        print "Volume %s: %d paths changed; %d entries, %d bytes in all" % \
+            (volume.name, len(paths), volume.totalCount, volume.totalSize)
+        sys.stdout.flush()
+
+    def storedDelta(self, stored):
+        """What the stored entry STORED adds to its parent's totals."""
+        (id, kind, size, totalCount, totalSize, totalLinkedSize) = stored
+        if kind == PLAIN_FILE:
+            return (1, size or 0, 1, size or 0, 0)
+        elif kind in (DIRECTORY, PACKAGE):
+            return (0, 0, totalCount or 0, totalSize or 0,
+                    totalLinkedSize or 0)
+        elif kind == ARCHIVE:
+            return (0, 0, totalCount or 0, totalSize or 0, 0)
+        return (0, 0, 0, 0, 0)
+
+    def insert(self, parentId, volumePath):
+        """Store the new entry at VOLUMEPATH, and everything beneath it.
+        Returns what it adds to its parent's totals."""
+        parent = Entry()
+        parent.id = parentId
+        path  = self.diskPath(volumePath)
+        entry = createEntry(self.volume, parent, path, volumePath,
+                            basename(volumePath))
+        entry.readInfo()
+        xattrs = readXattrs(path)
+
+        if entry.isDirectory() or entry.isPackage():
+            entry.store()
+            if xattrs:
+                storeXattrs(entry, xattrs)
+
+            directories = [entry]
+            WatchWalker(self.volume, entry, directories).run()
+            for directory in directories:
+                self.watch(directory.volumePath, directory.id,
+                           directory.parentId)
+
+            attrs = entry.attrs
+            return (0, 0, attrs.totalCount, attrs.totalSize,
+                    attrs.totalLinkedSize)
+
+        if entry.isArchive():
+            scanArchive(entry)
+        elif entry.isPlainFile():
+            hashFile(entry)
+        else:
+            entry.store()
+        if xattrs:
+            storeXattrs(entry, xattrs)
+
+        if entry.isArchive():
+            return (0, 0, entry.getCount(), entry.getSize(), 0)
+        elif entry.isPlainFile():
+            return (1, entry.getSize(), 1, entry.getSize(), 0)
+        return (0, 0, 0, 0, 0)
+
+    def update(self, stored, volumePath, info, mask):
+        """Update the stored entry STORED from INFO, its new lstat().  MASK
+        holds the events that were seen for it.  Returns the change in what
+        it adds to its parent's totals."""
+        (id, kind, size) = stored[:3]
+        c = conn.cursor()
+        doquery(c, """
+          UPDATE "entryRows" SET "permissions" = ?, "owner" = ?, "group" = ?,
+                                 "dataModified" = ?, "attrsModified" = ?,
+                                 "dataAccessed" = ?
+           WHERE "id" = ?""",
+                (info[ST_MODE], info[ST_UID], info[ST_GID],
+                 fromTicks(info.st_mtime), fromTicks(info.st_ctime),
+                 fromTicks(info.st_atime), id))
+
+        path  = self.diskPath(volumePath)
+        entry = Entry(self.volume, None, path, volumePath, basename(volumePath))
+        entry.id   = id
+        entry.kind = kind
+
+        if mask & inotify.IN_ATTRIB:
+            doquery(c, """DELETE FROM "metadata" WHERE "entryId" = ?""", (id,))
+            xattrs = readXattrs(path)
+            if xattrs:
+                storeXattrs(entry, xattrs)
+
+        delta = (0, 0, 0, 0, 0)
+        if kind == PLAIN_FILE:
+            newSize = long(info[ST_SIZE])
+            if mask & CONTENT_EVENTS:
+                doquery(c, """
+                  SELECT "checksum" IS NOT NULL, "fingerprint" IS NOT NULL
+                    FROM "fileAttrs" WHERE "entryId" = ?""", (id,))
+                (hadChecksum, hadFingerprint) = c.fetchone() or (False, False)
+
+                checksum = None
+                if hadChecksum or opts.readChecksums:
+                    checksum = fileChecksum(path)
+                fingerprint = None
+                if hadFingerprint or opts.readFingerprints:
+                    fingerprint = fileFingerprint(path, newSize)
+
+                doquery(c, """
+                  UPDATE "fileAttrs" SET "size" = ?, "checksum" = ?,
+                                         "checksumType" = ?, "fingerprint" = ?
+                   WHERE "entryId" = ?""",
+                        (newSize,) + splitChecksum(checksum) +
+                        (fingerprint, id))
+            else:
+                doquery(c, """
+                  UPDATE "fileAttrs" SET "size" = ? WHERE "entryId" = ?""",
+                        (newSize, id))
+            delta = (0, newSize - (size or 0), 0, newSize - (size or 0), 0)
+
+        elif kind == SYMBOLIC_LINK:
+            doquery(c, """
+              UPDATE "linkAttrs" SET "targetPath" = ?, "targetId" = NULL
+               WHERE "entryId" = ?""", (os.readlink(path), id))
+            self.links.append((id, volumePath))
+
+        return delta
+
+    def resolveLinks(self, firstId):
+        """Find the targets of the symbolic links stored in this batch,
+        whose ids are FIRSTID or above, and of those changed in place, by
+        looking up the path of each target."""
+        c = conn.cursor()
+        doquery(c, """
+          SELECT l."id", e."volumePath", l."targetPath"
+            FROM "linkAttrs" AS l, "entryRows" AS e
+           WHERE e."id" = l."entryId" AND e."id" >= ? AND e."volumeId" = ?
+             AND l."targetId" IS NULL AND l."targetPath" IS NOT NULL""",
+                (firstId, self.volume.id))
+        links = c.fetchall()
+        for (id, volumePath) in self.links:
+            doquery(c, """SELECT "id", ?, "targetPath" FROM "linkAttrs"
+                         WHERE "entryId" = ?""", (volumePath, id))
+            links.extend(c.fetchall())
+
+        resolved = []
+        for (id, volumePath, text) in links:
+            if isinstance(volumePath, unicode):
+                volumePath = volumePath.encode("utf-8")
+            if isinstance(text, unicode):
+                text = text.encode("utf-8")
+            target = self.volume.linkTarget(volumePath, text)
+            if target is not None:
+                targetId = self.resolve(target)
+                if targetId is not None:
+                    resolved.append((targetId, id))
+
+        doquerymany(c, """UPDATE "linkAttrs" SET "targetId" = ? WHERE "id" = ?""",
+                    resolved)
+
+########################################################################
+
+def findDirectory(spec):
+    """Find the directory named by SPEC, "VOLUME" or "VOLUME:PATH"."""
+    if ":" in spec:
+        (name, path) = spec.split(":", 1)
+    else:
+        (name, path) = (spec, "")
+
+    vol = findVolumeByName(name)
+    if not vol:
+        print "There is no volume named '%s'" % name
+        sys.exit(1)
+
+    entry = findEntryByVolumePath(vol, normpath("/" + path.strip("/"))[1:])
+    if not entry or entry.kind not in (DIRECTORY, PACKAGE, ARCHIVE):
+        print "There is no directory '%s' on volume '%s'" % (path, name)
+        sys.exit(1)
+
+    return entry
+
+def childUsage(entryId, directoriesOnly):
+    """Return (name, kind, totalCount, totalSize, id) for each child of the
+    entry ENTRYID, largest first.  Files count as one entry of their own
+    size."""
+    kinds = ""
+    if directoriesOnly:
+        kinds = """AND e."kind" IN (%d, %d, %d)""" % (DIRECTORY, PACKAGE, ARCHIVE)
+
+    c = conn.cursor()
+    doquery(c, """
+      SELECT e."name", e."kind", COALESCE(d."totalCount", 1),
+             COALESCE(d."totalSize", f."size", 0), e."id"
+        FROM "entryRows" AS e
+        LEFT JOIN "dirAttrs" AS d ON d."entryId" = e."id"
+        LEFT JOIN "fileAttrs" AS f ON f."entryId" = e."id"
+       WHERE e."directoryId" = ? %s""" % kinds, (entryId,))
+
+    children = c.fetchall()
+    children.sort(key = lambda child: -child[3])
+    return children
+
+def reportLargestDirectories(limit):
+    """Print the LIMIT largest directories of all volumes."""
+    c = conn.cursor()
+    doquery(c, """
+      SELECT d."totalSize", d."totalCount", v."name", e."volumePath"
+        FROM "dirAttrs" AS d, "entryRows" AS e, "volumes" AS v
+       WHERE e."id" = d."entryId" AND v."id" = e."volumeId"
+         AND e."kind" IN (?, ?) AND e."directoryId" <> -1
+       ORDER BY d."totalSize" DESC LIMIT %d""" % limit,
+            (DIRECTORY, PACKAGE))
+
+    for (totalSize, totalCount, volumeName, volumePath) in c.fetchall():
+        print "%14d %9d  %s => %s" % (totalSize, totalCount, volumeName,
+                                      volumePath)
+
+def reportDirectoryTree(spec, depth, limit):
+    """Print the sizes of the directory named by SPEC, and of the LIMIT
+    largest directories beneath it on each level, DEPTH levels deep."""
+    entry = findDirectory(spec)
+
+    c = conn.cursor()
+    doquery(c, """SELECT "totalCount", "totalSize" FROM "dirAttrs"
+                 WHERE "entryId" = ?""", (entry.id,))
+    (totalCount, totalSize) = c.fetchone()
+
+    stack = [(entry.id, entry.volumePath or ".", totalCount, totalSize, 0)]
+    while stack:
+        (id, path, totalCount, totalSize, level) = stack.pop()
+        print "%14d %9d  %s%s" % (totalSize, totalCount, "  " * level, path)
+
+        if level < depth:
+            children = childUsage(id, True)[:limit]
+            children.reverse()
+            for (name, kind, count, size, childId) in children:
+                stack.append((childId, name, count, size, level + 1))
+
+def reportComparison(specs, limit):
+    """Print the sizes of the children of each directory named in SPECS side
+    by side, by name, largest first."""
+    sizes = {}
+    for i in range(len(specs)):
+        for (name, kind, count, size, id) in \
+                childUsage(findDirectory(specs[i]).id, False):
+            if name not in sizes:
+                sizes[name] = [None] * len(specs)
+            sizes[name][i] = size
+
+    names = sizes.keys()
+    names.sort(key = lambda name: -max(sizes[name]))
+
+    print " ".join(["%14s" % spec[-14:] for spec in specs]), " name"
+    for name in names[:limit]:
+        print " ".join([size is None and "%14s" % "-" or "%14d" % size
+                        for size in sizes[name]]), "", name
+
+def fingerprintedCopies(fingerprint):
+    """Return (entryId, volume name, volume path, size, checksum,
+    linkGroupId) for each file with FINGERPRINT."""
+    c = conn.cursor()
+    doquery(c, """
+      SELECT e."id", v."name", e."volumePath", f."size", f."checksum",
+             f."linkGroupId"
+        FROM "fileAttrs" AS f, "entryRows" AS e, "volumes" AS v
+       WHERE f."fingerprint" = ? AND e."id" = f."entryId"
+         AND v."id" = e."volumeId"
+       ORDER BY v."name", e."volumePath" """, (fingerprint,))
+    return c.fetchall()
+
+def checksumCopies(checksum, checksumType, size):
+    """Return (entryId, volume name, volume path) for each file of SIZE
+    bytes whose checksum by CHECKSUMTYPE is CHECKSUM."""
+    c = conn.cursor()
+    doquery(c, """
+      SELECT e."id", v."name", e."volumePath"
+        FROM "fileAttrs" AS f, "entryRows" AS e, "volumes" AS v
+       WHERE f."checksum" = ? AND f."checksumType" = ? AND f."size" = ?
+         AND e."id" = f."entryId" AND v."id" = e."volumeId"
+       ORDER BY v."name", e."volumePath" """, (checksum, checksumType, size))
+    return c.fetchall()
+
+def haveChecksums(checksumType, size):
+    """True if any file of SIZE bytes has a checksum by CHECKSUMTYPE."""
+    c = conn.cursor()
+    doquery(c, """
+      SELECT 1 FROM "fileAttrs" WHERE "size" = ? AND "checksumType" = ?
+       LIMIT 1""", (size, checksumType))
+    return c.fetchone() is not None
+
+def reportCopies(spec):
+    """Print the catalogued copies of the file named by SPEC, either a path
+    on disk or "VOLUME:PATH".  Files with the same fingerprint are
+    candidates; those the fingerprint does not cover whole are compared by
+    checksum where one is known, and marked unverified where not.  Files
+    with the same size and checksum are copies too, which finds archive
+    members by the CRC their archive gives (marked as such, a CRC being
+    weaker evidence); a file on disk is read in full for its CRC, but only
+    if some archive member has its size."""
+    if os.path.isfile(spec):
+        size = os.path.getsize(spec)
+        fingerprint = fileFingerprint(spec, size)
+        (checksum, checksumType) = (None, None)
+        selfId = None
+    else:
+        if ":" in spec:
+            (name, path) = spec.split(":", 1)
+        else:
+            (name, path) = (spec, "")
+
+        vol = findVolumeByName(name)
+        if not vol:
+            print "There is no file '%s', nor a volume named '%s'" % (spec, name)
+            sys.exit(1)
+
+        c = conn.cursor()
+        doquery(c, """
+          SELECT e."id", f."size", f."fingerprint", f."checksum",
+                 f."checksumType"
+            FROM "entryRows" AS e, "fileAttrs" AS f
+           WHERE e."volumeId" = ? AND e."volumePath" = ?
+             AND f."entryId" = e."id" """,
+                (vol.id, normpath("/" + path.strip("/"))[1:]))
+        data = c.fetchone()
+        if not data:
+            print "There is no file '%s' on volume '%s'" % (path, name)
+            sys.exit(1)
+
+        (selfId, size, fingerprint, checksum, checksumType) = data
+        if not fingerprint and not checksum:
+            print "'%s' was indexed with neither --fingerprint nor --checksum" \
+                % spec
+            sys.exit(1)
+
+    reported = set([selfId])
+    def report(id, volumeName, volumePath, note = None):
+        if id not in reported:
+            reported.add(id)
+            if note:
+                print volumeName, "=>", volumePath, "(%s)" % note
+            else:
+                print volumeName, "=>", volumePath
+
+    if fingerprint:
+        for (id, volumeName, volumePath, otherSize, otherChecksum,
+             linkGroup) in fingerprintedCopies(fingerprint):
+            if fingerprintIsWhole(size):
+                report(id, volumeName, volumePath)
+                continue
+
+            if otherChecksum and checksum is None and selfId is None:
+                (checksum, checksumType) = (fileChecksum(spec), "md5")
+
+            if otherChecksum and checksumType == "md5":
+                if otherChecksum == checksum:
+                    report(id, volumeName, volumePath)
+            else:
+                report(id, volumeName, volumePath, "unverified")
+
+    probes = []
+    if checksum:
+        probes.append((checksum, checksumType))
+    if selfId is None and haveChecksums("crc32", size):
+        probes.append((fileCrc32(spec), "crc32"))
+
+    for (value, algorithm) in probes:
+        note = None
+        if algorithm != "md5":
+            note = algorithm
+        for (id, volumeName, volumePath) in \
+                checksumCopies(value, algorithm, size):
+            report(id, volumeName, volumePath, note)
+
+def reportDuplicates(limit):
+    """Print the LIMIT sets of copies that waste the most space.  Files are
+    grouped by fingerprint, and the groups the fingerprint does not cover
+    whole are split by checksum.  Files in such a group without a checksum
+    are marked unverified.  Archive members, which have no fingerprint, are
+    grouped by size and the CRC their archive gives."""
+    c = conn.cursor()
+    doquery(c, """
+      SELECT f."fingerprint", f."size", f."checksum", f."linkGroupId",
+             v."name", e."volumePath"
+        FROM "fileAttrs" AS f, "entryRows" AS e, "volumes" AS v
+       WHERE f."fingerprint" IN
+             (SELECT "fingerprint" FROM "fileAttrs"
+               WHERE "fingerprint" IS NOT NULL
+               GROUP BY "fingerprint"
+              HAVING COUNT(DISTINCT COALESCE("linkGroupId", -"entryId")) > 1)
+         AND e."id" = f."entryId" AND v."id" = e."volumeId"
+       ORDER BY f."fingerprint", v."name", e."volumePath" """, ())
+
+    groups = {}
+    for (fingerprint, size, checksum, linkGroup, volumeName, volumePath) in \
+            c.fetchall():
+        groups.setdefault(fingerprint, []).append(
+            (size, checksum, linkGroup, volumeName, volumePath))
+
+    sets = []
+    for files in groups.values():
+        size = files[0][0]
+        if fingerprintIsWhole(size):
+            sets.append((size, files, [], None))
+            continue
+
+        byChecksum = {}
+        unverified = []
+        for file in files:
+            if file[1]:
+                byChecksum.setdefault(file[1], []).append(file)
+            else:
+                unverified.append(file)
+
+        if len(byChecksum) == 1:
+            sets.append((size, byChecksum.values()[0], unverified, None))
+        else:
+            for copies in byChecksum.values():
+                sets.append((size, copies, [], None))
+            sets.append((size, [], unverified, None))
+
+    doquery(c, """
+      SELECT f."checksumType", f."checksum", f."size", f."linkGroupId",
+             v."name", e."volumePath"
+        FROM "fileAttrs" AS f
+        JOIN (SELECT "checksumType", "checksum", "size" FROM "fileAttrs"
+               WHERE "checksumType" <> 'md5' AND "fingerprint" IS NULL
+               GROUP BY "checksumType", "checksum", "size"
+              HAVING COUNT(*) > 1) AS d
+          ON d."checksumType" = f."checksumType"
+         AND d."checksum" = f."checksum" AND d."size" = f."size"
+        JOIN "entryRows" AS e ON e."id" = f."entryId"
+        JOIN "volumes" AS v ON v."id" = e."volumeId"
+       ORDER BY v."name", e."volumePath" """, ())
+
+    groups = {}
+    for (checksumType, checksum, size, linkGroup, volumeName, volumePath) in \
+            c.fetchall():
+        groups.setdefault((checksumType, checksum, size), []).append(
+            (size, checksum, linkGroup, volumeName, volumePath))
+    for ((checksumType, checksum, size), files) in groups.items():
+        sets.append((size, files, [], checksumType))
+
+    # Further links to the same data take no more space, so only sets
+    # holding the data more than once are reported (and no empty files)
+    def wasted(copySet):
+        (size, copies, unverified, note) = copySet
+        data = {}
+        for (size, checksum, linkGroup, volumeName, volumePath) in \
+                copies + unverified:
+            data[linkGroup or (volumeName, volumePath)] = True
+        return size * (len(data) - 1)
+
+    sets = [(wasted(copySet), copySet) for copySet in sets]
+    sets = [item for item in sets if item[0] > 0]
+    sets.sort(key = lambda item: -item[0])
+
+    for (waste, (size, copies, unverified, note)) in sets[:limit]:
+        if note:
+            print "%14d %5d copies (%s)" % (size, len(copies) + len(unverified),
+                                            note)
+        else:
+            print "%14d %5d copies" % (size, len(copies) + len(unverified))
+        for file in copies:
+            print "  %s => %s" % (file[3], file[4])
+        for file in unverified:
+            print "  %s => %s (unverified)" % (file[3], file[4])
 
 def findVolumeByName(name):
     c = conn.cursor()
@@ -1343,14 +4784,201 @@ def findVolumeByName(name):
 
 ########################################################################
 
+# SEARCH SERVER
+#
+# "catalog serve" answers searches over a Unix socket, keeping the database
+# connection and everything cached along with it (SQLite's prepared
+# statements, interned extensions, compiled regular expressions) from one
+# search to the next.  Each request is one line of tab-separated fields: the
+# search ("name", "path", "ext" or "tag"), optionally preceded by "-r" for a
+# regular expression search, followed by its patterns.  The reply is a line
+#
+#   R <volume name> TAB <volume path> TAB <checksum>
+#
+# for each entry found, ending with "OK <count>", or "ERR <message>" if the
+# search failed.  Tabs, newlines and backslashes in fields are escaped with
+# backslashes.  A client may send any number of requests over one connection.
+
+searchCommands = ("name", "path", "ext", "tag")
+
+def search(command, patterns, regex, reporter):
+    """Run the search COMMAND, one of searchCommands, for PATTERNS, passing
+    each entry found to REPORTER.  Raises re.error if REGEX is set and a
+    pattern is not a valid regular expression."""
+    if command == "tag":
+        return findEntriesByTags(patterns, reporter)
+
+    entries = []
+    for pattern in patterns:
+        if command == "name" and regex:
+            entries.extend(findEntriesByRegex("name", pattern, reporter))
+        elif command == "name":
+            entries.extend(findEntriesByName(pattern, reporter))
+        elif command == "path" and regex:
+            entries.extend(findEntriesByRegex("volumePath", pattern, reporter))
+        elif command == "path":
+            entries.extend(findEntriesByPath(pattern, reporter))
+        elif command == "ext":
+            entries.extend(findEntriesByExtension(pattern, reporter))
+    return entries
+
+def escapeField(text):
+    return text.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+def unescapeField(text):
+    return re.sub(r"\\(.)", lambda match: {"t": "\t", "n": "\n"}
+                  .get(match.group(1), match.group(1)), text)
+
+def socketPath():
+    if opts.socketPath:
+        return opts.socketPath
+    elif opts.databaseName:
+        return "/tmp/catalog-%s.sock" % opts.databaseName
+    else:
+        return opts.databaseFile + ".sock"
+
+class SearchHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            self.answer(line.rstrip("\n"))
+            self.wfile.flush()
+
+    def answer(self, line):
+        def reply(entry):
+            self.wfile.write("R %s\n" % "\t".join(
+                [escapeField(field or u"").encode("utf-8") for field in
+                 (entry.volume.name, entry.volumePath, entry.getChecksum())]))
+
+        try:
+            fields = [unescapeField(field.decode("utf-8"))
+                      for field in line.split("\t")]
+        except UnicodeDecodeError:
+            self.wfile.write("ERR requests must be UTF-8\n")
+            return
+
+        regex = fields[0] == "-r"
+        if regex:
+            fields = fields[1:]
+
+        if not fields or fields[0] not in searchCommands or len(fields) < 2:
+            self.wfile.write("ERR usage: [-r] name|path|ext|tag PATTERN...\n")
+            return
+
+        try:
+            entries = search(fields[0], fields[1:], regex, reply)
+            self.wfile.write("OK %d\n" % len(entries))
+        except re.error, msg:
+            self.wfile.write("ERR bad regular expression: %s\n" % msg)
+        except Exception, msg:
+            conn.rollback()
+            self.wfile.write("ERR %s\n" %
+                             escapeField(unicode(msg)).encode("utf-8"))
+
+def serve():
+    """Answer searches on socketPath() until interrupted."""
+    path = socketPath()
+    if lexists(path):
+        if not S_ISSOCK(os.lstat(path)[ST_MODE]):
+            print "%s exists and is not a socket; not serving on it" % path
+            sys.exit(1)
+
+        # A socket left behind by a server that is no longer running
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            print "catalog serve is already running on", path
+            sys.exit(1)
+        except socket.error:
+            os.unlink(path)
+        finally:
+            probe.close()
+
+    oldMask = os.umask(0077)
+    try:
+        server = SocketServer.UnixStreamServer(path, SearchHandler)
+    finally:
+        os.umask(oldMask)
+
+    # Stopping the server with kill removes the socket too
+    import signal
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    print "Serving searches on", path
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+def runClient(args):
+    """Send the search in ARGS to a running "catalog serve", printing the
+    entries found as the search itself would.  Returns the exit status."""
+    if not args or args[0] not in searchCommands or len(args) < 2:
+        print "usage: catalog --client [-r] name|path|ext|tag <PATTERN...>"
+        return 1
+
+    path   = socketPath()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error, msg:
+        print "catalog: cannot reach catalog serve on %s: %s" % (path, msg)
+        return 1
+
+    fields = list(args)
+    if opts.regex:
+        fields.insert(0, "-r")
+    client.sendall("\t".join([escapeField(field) for field in fields]) + "\n")
+    client.shutdown(socket.SHUT_WR)
+
+    status = 1
+    for line in client.makefile("rb"):
+        line = line.rstrip("\n")
+        if line.startswith("R "):
+            (volume, volumePath, checksum) = \
+                [unescapeField(field) for field in line[2:].split("\t")]
+            if checksum:
+                print volume, "=> %s <%s>" % (volumePath, checksum)
+            else:
+                print volume, "=>", volumePath
+        elif line.startswith("OK"):
+            status = 0
+        elif line.startswith("ERR "):
+            print "catalog:", unescapeField(line[4:])
+    client.close()
+    return status
+
+########################################################################
+
 parser = optparse.OptionParser()
 
+parser.add_option('-0', '--null',
+                  action='store_true', dest='nullSeparated', default=False,
+                  help='manifest records are terminated by NUL, not newline')
 parser.add_option('-E', '--open-encrypted',
                   action='store_true', dest='openEncryptedImages', default=False,
                   help='descend into encrypted images (may ask for password)')
+parser.add_option('', '--by', metavar='GROUPS',
+                  type='string', action='store', dest='groupBy', default='ext',
+                  help='group analyze reports by volume, ext, kind and/or year')
+parser.add_option('', '--cache-size', metavar='N',
+                  type='int', action='store', dest='cacheSize', default=100000,
+                  help='cache up to N search results (0 disables the cache)')
+parser.add_option('', '--client',
+                  action='store_true', dest='client', default=False,
+                  help='send the search to a running "catalog serve"')
 parser.add_option('-C', '--checksum',
                   action='store_true', dest='readChecksums', default=False,
                   help='calculate MD5 checksum of cataloged files (where possible)')
+parser.add_option('', '--depth', metavar='N',
+                  type='int', action='store', dest='depth', default=1,
+                  help='levels of directories shown by du')
 parser.add_option('-d', '--database', metavar='DATABASE',
                   type='string', action='store', dest='databaseName',
                   help='name of the PostgreSQL database where data is stored')
@@ -1358,6 +4986,18 @@ parser.add_option('-f', '--file', metavar='FILE',
                   type='string', action='store', dest='databaseFile',
                   default=os.path.expanduser('~/.catalogdb'),
                   help='SQLite3 filen where data is stored')
+parser.add_option('-F', '--fingerprint',
+                  action='store_true', dest='readFingerprints', default=False,
+                  help='fingerprint cataloged files, to find copies quickly')
+parser.add_option('-j', '--jobs', metavar='N',
+                  type='int', action='store', dest='jobs', default=2,
+                  help='threads for listing archives and computing checksums')
+parser.add_option('', '--batch-size', metavar='N',
+                  type='int', action='store', dest='batchSize', default=1000,
+                  help='rows written per database transaction while indexing')
+parser.add_option('', '--writers', metavar='N',
+                  type='int', action='store', dest='writers', default=1,
+                  help='PostgreSQL connections writing rows while indexing')
 parser.add_option('-k', '--kind', metavar='KIND',
                   type='string', action='store', dest='volumeKind',
                   help='kind of the volume being indexed')
@@ -1370,84 +5010,308 @@ parser.add_option('-p', '--pass', metavar='PASS',
 parser.add_option('-P', '--port', metavar='PORT',
                   type='string', action='store', dest='databasePort',
                   help='PostgreSQL port', default="5432")
+parser.add_option('', '--limit', metavar='N',
+                  type='int', action='store', dest='limit', default=20,
+                  help='number of rows in analyze, du and dups reports')
+parser.add_option('', '--no-xattrs',
+                  action='store_false', dest='readXattrs', default=True,
+                  help='do not catalog extended attributes and tags')
+parser.add_option('', '--profile', metavar='FILE',
+                  type='string', action='store', dest='profileFile',
+                  help='write cProfile statistics for an index run to FILE')
+parser.add_option('', '--progress', metavar='SECONDS',
+                  type='int', action='store', dest='progressInterval',
+                  default=10, help='seconds between progress reports (0: none)')
+parser.add_option('-r', '--regex',
+                  action='store_true', dest='regex', default=False,
+                  help='name and path patterns are regular expressions')
+parser.add_option('', '--resume',
+                  action='store_true', dest='resume', default=False,
+                  help='continue an interrupted index run instead of starting over')
+parser.add_option('', '--socket', metavar='PATH',
+                  type='string', action='store', dest='socketPath', default=None,
+                  help='Unix socket for "catalog serve" (default: FILE.sock)')
+parser.add_option('', '--stats-json', metavar='FILE',
+                  type='string', action='store', dest='statsJson',
+                  help='write timings and counters for an index run to FILE')
 parser.add_option('-u', '--user', metavar='USER',
                   type='string', action='store', dest='databaseUser',
                   help='name of the PostgreSQL user to connect as')
 parser.add_option('-v', '--verbose',
                   action='store_true', dest='verbose', default=False,
                   help='report activity options.verbosely')
+parser.add_option('', '--volume-list', metavar='FILE',
+                  type='string', action='store', dest='volumeList',
+                  help='index the volumes listed in FILE ("-" for stdin)')
 
-(opts, args) = parser.parse_args()
+def connect():
+    if opts.databaseName:
+        from pyPgSQL import PgSQL
+        c = PgSQL.connect(":%s:%s:%s:%s" % (opts.databasePort, opts.databaseName,
+                                            opts.databaseUser, opts.databasePass))
+        if c:
+            c.cursor().execute("SET CLIENT_ENCODING TO 'UTF8'")
+        return c
+    else:
+        import sqlite3
+        c = sqlite3.connect(opts.databaseFile)
+        c.create_function("regexp", 2, regexpMatch)
+        return c
 
-if opts.databaseName:
-    from pyPgSQL import PgSQL
-    import mx.DateTime
-    conn = PgSQL.connect(":%s:%s:%s:%s" % (opts.databasePort, opts.databaseName,
-                                           opts.databaseUser, opts.databasePass))
-    if not conn:
-        print "Could not connect to PostgreSQL database '%s' as '%s'" \
-            % (opts.databaseName, opts.databaseUser)
-        sys.exit(1)
-else:
-    import sqlite3
-    import datetime
-    conn = sqlite3.connect(opts.databaseFile)
-    if not conn:
-        print "Could not connect to SQLite3 database '%s'" % opts.databaseFile
-        sys.exit(1)
+def openDatabase():
+    global conn
 
-try:
-    cursor = conn.cursor()
     if opts.databaseName:
-        cursor.execute("SET CLIENT_ENCODING TO 'UTF8'")
+        conn = connect()
+        if not conn:
+            print "Could not connect to PostgreSQL database '%s' as '%s'" \
+                % (opts.databaseName, opts.databaseUser)
+            sys.exit(1)
+    else:
+        conn = connect()
+        if not conn:
+            print "Could not connect to SQLite3 database '%s'" % opts.databaseFile
+            sys.exit(1)
 
-    initDatabase()
+def main():
+    try:
+        initDatabase()
 
-    command = args[0]
+        command = args[0]
 
-    def print_result(entry):
-        csum = entry.getChecksum()
-        if csum:
-            print entry.volume.name, "=> %s <%s>" % (entry.volumePath, csum)
-        else:
-            print entry.volume.name, "=>", entry.volumePath
-        sys.stdout.flush()
+        def print_result(entry):
+            csum = entry.getChecksum()
+            if csum:
+                print entry.volume.name, "=> %s <%s>" % (entry.volumePath, csum)
+            else:
+                print entry.volume.name, "=>", entry.volumePath
+            sys.stdout.flush()
+
+        if command in searchCommands:
+            if len(args) == 1:
+                if command == "ext":
+                    print "usage: catalog ext <EXTENSION>"
+                elif command == "tag":
+                    print "usage: catalog tag <TAG...>"
+                else:
+                    print "usage: catalog %s <LIKE PATTERN>" % command
+                    print "       catalog -r %s <REGEX>" % command
+                sys.exit(1)
+
+            try:
+                search(command, args[1:], opts.regex, print_result)
+            except re.error, msg:
+                print "catalog: bad regular expression:", msg
+                sys.exit(1)
+
+        elif command == "serve":
+            serve()
+
+        elif command == "index":
+            specs = []
+            if opts.volumeList == "-":
+                specs = readVolumeList(sys.stdin)
+            elif opts.volumeList:
+                fd = open(opts.volumeList)
+                specs = readVolumeList(fd)
+                fd.close()
+
+            if len(args) == 2:
+                specs.append((args[1], basename(args[1]), None, None))
+            elif len(args) % 2 == 1:
+                for i in range(1, len(args), 2):
+                    specs.append((args[i], args[i + 1], None, None))
+            else:
+                specs = []
+
+            if not specs:
+                print "usage: catalog index <PATH> [NAME]"
+                print "       catalog index <PATH> <NAME> <PATH> <NAME>..."
+                print "       catalog --volume-list FILE index"
+                sys.exit(1)
+
+            volumes = []
+            for (path, name, location, kind) in specs:
+                if name in [vol.name for vol in volumes]:
+                    print "Volume %s is given more than once" % name
+                    sys.exit(1)
+
+                vol = findVolumeByName(name)
+                if not vol:
+                    vol = Volume(path, name, location or opts.volumeLocation,
+                                 kind or opts.volumeKind)
+                else:
+                    vol.path = normpath(path)
+                volumes.append(vol)
+
+            if opts.profileFile:
+                import cProfile
+                profile = cProfile.Profile()
+                try:
+                    profile.runcall(indexVolumes, volumes, opts.resume)
+                finally:
+                    writeProfile(profile, opts.profileFile)
+            else:
+                indexVolumes(volumes, opts.resume)
+
+            if opts.statsJson and len(volumes) == 1:
+                stats.writeJson(opts.statsJson, volume = vol.name,
+                                path = vol.path, totalCount = vol.totalCount,
+                                totalSize = vol.totalSize)
+            elif opts.statsJson:
+                stats.writeJson(opts.statsJson,
+                                totalCount = sum([vol.totalCount
+                                                  for vol in volumes]),
+                                totalSize = sum([vol.totalSize
+                                                 for vol in volumes]))
+
+        elif command == "watch":
+            if len(args) == 1:
+                print "usage: catalog watch <PATH> [NAME]"
+                sys.exit(1)
+
+            if not sys.platform.startswith("linux"):
+                print "catalog watch needs Linux's inotify"
+                sys.exit(1)
+
+            path = args[1]
+            if len(args) == 2:
+                name = basename(path)
+            else:
+                name = args[2]
 
-    if command == "name":
-        if len(args) == 1:
-            print "usage: catalog name <LIKE PATTERN>"
-            sys.exit(1)
+            vol = findVolumeByName(name)
+            if not vol:
+                print "Volume %s has not been indexed yet" % name
+                sys.exit(1)
+            vol.path = normpath(path)
+
+            watcher = VolumeWatcher(vol)
+            watcher.load()
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                pass
+
+        elif command == "analyze":
+            if len(args) != 2 or args[1] not in ("summary", "sizes", "top",
+                                                 "percentiles"):
+                print "usage: catalog analyze summary|sizes|top|percentiles"
+                sys.exit(1)
+
+            try:
+                import analytics
+            except ImportError:
+                print "The analyze command needs NumPy"
+                sys.exit(1)
+
+            reader = analyticsColumns()
+            try:
+                report = analytics.Analytics(reader, (PLAIN_FILE, ARCHIVE),
+                                             kindNames)
+                report.run(args[1], opts.groupBy, opts.limit)
+            except ValueError, msg:
+                print "catalog analyze:", msg
+                sys.exit(1)
+            finally:
+                reader.close()
+
+        elif command == "du":
+            if len(args) == 1:
+                reportLargestDirectories(opts.limit)
+            elif len(args) == 2:
+                reportDirectoryTree(args[1], opts.depth, opts.limit)
+            else:
+                reportComparison(args[1:], opts.limit)
+
+        elif command in ("newer-than", "modified-between"):
+            if command == "newer-than" and len(args) != 2:
+                print "usage: catalog newer-than <TIME|AGE>"
+                sys.exit(1)
+            if command == "modified-between" and len(args) != 3:
+                print "usage: catalog modified-between <TIME|AGE> <TIME|AGE>"
+                sys.exit(1)
+
+            try:
+                bounds = [parseTime(arg) for arg in args[1:]]
+            except ValueError, msg:
+                print "catalog:", msg
+                sys.exit(1)
+            if len(bounds) == 1:
+                bounds.append(None)
+            elif bounds[1] < bounds[0]:
+                bounds.reverse()
+
+            def print_modified(entry):
+                print formatTime(entry.dataModified), entry.volume.name, \
+                    "=>", entry.volumePath
+                sys.stdout.flush()
+
+            findEntriesByModified(bounds[0], bounds[1], print_modified)
+
+        elif command == "same":
+            if len(args) == 1:
+                print "usage: catalog same <FILE|VOLUME:PATH...>"
+                sys.exit(1)
+
+            for spec in args[1:]:
+                reportCopies(spec)
+
+        elif command == "dups":
+            reportDuplicates(opts.limit)
+
+        elif command == "export":
+            if len(args) == 1:
+                print "usage: catalog export <DIR> [VOLUME...]"
+                sys.exit(1)
+
+            exportEntries(args[1], args[2:])
+
+        elif command == "ingest-manifest":
+            if len(args) < 3:
+                print "usage: catalog ingest-manifest <MANIFEST> <NAME> [ROOT]"
+                sys.exit(1)
 
-        for name in args[1:]:
-            findEntriesByName(name, print_result)
+            name = args[2]
+            root = "/"
+            if len(args) > 3:
+                root = args[3]
 
-    elif command == "path":
-        if len(args) == 1:
-            print "usage: catalog path <LIKE PATTERN>"
-            sys.exit(1)
+            vol = findVolumeByName(name)
+            if not vol:
+                vol = Volume(root, name, opts.volumeLocation, opts.volumeKind)
+            else:
+                vol.path = normpath(root)
 
-        for path in args[1:]:
-            findEntriesByPath(path, print_result)
+            if args[1] == "-":
+                fd = sys.stdin
+            else:
+                fd = open(args[1], "rb")
 
-    elif command == "index":
-        if len(args) == 1:
-            print "usage: catalog index <PATH> [NAME]"
-            sys.exit(1)
+            separator = "\n"
+            if opts.nullSeparated:
+                separator = "\0"
 
-        path = args[1]
+            print "Ingesting manifest %s into volume %s" % (args[1], name)
+            vol.ingestManifest(readManifest(fd, separator))
 
-        if len(args) == 2:
-            name = basename(path)
-        else:
-            name = args[2]
+            if fd is not sys.stdin:
+                fd.close()
 
-        vol = findVolumeByName(name)
-        if not vol:
-            vol = Volume(path, name, opts.volumeLocation, opts.volumeKind)
-        else:
-            vol.path = normpath(path)
+            if opts.statsJson:
+                stats.writeJson(opts.statsJson, volume = vol.name,
+                                path = vol.path, totalCount = vol.totalCount,
+                                totalSize = vol.totalSize)
 
-        vol.scanEntries()
+    finally:
+        recordCacheUses()
+        conn.close()
 
-finally:
-    conn.close()
+if __name__ == "__main__":
+    (opts, args) = parser.parse_args()
+    if opts.client:
+        sys.exit(runClient(args))
+    openDatabase()
+    main()
+else:
+    (opts, args) = parser.parse_args([])
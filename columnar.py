@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+#
+# columnar.py -- columnar, memory-mappable exports of a catalog
+#
+# Usage:
+#
+#   catalog -f ~/.catalogdb export DIR [VOLUME ...]
+#   columnar.py DIR [--name PATTERN] [--ext EXT] [--min-size N] ...
+#
+# "catalog export" writes a volume, or the whole catalog, to DIR as a set of
+# flat files, one per column, which can be copied to a machine that has no
+# database and queried there with this script.
+#
+# EXPORT FORMAT
+#
+# Each numeric column is a raw array of native machine integers, one per
+# entry, in the file "<column>.col":
+#
+#   "id"        l   The entry's id in the catalog it was exported from
+#   "volume"    i   Index into "volumes" in meta.json
+#   "kind"      i   The entry's kind, as in catalog.py
+#   "extension" i   Index into "extensions" in meta.json, or -1 for none
+#   "size"      l   The file size, or total size for directories and archives
+#   "modified"  l   Modification time in seconds since the epoch, or NO_TIME
+#
+# Names and volume paths are kept in string heaps, "name.heap" and
+# "path.heap": UTF-8 strings, each preceded by a NUL byte, with the offset of
+# each entry's string in "name.off" and "path.off".  meta.json records the
+# entry count, the lookup tables, and the type code, item size and byte order
+# of every column, so that a reader on an incompatible machine refuses the
+# files rather than misreading them.
+#
+# QUERYING
+#
+# ColumnReader memory-maps the files, so nothing is read into memory but the
+# pages a query touches.  Names are matched by running a regular expression
+# over the whole name heap at once.  With NumPy installed, the numeric
+# filters are vectorized comparisons over the mapped columns; without it,
+# the columns are scanned a block at a time.
+
+import os
+import re
+import sys
+import mmap
+import json
+import time
+import array
+import struct
+import bisect
+import optparse
+
+from os.path import join, exists
+
+numpy = None
+try:
+    import numpy
+except ImportError:
+    pass
+
+FORMAT_VERSION = 1
+
+NO_TIME = -(2 ** 62)
+
+# Column name, and the array type code its values are stored as
+columns = (("id",        "l"),
+           ("volume",    "i"),
+           ("kind",      "i"),
+           ("extension", "i"),
+           ("size",      "l"),
+           ("modified",  "l"),
+           ("name.off",  "l"),
+           ("path.off",  "l"))
+
+heaps = ("name", "path")
+
+BLOCK_ITEMS = 65536
+
+########################################################################
+
+class ColumnWriter(object):
+    """Writes entries, one add() at a time, to an export in DIRNAME.  Any
+    keyword arguments are recorded in its meta.json."""
+
+    def __init__(self, dirName, **extra):
+        if not exists(dirName):
+            os.makedirs(dirName)
+
+        self.dirName    = dirName
+        self.extra      = extra
+        self.count      = 0
+        self.volumes    = []
+        self.volumeIds  = {}
+        self.extensions = []
+        self.extIds     = {}
+
+        self.files   = {}
+        self.buffers = {}
+        for (name, typecode) in columns:
+            self.files[name]   = open(self.columnFile(name), "wb")
+            self.buffers[name] = array.array(typecode)
+
+        self.heapSizes = {}
+        for name in heaps:
+            self.files[name + ".heap"] = open(join(dirName, name + ".heap"), "wb")
+            self.heapSizes[name] = 0
+
+    def columnFile(self, name):
+        if name.endswith(".off"):
+            return join(self.dirName, name)
+        return join(self.dirName, name + ".col")
+
+    def intern(self, value, values, ids):
+        if value is None:
+            return -1
+        id = ids.get(value)
+        if id is None:
+            id = ids[value] = len(values)
+            values.append(value)
+        return id
+
+    def addString(self, heap, value):
+        if value is None:
+            value = ""
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+
+        offset = self.heapSizes[heap] + 1
+        self.files[heap + ".heap"].write("\0" + value)
+        self.heapSizes[heap] = offset + len(value)
+        self.buffers[heap + ".off"].append(offset)
+
+    def add(self, id, volume, name, extension, kind, size, modified,
+            volumePath):
+        """Add an entry.  VOLUME and EXTENSION are strings; MODIFIED is in
+        seconds since the epoch, or None."""
+        buffers = self.buffers
+        buffers["id"].append(id)
+        buffers["volume"].append(self.intern(volume, self.volumes,
+                                             self.volumeIds))
+        buffers["kind"].append(kind)
+        buffers["extension"].append(self.intern(extension, self.extensions,
+                                                self.extIds))
+        buffers["size"].append(size or 0)
+        if modified is None:
+            buffers["modified"].append(NO_TIME)
+        else:
+            buffers["modified"].append(int(modified))
+
+        self.addString("name", name)
+        self.addString("path", volumePath)
+
+        self.count += 1
+        if self.count % BLOCK_ITEMS == 0:
+            self.flush()
+
+    def flush(self):
+        for (name, typecode) in columns:
+            self.buffers[name].tofile(self.files[name])
+            self.buffers[name] = array.array(typecode)
+
+    def close(self):
+        self.flush()
+        for fd in self.files.values():
+            fd.close()
+
+        meta = { "version":    FORMAT_VERSION,
+                 "count":      self.count,
+                 "byteorder":  sys.byteorder,
+                 "volumes":    self.volumes,
+                 "extensions": self.extensions,
+                 "columns":    {} }
+        meta.update(self.extra)
+        for (name, typecode) in columns:
+            meta["columns"][name] = { "typecode": typecode,
+                                      "itemsize": array.array(typecode).itemsize }
+
+        fd = open(join(self.dirName, "meta.json"), "w")
+        json.dump(meta, fd, indent = 2, sort_keys = True)
+        fd.write("\n")
+        fd.close()
+
+########################################################################
+
+class MappedColumn(object):
+    """A memory-mapped column read without NumPy: single items are unpacked
+    where they lie, and blocks() yields the column as arrays of at most
+    BLOCK_ITEMS items."""
+
+    def __init__(self, data, typecode, count):
+        self.data     = data
+        self.typecode = typecode
+        self.format   = "@" + typecode
+        self.itemsize = struct.calcsize(self.format)
+        self.count    = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return struct.unpack_from(self.format, self.data,
+                                  index * self.itemsize)[0]
+
+    def blocks(self):
+        for start in xrange(0, self.count, BLOCK_ITEMS):
+            stop  = min(start + BLOCK_ITEMS, self.count)
+            block = array.array(self.typecode)
+            block.fromstring(self.data[start * self.itemsize:
+                                       stop * self.itemsize])
+            yield (start, block)
+
+def globPattern(pattern):
+    """Translate a "catalog name" pattern, in which '*' or '%' matches any
+    run of characters and '?' any one, into a regular expression matching
+    whole strings of a heap.  Like SQLite's LIKE, it ignores case."""
+    parts = []
+    for char in pattern:
+        if char in "*%":
+            parts.append("[^\\x00]*")
+        elif char == "?":
+            parts.append("[^\\x00]")
+        else:
+            parts.append(re.escape(char))
+    return re.compile("(?<=\\x00)%s(?=\\x00|\\Z)" % "".join(parts),
+                      re.IGNORECASE)
+
+class ColumnReader(object):
+    """Queries an export made by ColumnWriter, in DIRNAME."""
+
+    def __init__(self, dirName, useNumPy = True):
+        fd = open(join(dirName, "meta.json"))
+        self.meta = json.load(fd)
+        fd.close()
+
+        if self.meta["version"] != FORMAT_VERSION:
+            raise ValueError("%s: unsupported export format %s" %
+                             (dirName, self.meta["version"]))
+        if self.meta["byteorder"] != sys.byteorder:
+            raise ValueError("%s: exported on a %s-endian machine" %
+                             (dirName, self.meta["byteorder"]))
+
+        self.dirName    = dirName
+        self.count      = self.meta["count"]
+        self.volumes    = self.meta["volumes"]
+        self.extensions = self.meta["extensions"]
+        self.numpy      = useNumPy and numpy
+
+        self.maps    = []
+        self.columns = {}
+        for (name, typecode) in columns:
+            itemsize = self.meta["columns"][name]["itemsize"]
+            if array.array(typecode).itemsize != itemsize:
+                raise ValueError("%s: column %s has %d-byte items" %
+                                 (dirName, name, itemsize))
+
+            fileName = name.endswith(".off") and name or name + ".col"
+            data = self.map(join(dirName, fileName))
+            if self.numpy:
+                self.columns[name] = numpy.frombuffer(
+                    data, dtype = numpy.dtype(typecode), count = self.count)
+            else:
+                self.columns[name] = MappedColumn(data, typecode, self.count)
+
+        self.heaps = {}
+        for name in heaps:
+            self.heaps[name] = self.map(join(dirName, name + ".heap"))
+
+    def map(self, fileName):
+        fd = open(fileName, "rb")
+        try:
+            if os.fstat(fd.fileno()).st_size == 0:
+                return ""
+            data = mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            fd.close()
+        self.maps.append(data)
+        return data
+
+    def close(self):
+        self.columns = {}
+        self.heaps   = {}
+        for data in self.maps:
+            data.close()
+        self.maps = []
+
+    def string(self, heap, index):
+        data  = self.heaps[heap]
+        start = int(self.columns[heap + ".off"][index])
+        end   = data.find("\0", start)
+        if end < 0:
+            end = len(data)
+        return data[start:end].decode("utf-8")
+
+    def row(self, index):
+        extension = int(self.columns["extension"][index])
+        modified  = int(self.columns["modified"][index])
+        return { "id":        int(self.columns["id"][index]),
+                 "volume":    self.volumes[int(self.columns["volume"][index])],
+                 "kind":      int(self.columns["kind"][index]),
+                 "extension": extension >= 0 and self.extensions[extension] or None,
+                 "size":      int(self.columns["size"][index]),
+                 "modified":  modified != NO_TIME and modified or None,
+                 "name":      self.string("name", index),
+                 "path":      self.string("path", index) }
+
+    def matchNames(self, pattern):
+        """Return the indices of the entries whose name matches PATTERN, in
+        order."""
+        offsets = self.columns["name.off"]
+        starts  = [match.start() for match in
+                   globPattern(pattern).finditer(self.heaps["name"])]
+        if self.numpy:
+            return numpy.searchsorted(offsets, starts, side = "right") - 1
+        return [bisect.bisect_right(offsets, start) - 1 for start in starts]
+
+    def conditions(self, volume, extension, minSize, maxSize, after, before):
+        """Turn the filters of select() into a list of (column, test, value)
+        triples, or None if they can match nothing."""
+        tests = []
+        if volume is not None:
+            if volume not in self.volumes:
+                return None
+            tests.append(("volume", "==", self.volumes.index(volume)))
+        if extension is not None:
+            if extension.startswith("."):
+                extension = extension[1:]
+            if extension not in self.extensions:
+                return None
+            tests.append(("extension", "==", self.extensions.index(extension)))
+        if minSize is not None:
+            tests.append(("size", ">=", minSize))
+        if maxSize is not None:
+            tests.append(("size", "<=", maxSize))
+        if after is not None:
+            tests.append(("modified", ">=", after))
+        if before is not None:
+            tests.append(("modified", "<", before))
+        if after is None and before is not None:
+            tests.append(("modified", ">", NO_TIME))
+        return tests
+
+    def select(self, name = None, volume = None, extension = None,
+               minSize = None, maxSize = None, after = None, before = None):
+        """Return the indices of the entries matching every filter given:
+        a name pattern, a volume name, an extension, sizes in bytes (both
+        bounds inclusive), and modification times in seconds since the
+        epoch (AFTER inclusive, BEFORE exclusive)."""
+        tests = self.conditions(volume, extension, minSize, maxSize, after,
+                                before)
+        if tests is None:
+            return []
+
+        rows = None
+        if name is not None:
+            rows = self.matchNames(name)
+
+        if self.numpy:
+            mask = None
+            for (column, test, value) in tests:
+                values = self.columns[column]
+                if test == "==":
+                    result = values == value
+                elif test == ">=":
+                    result = values >= value
+                elif test == "<=":
+                    result = values <= value
+                elif test == ">":
+                    result = values > value
+                else:
+                    result = values < value
+                if mask is None:
+                    mask = result
+                else:
+                    mask &= result
+
+            if rows is None:
+                if mask is None:
+                    return numpy.arange(self.count)
+                return numpy.nonzero(mask)[0]
+            if mask is None:
+                return rows
+            return rows[mask[rows]]
+
+        if rows is not None:
+            # Only a few rows are left, so look each one up where it lies
+            return [index for index in rows if self.matches(index, tests)]
+        if not tests:
+            return range(self.count)
+        return self.scan(tests)
+
+    def matches(self, index, tests):
+        for (column, test, value) in tests:
+            if not compare(self.columns[column][index], test, value):
+                return False
+        return True
+
+    def scan(self, tests):
+        """Test every entry, a block of each column at a time."""
+        rows    = []
+        needed  = []
+        for (column, test, value) in tests:
+            if column not in needed:
+                needed.append(column)
+        readers = [self.columns[column].blocks() for column in needed]
+
+        for blocks in zip(*readers):
+            start  = blocks[0][0]
+            values = dict(zip(needed, [block for (offset, block) in blocks]))
+            for i in xrange(len(blocks[0][1])):
+                for (column, test, value) in tests:
+                    if not compare(values[column][i], test, value):
+                        break
+                else:
+                    rows.append(start + i)
+        return rows
+
+def compare(item, test, value):
+    if test == "==":
+        return item == value
+    elif test == ">=":
+        return item >= value
+    elif test == "<=":
+        return item <= value
+    elif test == ">":
+        return item > value
+    else:
+        return item < value
+
+########################################################################
+
+def parseDate(text):
+    for format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(text, format))
+        except ValueError:
+            pass
+    raise ValueError("cannot parse date '%s'" % text)
+
+def main(argv):
+    parser = optparse.OptionParser(usage = "%prog DIR [options]")
+    parser.add_option('-n', '--name', metavar='PATTERN',
+                      type='string', action='store', dest='name',
+                      help="entries whose name matches PATTERN ('*' for any)")
+    parser.add_option('-e', '--ext', metavar='EXT',
+                      type='string', action='store', dest='extension',
+                      help='entries with the extension EXT')
+    parser.add_option('-V', '--volume', metavar='NAME',
+                      type='string', action='store', dest='volume',
+                      help='entries on the volume NAME')
+    parser.add_option('', '--min-size', metavar='BYTES',
+                      type='long', action='store', dest='minSize',
+                      help='entries of at least BYTES')
+    parser.add_option('', '--max-size', metavar='BYTES',
+                      type='long', action='store', dest='maxSize',
+                      help='entries of at most BYTES')
+    parser.add_option('', '--after', metavar='DATE',
+                      type='string', action='store', dest='after',
+                      help='entries modified on or after DATE (YYYY-MM-DD)')
+    parser.add_option('', '--before', metavar='DATE',
+                      type='string', action='store', dest='before',
+                      help='entries modified before DATE (YYYY-MM-DD)')
+    parser.add_option('', '--no-numpy',
+                      action='store_false', dest='useNumPy', default=True,
+                      help='scan the columns without NumPy, even if it is there')
+
+    (opts, args) = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.print_usage()
+        return 1
+
+    after  = opts.after and parseDate(opts.after)
+    before = opts.before and parseDate(opts.before)
+
+    reader = ColumnReader(args[0], opts.useNumPy)
+    try:
+        for index in reader.select(opts.name, opts.volume, opts.extension,
+                                   opts.minSize, opts.maxSize, after, before):
+            row = reader.row(index)
+            print row["volume"].encode("utf-8"), "=>", row["path"].encode("utf-8")
+    finally:
+        reader.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
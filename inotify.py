@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#
+# inotify.py -- a small ctypes binding to Linux's inotify(7), for
+# "catalog watch"
+#
+# Only what the catalog needs is here: watching directories, and reading the
+# events queued for them, each as a (watch descriptor, mask, cookie, name)
+# tuple.  NAME is the name of the child of the watched directory that the
+# event is about, or "" if it is about the directory itself.
+
+import os
+import select
+import struct
+import ctypes
+import ctypes.util
+
+IN_ACCESS        = 0x00000001
+IN_MODIFY        = 0x00000002
+IN_ATTRIB        = 0x00000004
+IN_CLOSE_WRITE   = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN          = 0x00000020
+IN_MOVED_FROM    = 0x00000040
+IN_MOVED_TO      = 0x00000080
+IN_CREATE        = 0x00000100
+IN_DELETE        = 0x00000200
+IN_DELETE_SELF   = 0x00000400
+IN_MOVE_SELF     = 0x00000800
+
+IN_UNMOUNT       = 0x00002000
+IN_Q_OVERFLOW    = 0x00004000
+IN_IGNORED       = 0x00008000
+
+IN_ONLYDIR       = 0x01000000
+IN_DONT_FOLLOW   = 0x02000000
+IN_EXCL_UNLINK   = 0x04000000
+IN_ISDIR         = 0x40000000
+
+EVENT_HEADER = struct.Struct("iIII")   # wd, mask, cookie, len
+
+class Inotify(object):
+    """An inotify instance, and the watches added to it."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                                use_errno = True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            self.raiseError()
+
+    def raiseError(self, path = None):
+        error = ctypes.get_errno()
+        if path is None:
+            raise OSError(error, os.strerror(error))
+        raise OSError(error, os.strerror(error), path)
+
+    def fileno(self):
+        return self.fd
+
+    def addWatch(self, path, mask):
+        """Watch PATH for the events in MASK, returning the descriptor that
+        its events will carry.  Watching a path again replaces its mask and
+        returns the same descriptor."""
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self.raiseError(path)
+        return wd
+
+    def removeWatch(self, wd):
+        """Stop watching WD.  Its last event is IN_IGNORED."""
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout = None):
+        """Return the events queued so far, waiting up to TIMEOUT seconds
+        (forever if None) for there to be any."""
+        (ready, writable, failed) = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data   = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name    = data[offset:offset + length].rstrip("\0")
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -0,0 +1,709 @@
+#!/usr/bin/env python
+#
+# isoimage.py -- list the contents of ISO 9660 and UDF disc images without
+# mounting them, for "catalog index"
+#
+# Usage:
+#
+#   isoimage.py IMAGE
+#
+# Only the volume descriptors and the directories of an image are read,
+# seeking to each in turn; the data of the files in it never is.  The formats
+# understood are:
+#
+#   UDF        DVD and Blu-ray images, UDF 1.02 to 2.60, including the
+#              metadata partition of 2.50 and later
+#   ISO 9660   CD images, with the Rock Ridge extensions (POSIX names,
+#              permissions, owners, times and symbolic links) or the Joliet
+#              extensions (Unicode names)
+#
+# An image may carry several of them over the same files.  UDF is preferred
+# (it has neither the 4GB file size limit nor the name limits of ISO 9660),
+# then Rock Ridge, then Joliet, then the plain ISO 9660 names.
+#
+# Malformed images raise ValueError.
+
+import sys
+import struct
+import calendar
+
+SECTOR = 2048
+
+(FILE, DIRECTORY, SYMLINK) = range(3)
+
+class ImageFile(object):
+    """A file, directory or symbolic link in an image.  PATH is relative to
+    the image's root, with "/" between names; MTIME is in seconds since the
+    epoch, or None.  MODE (permission bits only), UID and GID are None if
+    the image does not record them; TARGET is the text of a link."""
+    __slots__ = ('path', 'kind', 'size', 'mtime', 'mode', 'uid', 'gid',
+                 'target')
+
+    def __init__(self, path, kind, size, mtime, mode = None, uid = None,
+                 gid = None, target = None):
+        self.path   = path
+        self.kind   = kind
+        self.size   = size
+        self.mtime  = mtime
+        self.mode   = mode
+        self.uid    = uid
+        self.gid    = gid
+        self.target = target
+
+def u16(data, offset):
+    return struct.unpack_from("<H", data, offset)[0]
+
+def u32(data, offset):
+    return struct.unpack_from("<I", data, offset)[0]
+
+def u64(data, offset):
+    return struct.unpack_from("<Q", data, offset)[0]
+
+def decodeName(name):
+    """Decode a name recorded as bytes in no stated encoding."""
+    try:
+        return name.decode("utf-8")
+    except UnicodeDecodeError:
+        return name.decode("latin-1")
+
+def joinTarget(parts):
+    """Join the components of a link target; a leading "" stands for the
+    root."""
+    if parts == [""]:
+        return u"/"
+    return u"/".join(parts)
+
+class IsoImage(object):
+    """An ISO 9660 or UDF image open for listing.  FORMAT tells which of
+    "udf", "rockridge", "joliet" or "iso9660" its files are listed from."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd   = open(path, "rb")
+        self.fd.seek(0, 2)
+        self.imageSize = self.fd.tell()
+        self.format = None
+        try:
+            self.readDescriptors()
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+
+    def readAt(self, offset, length):
+        if offset < 0 or length < 0 or offset + length > self.imageSize:
+            raise ValueError("%s: reference beyond the end of the image" %
+                             self.path)
+        self.fd.seek(offset)
+        return self.fd.read(length)
+
+    def readDescriptors(self):
+        """Read the volume recognition sequence, which starts at sector 16:
+        the ISO 9660 volume descriptors, then UDF's "NSR" descriptor."""
+        primary = None
+        joliet  = None
+        udf     = False
+
+        sector = 16
+        while (sector + 1) * SECTOR <= self.imageSize and sector < 256:
+            data = self.readAt(sector * SECTOR, SECTOR)
+            ident = data[1:6]
+            if ident == "CD001":
+                kind = ord(data[0])
+                if kind == 1 and primary is None:
+                    primary = data
+                elif kind == 2 and data[88:91] in ("%/@", "%/C", "%/E"):
+                    joliet = data
+            elif ident in ("NSR02", "NSR03"):
+                udf = True
+            elif ident == "TEA01":
+                break
+            elif ident not in ("BEA01", "BOOT2", "CDW02"):
+                break
+            sector += 1
+
+        if udf:
+            try:
+                self.openUdf()
+                self.format = "udf"
+                return
+            except ValueError:
+                if primary is None:
+                    raise
+
+        if primary is None:
+            raise ValueError("%s: neither an ISO 9660 nor a UDF image" %
+                             self.path)
+        self.openIso(primary, joliet)
+
+    def walk(self):
+        """Yield an ImageFile for everything in the image, each directory
+        before what it holds."""
+        if self.format == "udf":
+            return self.walkUdf()
+        return self.walkIso()
+
+    ####################################################################
+    #
+    # ISO 9660
+    #
+    # A directory is an extent of records, each naming a file or directory
+    # and giving the extent of its data.  Records never cross a sector;
+    # the rest of a sector after its last record is zero.  Rock Ridge keeps
+    # its attributes in the "system use" area at the end of each record, as
+    # a series of SUSP entries, which may continue in a separate area.
+
+    def openIso(self, primary, joliet):
+        self.blockSize  = u16(primary, 128)
+        self.suspSkip   = 0
+        self.rockRidge  = False
+
+        root = primary[156:190]
+        (extent, length) = (u32(root, 2), u32(root, 10))
+
+        # Rock Ridge announces itself with an "SP" entry in the root's "."
+        # record, giving the bytes to skip in every system use area
+        data = self.readAt(extent * self.blockSize, min(length, SECTOR))
+        first = data[:ord(data[0])]
+        system = self.systemUse(first)
+        if system[:2] == "SP" and system[4:6] == "\xbe\xef":
+            self.rockRidge = True
+            self.suspSkip  = ord(system[6])
+
+        if self.rockRidge:
+            self.format = "rockridge"
+        elif joliet is not None:
+            self.format = "joliet"
+            root = joliet[156:190]
+        else:
+            self.format = "iso9660"
+
+        self.root = (u32(root, 2), u32(root, 10))
+
+    def systemUse(self, record):
+        nameLength = ord(record[32])
+        start = 33 + nameLength
+        if nameLength % 2 == 0:
+            start += 1
+        return record[start:]
+
+    def records(self, extent, length):
+        data = self.readAt(extent * self.blockSize, length)
+        offset = 0
+        while offset < len(data):
+            recordLength = ord(data[offset])
+            if recordLength == 0:
+                offset = (offset // SECTOR + 1) * SECTOR
+                continue
+            if recordLength < 34:
+                raise ValueError("%s: bad directory record" % self.path)
+            yield data[offset:offset + recordLength]
+            offset += recordLength
+
+    def suspEntries(self, record):
+        """Return the (signature, entry) pairs of RECORD's SUSP entries,
+        following continuation ("CE") areas."""
+        entries = []
+        areas = [self.systemUse(record)[self.suspSkip:]]
+        followed = 0
+        while areas:
+            area = areas.pop(0)
+            i = 0
+            while i + 4 <= len(area):
+                signature = area[i:i + 2]
+                length = ord(area[i + 2])
+                if length < 4:
+                    break
+                entry = area[i:i + length]
+                i += length
+                if signature == "ST":
+                    break
+                elif signature == "CE" and len(entry) >= 28:
+                    followed += 1
+                    if followed > 64:
+                        raise ValueError("%s: too many SUSP continuations" %
+                                         self.path)
+                    areas.append(self.readAt(
+                        u32(entry, 4) * self.blockSize + u32(entry, 12),
+                        u32(entry, 20)))
+                else:
+                    entries.append((signature, entry))
+        return entries
+
+    def isoTime(self, data):
+        """Decode a 7-byte directory record date, or None."""
+        (year, month, day, hour, minute, second, zone) = \
+            struct.unpack("<6Bb", data)
+        if not month or not day:
+            return None
+        try:
+            return calendar.timegm((1900 + year, month, day, hour, minute,
+                                    second, 0, 0, 0)) - zone * 900
+        except (ValueError, OverflowError):
+            return None
+
+    def longIsoTime(self, data):
+        """Decode a 17-byte "YYYYMMDDHHMMSScc" date and zone, or None."""
+        digits = data[:16]
+        if not digits.isdigit() or digits[:4] == "0000":
+            return None
+        try:
+            return calendar.timegm((int(digits[0:4]), int(digits[4:6]),
+                                    int(digits[6:8]), int(digits[8:10]),
+                                    int(digits[10:12]), int(digits[12:14]),
+                                    0, 0, 0)) - \
+                struct.unpack("b", data[16])[0] * 900
+        except (ValueError, OverflowError):
+            return None
+
+    def rockRidgeInfo(self, record, info):
+        """Update INFO, a dict with the record's name, kind, extent, length,
+        mtime and so on, from its Rock Ridge entries.  Returns False if the
+        record is to be skipped, being a directory moved elsewhere."""
+        names     = []
+        links     = []
+        linkParts = []
+        continuing = False
+
+        for (signature, entry) in self.suspEntries(record):
+            if signature == "NM":
+                flags = ord(entry[4])
+                if flags & 0x06:        # "." or ".."
+                    continue
+                names.append(entry[5:])
+            elif signature == "PX" and len(entry) >= 36:
+                mode = u32(entry, 4)
+                info["mode"] = mode & 07777
+                info["uid"]  = u32(entry, 20)
+                info["gid"]  = u32(entry, 28)
+                if mode & 0170000 == 0120000:
+                    info["kind"] = SYMLINK
+            elif signature == "SL":
+                links.append(entry)
+            elif signature == "TF":
+                flags = ord(entry[4])
+                size = 7
+                if flags & 0x80:
+                    size = 17
+                offset = 5
+                if flags & 0x01:        # creation, before modification
+                    offset += size
+                if flags & 0x02:
+                    stamp = entry[offset:offset + size]
+                    if len(stamp) == size:
+                        if size == 7:
+                            info["mtime"] = self.isoTime(stamp)
+                        else:
+                            info["mtime"] = self.longIsoTime(stamp)
+            elif signature == "CL":
+                # A directory relocated to keep the tree within 8 levels: its
+                # contents are at the extent given, whose "." record says
+                # how long it is
+                extent = u32(entry, 4)
+                data   = self.readAt(extent * self.blockSize, 34)
+                info["kind"]   = DIRECTORY
+                info["extent"] = extent
+                info["length"] = u32(data, 10)
+            elif signature == "RE":
+                return False
+
+        if names:
+            info["name"] = decodeName("".join(names))
+
+        for entry in links:
+            i = 5
+            while i + 2 <= len(entry):
+                (flags, length) = (ord(entry[i]), ord(entry[i + 1]))
+                text = entry[i + 2:i + 2 + length]
+                i += 2 + length
+                if flags & 0x02:
+                    text = "."
+                elif flags & 0x04:
+                    text = ".."
+                elif flags & 0x08:
+                    text = ""
+                if continuing:
+                    linkParts[-1] += decodeName(text)
+                else:
+                    linkParts.append(decodeName(text))
+                continuing = bool(flags & 0x01)
+        if linkParts:
+            info["kind"]   = SYMLINK
+            info["target"] = joinTarget(linkParts)
+
+        return True
+
+    def walkIso(self):
+        stack = [(u"", self.root[0], self.root[1])]
+        seen  = set()
+
+        while stack:
+            (prefix, extent, length) = stack.pop()
+            if extent in seen:
+                continue
+            seen.add(extent)
+
+            carried = 0
+            for record in self.records(extent, length):
+                flags = ord(record[25])
+                name  = record[33:33 + ord(record[32])]
+                if name in ("\0", "\1") or flags & 0x04:
+                    continue
+
+                # A file larger than 4GB is split over several records, all
+                # but the last flagged as continued
+                size = u32(record, 10)
+                if flags & 0x80:
+                    carried += size
+                    continue
+                size += carried
+                carried = 0
+
+                if self.format == "joliet":
+                    name = name.decode("utf-16-be", "replace")
+                else:
+                    name = decodeName(name)
+                if not flags & 0x02:
+                    name = name.split(u";")[0]
+                    if self.format != "joliet":
+                        name = name.rstrip(u".")
+
+                info = {"name": name, "extent": u32(record, 2),
+                        "length": size, "mtime": self.isoTime(record[18:25]),
+                        "mode": None, "uid": None, "gid": None,
+                        "target": None, "kind": FILE}
+                if flags & 0x02:
+                    info["kind"] = DIRECTORY
+
+                if self.rockRidge and not self.rockRidgeInfo(record, info):
+                    continue
+
+                path = prefix + info["name"]
+                if info["kind"] == DIRECTORY:
+                    yield ImageFile(path, DIRECTORY, 0, info["mtime"],
+                                    info["mode"], info["uid"], info["gid"])
+                    stack.append((path + u"/", info["extent"],
+                                  info["length"]))
+                else:
+                    if info["kind"] == SYMLINK:
+                        size = 0
+                    yield ImageFile(path, info["kind"], size, info["mtime"],
+                                    info["mode"], info["uid"], info["gid"],
+                                    info["target"])
+
+    ####################################################################
+    #
+    # UDF
+    #
+    # The anchor at sector 256 points to the volume descriptor sequence,
+    # which describes the partitions, and the logical volume built from
+    # them.  Blocks are addressed within a partition, through the logical
+    # volume's partition maps; with a metadata partition, the blocks of the
+    # file system's structures are found through the extents of its
+    # metadata file.  The file set descriptor gives the root directory's
+    # file entry; a directory's data is a series of file identifier
+    # descriptors, each naming a child and giving its file entry.
+
+    def openUdf(self):
+        anchor = None
+        for sector in (256, self.imageSize // SECTOR - 1,
+                       self.imageSize // SECTOR - 257):
+            if sector > 0 and (sector + 1) * SECTOR <= self.imageSize:
+                data = self.readAt(sector * SECTOR, 512)
+                if u16(data, 0) == 2:
+                    anchor = data
+                    break
+        if anchor is None:
+            raise ValueError("%s: no UDF anchor" % self.path)
+
+        partitions = {}
+        volume     = None
+        (length, location) = (u32(anchor, 16), u32(anchor, 20))
+        for sector in range(location, location + max(length // SECTOR, 1)):
+            data = self.readAt(sector * SECTOR, SECTOR)
+            tag  = u16(data, 0)
+            if tag == 5:
+                partitions[u16(data, 22)] = u32(data, 188)
+            elif tag == 6 and volume is None:
+                volume = data
+            elif tag == 8:
+                break
+        if volume is None or not partitions:
+            raise ValueError("%s: no UDF logical volume" % self.path)
+
+        self.blockSize = u32(volume, 212)
+        if self.blockSize not in (512, 1024, 2048, 4096):
+            raise ValueError("%s: bad UDF block size" % self.path)
+
+        # Each partition map is addressed by its position in the table
+        self.maps = []
+        table = volume[440:440 + u32(volume, 264)]
+        offset = 0
+        for i in range(u32(volume, 268)):
+            (kind, length) = (ord(table[offset]), ord(table[offset + 1]))
+            entry = table[offset:offset + length]
+            if kind == 1:
+                number = u16(entry, 4)
+                self.maps.append([partitions.get(number), None])
+            elif kind == 2:
+                ident  = entry[5:28].rstrip("\0")
+                number = u16(entry, 38)
+                if ident == "*UDF Metadata Partition":
+                    self.maps.append([partitions.get(number), u32(entry, 40)])
+                elif ident == "*UDF Sparable Partition":
+                    # Images are read back whole, with nothing spared
+                    self.maps.append([partitions.get(number), None])
+                else:
+                    raise ValueError("%s: unsupported UDF partition %s" %
+                                     (self.path, ident))
+            else:
+                raise ValueError("%s: bad UDF partition map" % self.path)
+            if self.maps[-1][0] is None:
+                raise ValueError("%s: UDF partition %d is missing" %
+                                 (self.path, number))
+            offset += length
+
+        # Replace each metadata file's location with its extents, as
+        # (first block, count) within the physical partition, which is
+        # where the metadata file itself is found
+        for partition in [map for map in self.maps if map[1] is not None]:
+            physical = [ref for ref in range(len(self.maps))
+                        if self.maps[ref] == [partition[0], None]]
+            if not physical:
+                self.maps.append([partition[0], None])
+                physical = [len(self.maps) - 1]
+            fileEntry = self.fileEntry(physical[0], partition[1])
+            extents = []
+            for (ref, block, length) in self.allocations(fileEntry):
+                extents.append((block, length // self.blockSize))
+            partition[1] = extents
+
+        fileSet = u32(volume, 252)
+        data = self.readBlock(u16(volume, 256), fileSet)
+        if u16(data, 0) != 256:
+            raise ValueError("%s: no UDF file set" % self.path)
+        self.root = (u16(data, 408), u32(data, 404))
+
+    def blockOffset(self, ref, block):
+        """Return the byte offset of BLOCK in the partition mapped by REF."""
+        if ref >= len(self.maps):
+            raise ValueError("%s: bad UDF partition reference" % self.path)
+
+        (start, extents) = self.maps[ref]
+        if extents is None:
+            return (start + block) * self.blockSize
+        for (first, count) in extents:
+            if block < count:
+                return (start + first + block) * self.blockSize
+            block -= count
+        raise ValueError("%s: block beyond the UDF metadata" % self.path)
+
+    def readBlock(self, ref, block):
+        return self.readAt(self.blockOffset(ref, block), self.blockSize)
+
+    def fileEntry(self, ref, block):
+        """Read the file entry at BLOCK of REF, returning (file type, ICB
+        flags, information length, mtime, mode, uid, gid, allocation
+        descriptors, and REF, which short allocation descriptors are
+        relative to)."""
+        data = self.readBlock(ref, block)
+        tag  = u16(data, 0)
+        if tag == 261:
+            (mtime, eaLength, adLength, start) = \
+                (data[84:96], u32(data, 168), u32(data, 172), 176)
+        elif tag == 266:
+            (mtime, eaLength, adLength, start) = \
+                (data[92:104], u32(data, 208), u32(data, 212), 216)
+        else:
+            raise ValueError("%s: no UDF file entry at block %d" %
+                             (self.path, block))
+
+        permissions = u32(data, 44)
+        mode = ((permissions >> 10) & 7) << 6 | \
+               ((permissions >> 5) & 7) << 3 | (permissions & 7)
+        (uid, gid) = (u32(data, 36), u32(data, 40))
+        if uid == 0xFFFFFFFF:
+            uid = None
+        if gid == 0xFFFFFFFF:
+            gid = None
+
+        descriptors = data[start + eaLength:start + eaLength + adLength]
+        return (ord(data[27]), u16(data, 34), u64(data, 56),
+                self.udfTime(mtime), mode, uid, gid, descriptors, ref)
+
+    def udfTime(self, data):
+        (zone, year, month, day, hour, minute, second, centi, hundreds,
+         micro) = struct.unpack("<Hh8B", data)
+        if not year or not month or not day:
+            return None
+
+        offset = 0
+        minutes = zone & 0xFFF
+        if minutes & 0x800:
+            minutes -= 0x1000
+        if zone >> 12 == 1 and minutes != -2047:
+            offset = minutes * 60
+        try:
+            return calendar.timegm((year, month, day, hour, minute, second,
+                                    0, 0, 0)) - offset + \
+                centi / 100.0 + hundreds / 10000.0 + micro / 1000000.0
+        except (ValueError, OverflowError):
+            return None
+
+    def allocations(self, fileEntry):
+        """Return the (partition reference, block, length) extents holding
+        the data of FILEENTRY, following continuations of its allocation
+        descriptors."""
+        (flags, descriptors, ref) = \
+            (fileEntry[1], fileEntry[7], fileEntry[8])
+        kind = flags & 7
+        sizes = {0: 8, 1: 16, 2: 20}
+        if kind not in sizes:
+            raise ValueError("%s: bad UDF allocation descriptors" % self.path)
+
+        extents  = []
+        offset   = 0
+        followed = 0
+        while offset + sizes[kind] <= len(descriptors):
+            length = u32(descriptors, offset)
+            extentType = length >> 30
+            length &= 0x3FFFFFFF
+            if length == 0:
+                break
+            if kind == 0:
+                (block, extentRef) = (u32(descriptors, offset + 4), ref)
+            elif kind == 1:
+                (block, extentRef) = (u32(descriptors, offset + 4),
+                                      u16(descriptors, offset + 8))
+            else:
+                (block, extentRef) = (u32(descriptors, offset + 12),
+                                      u16(descriptors, offset + 16))
+            offset += sizes[kind]
+
+            if extentType == 3:
+                # The descriptors go on in the extent given
+                followed += 1
+                if followed > 4096:
+                    raise ValueError("%s: too many UDF extents" % self.path)
+                descriptors = self.readAt(self.blockOffset(extentRef, block),
+                                          length)
+                if u16(descriptors, 0) == 258:  # allocation extent header
+                    descriptors = descriptors[24:24 + u32(descriptors, 20)]
+                offset = 0
+            elif extentType == 0:
+                extents.append((extentRef, block, length))
+        return extents
+
+    def fileData(self, fileEntry):
+        """Return the contents of FILEENTRY, a directory or link."""
+        (flags, length, descriptors) = \
+            (fileEntry[1], fileEntry[2], fileEntry[7])
+        if flags & 7 == 3:              # embedded in the file entry
+            return descriptors[:length]
+        if length > 64 * 1024 * 1024:
+            raise ValueError("%s: UDF directory too large" % self.path)
+
+        parts = []
+        for (ref, block, size) in self.allocations(fileEntry):
+            parts.append(self.readAt(self.blockOffset(ref, block), size))
+        return "".join(parts)[:length]
+
+    def dstring(self, data):
+        """Decode an OSTA compressed Unicode string."""
+        if not data:
+            return u""
+        if data[0] == "\x08":
+            return data[1:].decode("latin-1")
+        if data[0] == "\x10":
+            return data[1:].decode("utf-16-be", "replace")
+        raise ValueError("%s: bad UDF name encoding" % self.path)
+
+    def identifiers(self, data):
+        """Yield (name, is a directory, partition reference, block) for the
+        file identifier descriptors in DATA, a directory's contents."""
+        offset = 0
+        while offset + 38 <= len(data):
+            if u16(data, offset) != 257:
+                raise ValueError("%s: bad UDF directory" % self.path)
+            characteristics = ord(data[offset + 18])
+            nameLength = ord(data[offset + 19])
+            useLength  = u16(data, offset + 36)
+            block      = u32(data, offset + 24)
+            ref        = u16(data, offset + 28)
+            start      = offset + 38 + useLength
+            name       = data[start:start + nameLength]
+            offset    += (38 + useLength + nameLength + 3) & ~3
+
+            # Skip the parent, and deleted entries
+            if characteristics & 0x0C:
+                continue
+            yield (self.dstring(name), bool(characteristics & 0x02), ref,
+                   block)
+
+    def linkTarget(self, data):
+        """Decode the path components stored as a symbolic link's data."""
+        parts  = []
+        offset = 0
+        while offset + 4 <= len(data):
+            (kind, length) = (ord(data[offset]), ord(data[offset + 1]))
+            text = data[offset + 4:offset + 4 + length]
+            offset += 4 + length
+            if kind in (1, 2):                 # the root
+                parts = [u""]
+            elif kind == 3:
+                parts.append(u"..")
+            elif kind == 4:
+                parts.append(u".")
+            elif kind == 5:
+                parts.append(self.dstring(text))
+        return joinTarget(parts)
+
+    def walkUdf(self):
+        stack = [(u"", self.root[0], self.root[1])]
+        seen  = set()
+
+        while stack:
+            (prefix, ref, block) = stack.pop()
+            if (ref, block) in seen:
+                continue
+            seen.add((ref, block))
+
+            directory = self.fileEntry(ref, block)
+            for (name, isDirectory, childRef, childBlock) in \
+                    self.identifiers(self.fileData(directory)):
+                path = prefix + name
+                entry = self.fileEntry(childRef, childBlock)
+                (fileType, length, mtime, mode, uid, gid) = \
+                    (entry[0], entry[2], entry[3], entry[4], entry[5],
+                     entry[6])
+
+                if fileType == 4 or isDirectory:
+                    yield ImageFile(path, DIRECTORY, 0, mtime, mode, uid, gid)
+                    stack.append((path + u"/", childRef, childBlock))
+                elif fileType == 12:
+                    yield ImageFile(path, SYMLINK, 0, mtime, mode, uid, gid,
+                                    self.linkTarget(self.fileData(entry)))
+                elif fileType in (0, 5):
+                    yield ImageFile(path, FILE, length, mtime, mode, uid, gid)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print "usage: isoimage.py IMAGE"
+        sys.exit(1)
+
+    image = IsoImage(sys.argv[1])
+    try:
+        print "# %s" % image.format
+        for info in image.walk():
+            line = u"%12d  %s" % (info.size, info.path)
+            if info.kind == DIRECTORY:
+                line += u"/"
+            elif info.kind == SYMLINK:
+                line += u" -> %s" % info.target
+            print line.encode("utf-8")
+    finally:
+        image.close()
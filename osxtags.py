@@ -1,3 +1,17 @@
+# Tags are words kept with a file, in one of two places depending on the
+# backend:
+#
+#   FinderBackend   the Spotlight comment, through Finder (OS/X, appscript)
+#   XattrBackend    the "user.xdg.tags" extended attribute, comma-separated,
+#                   with the comment in "user.xdg.comment" (pyxattr or xattr)
+#
+# The batch functions take many paths and many tags, and read and write each
+# file's tags once, whatever the number of tags.  The single-path functions
+# below them are kept for existing callers.
+
+import sys
+import errno
+
 appscript = None
 try:
     import appscript
@@ -5,92 +19,190 @@ try:
 except:
     pass
 
+xattr = None
+try:
+    import xattr
+except ImportError:
+    pass
 
-def comment(path):
-    if not appscript:
-        return False
 
-    finder = appscript.app('Finder')
-    alias  = mactypes.Alias(path)
+class FinderBackend:
+    def __init__(self):
+        self.finder = appscript.app('Finder')
 
-    try:
-        return finder.files[alias].comment.get()
-    except:
-        return ""
+    def file(self, path):
+        return self.finder.files[mactypes.Alias(path)]
 
-def setcomment(path, comment):
-    if not appscript:
-        return False
+    def comment(self, path):
+        try:
+            return self.file(path).comment.get()
+        except:
+            return None
 
-    finder = appscript.app('Finder')
-    alias  = mactypes.Alias(path)
+    def setcomment(self, path, comment):
+        try:
+            self.file(path).comment.set(comment)
+            return True
+        except:
+            return False
 
-    try:
-        return finder.files[alias].comment.set(comment)
-    except:
-        return ""
+    def tags(self, path):
+        comment = self.comment(path)
+        if comment is None:
+            return None
+        return comment.split()
 
+    def settags(self, path, tags):
+        return self.setcomment(path, ' '.join(tags))
 
-def hastags(path, tags):
-    if not appscript:
-        return False
 
-    for tag in tags:
-        if tag not in comment(path):
+class XattrBackend:
+    TAGS    = 'user.xdg.tags'
+    COMMENT = 'user.xdg.comment'
+
+    def get(self, path, name):
+        try:
+            if hasattr(xattr, 'get'):           # pyxattr
+                return xattr.get(path, name).decode('utf-8')
+            else:                               # xattr
+                return xattr.getxattr(path, name).decode('utf-8')
+        except (IOError, OSError), err:
+            if err.errno in (errno.ENODATA, getattr(errno, 'ENOATTR', 93)):
+                return ""
+            return None
+
+    def set(self, path, name, value):
+        try:
+            if not value:
+                if self.get(path, name):
+                    if hasattr(xattr, 'remove'):
+                        xattr.remove(path, name)
+                    else:
+                        xattr.removexattr(path, name)
+            elif hasattr(xattr, 'set'):
+                xattr.set(path, name, value.encode('utf-8'))
+            else:
+                xattr.setxattr(path, name, value.encode('utf-8'))
+            return True
+        except (IOError, OSError):
             return False
-    return True
 
-def hastag(path, *tags):
-    return hastags(path, tags)
+    def comment(self, path):
+        return self.get(path, self.COMMENT)
+
+    def setcomment(self, path, comment):
+        return self.set(path, self.COMMENT, comment)
+
+    def tags(self, path):
+        value = self.get(path, self.TAGS)
+        if value is None:
+            return None
+        return [tag.strip() for tag in value.split(',') if tag.strip()]
+
+    def settags(self, path, tags):
+        return self.set(path, self.TAGS, ','.join(tags))
+
+
+backend = None
+if appscript:
+    backend = FinderBackend()
+elif xattr and sys.platform.startswith('linux'):
+    backend = XattrBackend()
+
+
+def readpaths(stream):
+    return [line.rstrip('\n') for line in stream if line.rstrip('\n')]
 
 
-def addtags(path, *tags):
-    if not appscript:
+def batchcomments(paths):
+    if not backend:
         return False
+    return dict([(path, backend.comment(path)) for path in paths])
+
+def batchsetcomment(paths, comment):
+    if not backend:
+        return False
+    return [path for path in paths if backend.setcomment(path, comment)]
 
-    finder = appscript.app('Finder')
-    alias  = mactypes.Alias(path)
 
-    comment = ""
-    try:
-        comment = finder.files[alias].comment.get()
-    except:
+def batchhastags(paths, tags):
+    if not backend:
         return False
 
-    for tag in tags:
-        try:
-            if tag not in comment:
-                if comment:
-                    finder.files[alias].comment.set(comment + ' ' + tag)
-                else:
-                    finder.files[alias].comment.set(tag)
-        except:
-            pass
+    matching = []
+    for path in paths:
+        present = backend.tags(path)
+        if present is None:
+            continue
+        for tag in tags:
+            if tag not in present:
+                break
+        else:
+            matching.append(path)
+    return matching
+
+def batchaddtags(paths, tags):
+    if not backend:
+        return False
 
-def addtag(path, *tags):
-    return addtags(path, tags)
+    changed = []
+    for path in paths:
+        present = backend.tags(path)
+        if present is None:
+            continue
+        missing = [tag for tag in tags if tag not in present]
+        if missing and backend.settags(path, present + missing):
+            changed.append(path)
+    return changed
+
+def batchdeltags(paths, tags):
+    if not backend:
+        return False
+
+    changed = []
+    for path in paths:
+        present = backend.tags(path)
+        if present is None:
+            continue
+        remaining = [tag for tag in present if tag not in tags]
+        if len(remaining) < len(present) and backend.settags(path, remaining):
+            changed.append(path)
+    return changed
 
 
-def deltags(path, *tags):
-    if not appscript:
+def comment(path):
+    if not backend:
         return False
+    return backend.comment(path) or ""
 
-    finder = appscript.app('Finder')
-    alias  = mactypes.Alias(path)
+def setcomment(path, comment):
+    if not backend:
+        return False
+    return backend.setcomment(path, comment)
 
-    comment = ""
-    try:
-        comment = finder.files[alias].comment.get()
-    except:
-        pass
 
-    for tag in tags:
-        comment = re.sub("\\s*%s" % tag, "", comment)
+def hastags(path, tags):
+    if not backend:
+        return False
+    return bool(batchhastags([path], tags))
+
+def hastag(path, *tags):
+    return hastags(path, tags)
+
+
+def addtags(path, tags):
+    if not backend:
+        return False
+    return bool(batchaddtags([path], tags))
+
+def addtag(path, *tags):
+    return addtags(path, tags)
+
 
-    try:
-        finder.files[alias].comment.set(comment)
-    except:
-        pass
+def deltags(path, tags):
+    if not backend:
+        return False
+    return bool(batchdeltags([path], tags))
 
 def deltag(path, *tags):
     return deltags(path, tags)